@@ -27,18 +27,47 @@ TODO
  - Emission?
 '''
 
-from scipy.optimize import newton_krylov, minimize
+from scipy.optimize import minimize, NoConvergence
+from scipy.sparse.linalg import LinearOperator, gmres
 import seaborn as sns, pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 import time
+import math
+import warnings
+
+try:
+    from numba import njit, prange, get_num_threads
+    numba_available = True
+except ImportError:
+    # without numba the particle kernels fall back to the plain python loops
+    numba_available = False
+    prange = range
+    get_num_threads = lambda: 1
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+try:
+    from joblib import Parallel, delayed
+    joblib_available = True
+except ImportError:
+    # without joblib the grid inversion runs point by point in this process
+    joblib_available = False
+
+try:
+    from numba import cuda
+    cuda_available = cuda.is_available()
+except ImportError:
+    cuda_available = False
 
 PATH1 = '/Users/luca_pezzini/Documents/Code/cov_pic-2d/figures/'
 
 # method flags
 pic              = True     # True -> particles & fields; False -> only fields
 Picard           = True     # Picard iteration
-NK_method        = False    # Newton Krylov non linear solver
+NK_method        = False    # Jacobian-free Newton Krylov non linear solver (FFT preconditioned if metric=False)
+FFT_fields       = True     # Direct FFT solution of the field equations (only if metric=False)
+GPU              = False    # particle deposit & gather as numba.cuda kernels (if a CUDA device is found)
 
 # metric flag
 metric           = False    # True -> activate non-identity metric tensor (False = Cartesian)
@@ -76,6 +105,7 @@ B0 = 0.01                   # B field perturbation amplitude (field only)
 V0 = 1.                     # stream velocity magnitude
 alpha = 0.1                 # attenuation of VT respect V0
 pcs = 16                    # number particles per cell per species
+curl_tile = 16              # tile size of the curl kernels (~ sqrt(L1 size/72 bytes))
 
 # !be careful to modify from now on!
 
@@ -124,6 +154,10 @@ QM[npart1:npart] = QM2
 # INIT PARTICLES
 np.random.seed(1)
 
+# particle quantities packed row by row in one contiguous block (x,y,u,v,w,q)
+particles = np.zeros((6, npart), np.float64)
+x, y, u, v, w, q = particles
+
 if nppc==0:
     # only fields
     dxp = 0.
@@ -134,17 +168,14 @@ else:
 
 xp, yp = np.mgrid[dxp/2.:Lx-dxp/2.:(np.sqrt(npart1)*1j), dyp/2.:Ly-dyp/2.:(np.sqrt(npart1)*1j)]
 
-x = np.zeros(npart, np.float64)
 x[0:npart1] = xp.reshape(npart1)
 x[0:npart1] = Lx*np.random.rand(npart1)
 x[npart1:npart] = x[0:npart1]
 
-y = np.zeros(npart, np.float64)
 y[0:npart1] = yp.reshape(npart1)
 y[0:npart1] = Ly*np.random.rand(npart1)
 y[npart1:npart] = y[0:npart1]
 
-u = np.zeros(npart, np.float64)
 if harmonic:
     u[0:npart1] = VT1
     u[npart1:npart] = VT2
@@ -159,7 +190,6 @@ elif stream_inst:
     u[1:npart:2] = - u[1:npart:2] # velocity in the odd position are negative
     #np.random.shuffle(u) # to guarantee 50% of +u0 to e- and the other 50% to e+ and same fo -u0
 
-v = np.zeros(npart, np.float64)
 if stable_plasma:
     v[0:npart1] = VT1*np.random.randn(npart1)
     v[npart1:npart] = VT2*np.random.randn(npart2)
@@ -167,22 +197,20 @@ elif landau_damping:
     v[0:npart1] = V0y1+VT1*np.sin(x[0:npart1]/Lx)
     v[npart1:npart] = V0y2+VT2*np.sin(x[npart1:npart]/Lx)
 
-w = np.zeros(npart, np.float64)
 if stable_plasma: 
     w[0:npart1] = VT1*np.random.randn(npart1)
     w[npart1:npart] = VT2*np.random.randn(npart2)
 
 mod_vel = np.zeros(npart, np.float64) # module of velocity
 
-q = np.zeros(npart, np.float64)
 q[0:npart1] = np.ones(npart1)*WP1**2/(QM1*npart1/Lx/Ly) 
 q[npart1:npart] = np.ones(npart2)*WP2**2/(QM2*npart2/Lx/Ly)
 
 if relativistic:
     g = 1./np.sqrt(1.-(u**2+v**2+w**2))
-    u = u*g
-    v = v*g
-    w = w*g
+    u *= g
+    v *= g
+    w *= g
 
 # INIT LOGIC GRID
 
@@ -731,6 +759,14 @@ def diff_for_inversion(param, target):
     xi, eta = cartesian_to_general_particle(param[0], param[1])
     return (xi - target[0]) ** 2 + (eta - target[1]) ** 2
 
+def invert_point(target, init):
+    '''To find the Cartesian (x, y) of one grid point of general coordinates target
+    '''
+    # use this to set bounds on the values of x and y
+    bnds = ((None, None), (None, None))
+    res = minimize(lambda param: diff_for_inversion(param, target), init, bounds=bnds, tol=1e-16)
+    return res.x[0], res.x[1]
+
 def cart_grid_calculator(xi, eta):
     if xi.shape != eta.shape:
         raise ValueError
@@ -743,71 +779,144 @@ def cart_grid_calculator(xi, eta):
     init = np.stack((init0, init1), axis=-1)
     target = np.stack((xi, eta), axis=-1)
 
-    # use this to set bounds on the values of x and y
-    bnds = ((None, None), (None, None))
+    if joblib_available:
+        # the points are independent: one minimize per task, spread over all the cores
+        points = [(i, j) for i in range(xi.shape[0]) for j in range(xi.shape[1])]
+        sols = Parallel(n_jobs=-1)(delayed(invert_point)(target[i, j, :], init[i, j, :]) for i, j in points)
+        for (i, j), sol in zip(points, sols):
+            x[i, j], y[i, j] = sol
+        return x, y
+
     for i in range(xi.shape[0]):
         for j in range(xi.shape[1]):
-            res = minimize(lambda param: diff_for_inversion(param, target[i, j, :]), init[i, j, :], bounds=bnds, tol=1e-16)
-            x[i, j] = res.x[0]
-            y[i, j] = res.x[1]
+            x[i, j], y[i, j] = invert_point(target[i, j, :], init[i, j, :])
     return x, y
 
-def dirder(field, dertype):
-    ''' To take the directional derivative of a quantity
-    dertype defines input/output grid type and direction
-    '''
-    global nxn, nyn, nxc, nyc, dx, dy
-
-    if dertype == 'C2UD':  # centres to UD faces, y-derivative
-      derfield = np.zeros((nxc, nyn), np.float64)
-
-      derfield[0:nxc, 1:nyn-1] = (field[0:nxc, 1:nyc]-field[0:nxc, 0:nyc-1])/dy
-      derfield[0:nxc, 0] = (field[0:nxc, 0]-field[0:nxc, nyc-1])/dy
-      derfield[0:nxc, nyn-1] = derfield[0:nxc, 0]
-
-    elif dertype == 'C2LR':  # centres to LR faces, x-derivative
-      derfield = np.zeros((nxn, nyc), np.float64)
-
-      derfield[1:nxn-1, 0:nyc] = (field[1:nxc, 0:nyc]-field[0:nxc-1, 0:nyc])/dx
-      derfield[0, 0:nyc] = (field[0, 0:nyc]-field[nxc-1, 0:nyc])/dx
-      derfield[nxn-1, 0:nyc] = derfield[0, 0:nyc]
-
-    elif dertype == 'UD2N':  # UD faces to nodes, x-derivative
-      derfield = np.zeros((nxn, nyn), np.float64)
-
-      derfield[1:nxn-1, 0:nyn] = (field[1:nxc, 0:nyn]-field[0:nxc-1, 0:nyn])/dx
-      derfield[0, 0:nyn] = (field[0, 0:nyn]-field[nxc-1, 0:nyn])/dx
-      derfield[nxn-1, 0:nyn] = derfield[0, 0:nyn]
-
-    elif dertype == 'LR2N':  # LR faces to nodes, y-derivative
-      derfield = np.zeros((nxn, nyn), np.float64)
-
-      derfield[0:nxn, 1:nyn-1] = (field[0:nxn, 1:nyc]-field[0:nxn, 0:nyc-1])/dy
-      derfield[0:nxn, 0] = (field[0:nxn, 0]-field[0:nxn, nyc-1])/dy
-      derfield[0:nxn, nyn-1] = derfield[0:nxn, 0]
-
-    elif dertype == 'N2LR':  # nodes to LR faces, y-derivative
-      derfield = np.zeros((nxn, nyc), np.float64)
-
-      derfield[0:nxn, 0:nyc] = (field[0:nxn, 1:nyn]-field[0:nxn, 0:nyn-1])/dy
+# slices of the staggered stencils (x: first index, y: second index)
+sx_c_hi, sx_c_lo = slice(1, nxc), slice(0, nxc-1)   # neighbouring centres along x
+sx_n_hi, sx_n_lo = slice(1, nxn), slice(0, nxn-1)   # neighbouring nodes along x
+sx_n_in = slice(1, nxn-1)                           # inner nodes along x
+sy_c_hi, sy_c_lo = slice(1, nyc), slice(0, nyc-1)   # neighbouring centres along y
+sy_n_hi, sy_n_lo = slice(1, nyn), slice(0, nyn-1)   # neighbouring nodes along y
+sy_n_in = slice(1, nyn-1)                           # inner nodes along y
+inv_dx, inv_dy = 1./dx, 1./dy                       # the stencils multiply by the reciprocals
+wrap_x = np.arange(-1, nxc+2) % nxc                 # wrap_x[k+1] = k%nxc for k = -1..nxc+1
+wrap_y = np.arange(-1, nyc+2) % nyc                 # wrap_y[k+1] = k%nyc for k = -1..nyc+1
+
+def dirder_C2UD(field, derfield):  # centres to UD faces, y-derivative
+    derfield[:, sy_n_in] = (field[:, sy_c_hi]-field[:, sy_c_lo])*inv_dy
+    derfield[:, 0] = (field[:, 0]-field[:, nyc-1])*inv_dy
+    derfield[:, nyn-1] = derfield[:, 0]
+    return derfield
 
-    elif dertype == 'N2UD':  # nodes to UD faces, x-derivative
-      derfield = np.zeros((nxc, nyn), np.float64)
+def dirder_C2LR(field, derfield):  # centres to LR faces, x-derivative
+    derfield[sx_n_in, :] = (field[sx_c_hi, :]-field[sx_c_lo, :])*inv_dx
+    derfield[0, :] = (field[0, :]-field[nxc-1, :])*inv_dx
+    derfield[nxn-1, :] = derfield[0, :]
+    return derfield
 
-      derfield[0:nxc, 0:nyn] = (field[1:nxn, 0:nyn]-field[0:nxn-1, 0:nyn])/dx
+def dirder_UD2N(field, derfield):  # UD faces to nodes, x-derivative
+    derfield[sx_n_in, :] = (field[sx_c_hi, :]-field[sx_c_lo, :])*inv_dx
+    derfield[0, :] = (field[0, :]-field[nxc-1, :])*inv_dx
+    derfield[nxn-1, :] = derfield[0, :]
+    return derfield
 
-    elif dertype == 'LR2C':  # LR faces to centres, x-derivative
-      derfield = np.zeros((nxc, nyc), np.float64)
+def dirder_LR2N(field, derfield):  # LR faces to nodes, y-derivative
+    derfield[:, sy_n_in] = (field[:, sy_c_hi]-field[:, sy_c_lo])*inv_dy
+    derfield[:, 0] = (field[:, 0]-field[:, nyc-1])*inv_dy
+    derfield[:, nyn-1] = derfield[:, 0]
+    return derfield
 
-      derfield[0:nxc, 0:nyc] = (field[1:nxn, 0:nyc]-field[0:nxn-1, 0:nyc])/dx
+def dirder_N2LR(field, derfield):  # nodes to LR faces, y-derivative
+    np.subtract(field[:, sy_n_hi], field[:, sy_n_lo], out=derfield)
+    derfield *= inv_dy
+    return derfield
 
-    elif dertype == 'UD2C':  # UD faces to centres, y-derivative
-      derfield = np.zeros((nxc, nyc), np.float64)
+def dirder_N2UD(field, derfield):  # nodes to UD faces, x-derivative
+    np.subtract(field[sx_n_hi, :], field[sx_n_lo, :], out=derfield)
+    derfield *= inv_dx
+    return derfield
 
-      derfield[0:nxc, 0:nyc] = (field[0:nxc, 1:nyn]-field[0:nxc, 0:nyn-1])/dy
+def dirder_LR2C(field, derfield):  # LR faces to centres, x-derivative
+    np.subtract(field[sx_n_hi, :], field[sx_n_lo, :], out=derfield)
+    derfield *= inv_dx
+    return derfield
 
+def dirder_UD2C(field, derfield):  # UD faces to centres, y-derivative
+    np.subtract(field[:, sy_n_hi], field[:, sy_n_lo], out=derfield)
+    derfield *= inv_dy
     return derfield
 
+# dertype -> (stencil, output shape)
+DIRDER = {'C2UD': (dirder_C2UD, (nxc, nyn)),
+          'C2LR': (dirder_C2LR, (nxn, nyc)),
+          'UD2N': (dirder_UD2N, (nxn, nyn)),
+          'LR2N': (dirder_LR2N, (nxn, nyn)),
+          'N2LR': (dirder_N2LR, (nxn, nyc)),
+          'N2UD': (dirder_N2UD, (nxc, nyn)),
+          'LR2C': (dirder_LR2C, (nxc, nyc)),
+          'UD2C': (dirder_UD2C, (nxc, nyc))}
+
+@njit(cache=True, fastmath=True)
+def dirder_bx_nb(field, derfield, inv_d):  # C2LR, UD2N: backward x-difference, periodic first face
+    n, m = field.shape
+    for i in range(n):
+      im = i-1 if i > 0 else n-1
+      for j in range(m):
+        derfield[i,j] = (field[i,j]-field[im,j])*inv_d
+    for j in range(m):
+      derfield[n,j] = derfield[0,j]
+
+@njit(cache=True, fastmath=True)
+def dirder_by_nb(field, derfield, inv_d):  # C2UD, LR2N: backward y-difference, periodic first face
+    n, m = field.shape
+    for i in range(n):
+      derfield[i,0] = (field[i,0]-field[i,m-1])*inv_d
+      for j in range(1, m):
+        derfield[i,j] = (field[i,j]-field[i,j-1])*inv_d
+      derfield[i,m] = derfield[i,0]
+
+@njit(cache=True, fastmath=True)
+def dirder_fx_nb(field, derfield, inv_d):  # N2UD, LR2C: forward x-difference
+    n, m = derfield.shape
+    for i in range(n):
+      for j in range(m):
+        derfield[i,j] = (field[i+1,j]-field[i,j])*inv_d
+
+@njit(cache=True, fastmath=True)
+def dirder_fy_nb(field, derfield, inv_d):  # N2LR, UD2C: forward y-difference
+    n, m = derfield.shape
+    for i in range(n):
+      for j in range(m):
+        derfield[i,j] = (field[i,j+1]-field[i,j])*inv_d
+
+# dertype -> (jitted stencil, output shape, 1/spacing)
+DIRDER_NB = {'C2UD': (dirder_by_nb, (nxc, nyn), inv_dy),
+             'C2LR': (dirder_bx_nb, (nxn, nyc), inv_dx),
+             'UD2N': (dirder_bx_nb, (nxn, nyn), inv_dx),
+             'LR2N': (dirder_by_nb, (nxn, nyn), inv_dy),
+             'N2LR': (dirder_fy_nb, (nxn, nyc), inv_dy),
+             'N2UD': (dirder_fx_nb, (nxc, nyn), inv_dx),
+             'LR2C': (dirder_fx_nb, (nxc, nyc), inv_dx),
+             'UD2C': (dirder_fy_nb, (nxc, nyc), inv_dy)}
+
+def dirder(field, dertype, out=None):
+    ''' To take the directional derivative of a quantity
+    dertype defines input/output grid type and direction
+    out (optional) is a preallocated array of the output grid to be overwritten
+    '''
+    if numba_available:
+        stencil, shape, inv_d = DIRDER_NB[dertype]
+        if out is None:
+            out = np.empty(shape, np.float64)
+        stencil(field, out, inv_d)
+        return out
+
+    stencil, shape = DIRDER[dertype]
+    if out is None:
+        out = np.empty(shape, np.float64)
+    return stencil(field, out)
+
 def avgC2N(fieldC):
     ''' To average a 2D field defined on centres to the nodes
     '''
@@ -826,62 +935,70 @@ def avgC2N(fieldC):
     fieldN[nx-1,ny-1] = fieldN[0,0]
     return fieldN
 
-def avg(field, avgtype):
-    ''' To take the average of a quantity with mine method
-    avgtype defines input/output grid type and direction
-    '''
-    global nxn, nyn, nxc, nyc, dx, dy
-
-    if avgtype == 'C2UD':  # centres to UD faces, y-average
-      avgfield = np.zeros((nxc, nyn), np.float64)
-
-      avgfield[0:nxc, 1:nyn-1] = (field[0:nxc, 1:nyc]+field[0:nxc, 0:nyc-1])/2.
-      avgfield[0:nxc, 0] = (field[0:nxc, 0]+field[0:nxc, nyc-1])/2.
-      avgfield[0:nxc, nyn-1] = avgfield[0:nxc, 0]
-
-    elif avgtype == 'C2LR':  # centres to LR faces, x-average
-      avgfield = np.zeros((nxn, nyc), np.float64)
-
-      avgfield[1:nxn-1, 0:nyc] = (field[1:nxc, 0:nyc]+field[0:nxc-1, 0:nyc])/2.
-      avgfield[0, 0:nyc] = (field[0, 0:nyc]+field[nxc-1, 0:nyc])/2.
-      avgfield[nxn-1, 0:nyc] = avgfield[0, 0:nyc]
-
-    elif avgtype == 'UD2N':  # UD faces to nodes, x-average
-      avgfield = np.zeros((nxn, nyn), np.float64)
-
-      avgfield[1:nxn-1, 0:nyn] = (field[1:nxc, 0:nyn]+field[0:nxc-1, 0:nyn])/2.
-      avgfield[0, 0:nyn] = (field[0, 0:nyn]+field[nxc-1, 0:nyn])/2.
-      avgfield[nxn-1, 0:nyn] = avgfield[0, 0:nyn]
-
-    elif avgtype == 'LR2N':  # LR faces to nodes, y-average
-      avgfield = np.zeros((nxn, nyn), np.float64)
-
-      avgfield[0:nxn, 1:nyn-1] = (field[0:nxn, 1:nyc]+field[0:nxn, 0:nyc-1])/2.
-      avgfield[0:nxn, 0] = (field[0:nxn, 0]+field[0:nxn, nyc-1])/2.
-      avgfield[0:nxn, nyn-1] = avgfield[0:nxn, 0]
-
-    elif avgtype == 'N2LR':  # nodes to LR faces, y-average
-      avgfield = np.zeros((nxn, nyc), np.float64)
-
-      avgfield[0:nxn, 0:nyc] = (field[0:nxn, 1:nyn]+field[0:nxn, 0:nyn-1])/2.
+def avg_C2UD(field, avgfield):  # centres to UD faces, y-average
+    avgfield[:, sy_n_in] = (field[:, sy_c_hi]+field[:, sy_c_lo])/2.
+    avgfield[:, 0] = (field[:, 0]+field[:, nyc-1])/2.
+    avgfield[:, nyn-1] = avgfield[:, 0]
+    return avgfield
 
-    elif avgtype == 'N2UD':  # nodes to UD faces, x-average
-      avgfield = np.zeros((nxc, nyn), np.float64)
+def avg_C2LR(field, avgfield):  # centres to LR faces, x-average
+    avgfield[sx_n_in, :] = (field[sx_c_hi, :]+field[sx_c_lo, :])/2.
+    avgfield[0, :] = (field[0, :]+field[nxc-1, :])/2.
+    avgfield[nxn-1, :] = avgfield[0, :]
+    return avgfield
 
-      avgfield[0:nxc, 0:nyn] = (field[1:nxn, 0:nyn]+field[0:nxn-1, 0:nyn])/2.
+def avg_UD2N(field, avgfield):  # UD faces to nodes, x-average
+    avgfield[sx_n_in, :] = (field[sx_c_hi, :]+field[sx_c_lo, :])/2.
+    avgfield[0, :] = (field[0, :]+field[nxc-1, :])/2.
+    avgfield[nxn-1, :] = avgfield[0, :]
+    return avgfield
 
-    elif avgtype == 'LR2C':  # LR faces to centres, x-average
-      avgfield = np.zeros((nxc, nyc), np.float64)
+def avg_LR2N(field, avgfield):  # LR faces to nodes, y-average
+    avgfield[:, sy_n_in] = (field[:, sy_c_hi]+field[:, sy_c_lo])/2.
+    avgfield[:, 0] = (field[:, 0]+field[:, nyc-1])/2.
+    avgfield[:, nyn-1] = avgfield[:, 0]
+    return avgfield
 
-      avgfield[0:nxc, 0:nyc] = (field[1:nxn, 0:nyc]+field[0:nxn-1, 0:nyc])/2.
+def avg_N2LR(field, avgfield):  # nodes to LR faces, y-average
+    np.add(field[:, sy_n_hi], field[:, sy_n_lo], out=avgfield)
+    avgfield /= 2.
+    return avgfield
 
-    elif avgtype == 'UD2C':  # UD faces to centres, y-average
-      avgfield = np.zeros((nxc, nyc), np.float64)
+def avg_N2UD(field, avgfield):  # nodes to UD faces, x-average
+    np.add(field[sx_n_hi, :], field[sx_n_lo, :], out=avgfield)
+    avgfield /= 2.
+    return avgfield
 
-      avgfield[0:nxc, 0:nyc] = (field[0:nxc, 1:nyn]+field[0:nxc, 0:nyn-1])/2.
+def avg_LR2C(field, avgfield):  # LR faces to centres, x-average
+    np.add(field[sx_n_hi, :], field[sx_n_lo, :], out=avgfield)
+    avgfield /= 2.
+    return avgfield
 
+def avg_UD2C(field, avgfield):  # UD faces to centres, y-average
+    np.add(field[:, sy_n_hi], field[:, sy_n_lo], out=avgfield)
+    avgfield /= 2.
     return avgfield
 
+# avgtype -> (stencil, output shape)
+AVG = {'C2UD': (avg_C2UD, (nxc, nyn)),
+       'C2LR': (avg_C2LR, (nxn, nyc)),
+       'UD2N': (avg_UD2N, (nxn, nyn)),
+       'LR2N': (avg_LR2N, (nxn, nyn)),
+       'N2LR': (avg_N2LR, (nxn, nyc)),
+       'N2UD': (avg_N2UD, (nxc, nyn)),
+       'LR2C': (avg_LR2C, (nxc, nyc)),
+       'UD2C': (avg_UD2C, (nxc, nyc))}
+
+def avg(field, avgtype, out=None):
+    ''' To take the average of a quantity with mine method
+    avgtype defines input/output grid type and direction
+    out (optional) is a preallocated array of the output grid to be overwritten
+    '''
+    stencil, shape = AVG[avgtype]
+    if out is None:
+        out = np.empty(shape, np.float64)
+    return stencil(field, out)
+
 def shift(mat, x, y):
     '''To shift the matrix in xy-position with periodic boundary conditions
     '''
@@ -963,12 +1080,124 @@ def avg_joost(field, type):
         avgfield[-1, :] = avgfield[0, :]
     return avgfield
 
-def curl(fieldx, fieldy, fieldz, fieldtype):
+@njit(cache=True, fastmath=True)
+def curl_E_nb(fx, fy, fz, g11_LR, g12_LR, g13_LR, g21_UD, g22_UD, g23_UD, g31_C, g32_C, g33_C,\
+              inv_dx, inv_dy, nxc, nyc, curl_x, curl_y, curl_z, ts=16):
+    ''' Numba version of curl(E) without the 1/J factor (applied by curl() if metric): the 
+    averages, the metric contraction and the derivative are evaluated in one pass for each output cell
+    the grid is swept in ts x ts tiles, all the components are computed on each tile
+    input -> LR,UD,c, output -> UD,LR,n
+    '''
+    nxn, nyn = nxc+1, nyc+1
+
+    def A(i, j):   # g_3q·E^q on the centres
+        return g31_C[i,j] * (fx[i+1,j]+fx[i,j])/2. + g32_C[i,j] * (fy[i,j+1]+fy[i,j])/2. + g33_C[i,j] * fz[i,j]
+
+    def EyC(i, j):
+        return (fy[i,j+1]+fy[i,j])/2.
+
+    def P(i, j):   # g_2q·E^q on the UD faces
+        jj = j if j < nyc else 0
+        fx_UD = ((fx[i+1,jj]+fx[i,jj])/2. + (fx[i+1,(jj-1)%nyc]+fx[i,(jj-1)%nyc])/2.)/2.
+        fz_UD = (fz[i,jj]+fz[i,(jj-1)%nyc])/2.
+        return g21_UD[i,j] * fx_UD + g22_UD[i,j] * fy[i,j] + g23_UD[i,j] * fz_UD
+
+    def Q(i, j):   # g_1q·E^q on the LR faces
+        ii = i if i < nxc else 0
+        fy_LR = (EyC(ii,j) + EyC((ii-1)%nxc,j))/2.
+        fz_LR = (fz[ii,j]+fz[(ii-1)%nxc,j])/2.
+        return g11_LR[i,j] * fx[i,j] + g12_LR[i,j] * fy_LR + g13_LR[i,j] * fz_LR
+
+    for it in range(0, nxn, ts):
+      for jt in range(0, nyn, ts):
+        for i in range(it, min(it+ts, nxn)):
+          ii = i if i < nxc else 0
+          for j in range(jt, min(jt+ts, nyn)):
+            jj = j if j < nyc else 0
+            if i < nxc:
+              curl_x[i,j] = (A(i,jj)-A(i,(jj-1)%nyc))*inv_dy
+            if j < nyc:
+              curl_y[i,j] = - (A(ii,j)-A((ii-1)%nxc,j))*inv_dx
+            curl_z[i,j] = (P(ii,j)-P((ii-1)%nxc,j))*inv_dx - (Q(i,jj)-Q(i,(jj-1)%nyc))*inv_dy
+
+@njit(cache=True, fastmath=True)
+def curl_B_nb(fx, fy, fz, g11_UD, g12_UD, g13_UD, g21_LR, g22_LR, g23_LR, g31_N, g32_N, g33_N,\
+              inv_dx, inv_dy, nxc, nyc, curl_x, curl_y, curl_z, ts=16):
+    ''' Numba version of curl(B) without the 1/J factor (applied by curl() if metric): the 
+    averages, the metric contraction and the derivative are evaluated in one pass for each output cell
+    the grid is swept in ts x ts tiles, all the components are computed on each tile
+    input -> UD,LR,n, output -> LR,UD,c
+    '''
+    nxn, nyn = nxc+1, nyc+1
+
+    def BxN(i, j):
+        ii = i if i < nxc else 0
+        return (fx[ii,j]+fx[(ii-1)%nxc,j])/2.
+
+    def ByN(i, j):
+        jj = j if j < nyc else 0
+        return (fy[i,jj]+fy[i,(jj-1)%nyc])/2.
+
+    def A(i, j):   # g_3q·B^q on the nodes
+        return g31_N[i,j] * BxN(i,j) + g32_N[i,j] * ByN(i,j) + g33_N[i,j] * fz[i,j]
+
+    def Q(i, j):   # g_2q·B^q on the LR faces
+        fx_LR = (BxN(i,j+1)+BxN(i,j))/2.
+        fz_LR = (fz[i,j+1]+fz[i,j])/2.
+        return g21_LR[i,j] * fx_LR + g22_LR[i,j] * fy[i,j] + g23_LR[i,j] * fz_LR
+
+    def P(i, j):   # g_1q·B^q on the UD faces
+        fy_UD = (ByN(i+1,j)+ByN(i,j))/2.
+        fz_UD = (fz[i+1,j]+fz[i,j])/2.
+        return g11_UD[i,j] * fx[i,j] + g12_UD[i,j] * fy_UD + g13_UD[i,j] * fz_UD
+
+    for it in range(0, nxn, ts):
+      for jt in range(0, nyn, ts):
+        for i in range(it, min(it+ts, nxn)):
+          for j in range(jt, min(jt+ts, nyn)):
+            if j < nyc:
+              curl_x[i,j] = (A(i,j+1)-A(i,j))*inv_dy
+            if i < nxc:
+              curl_y[i,j] = - (A(i+1,j)-A(i,j))*inv_dx
+            if i < nxc and j < nyc:
+              curl_z[i,j] = (Q(i+1,j)-Q(i,j))*inv_dx - (P(i,j+1)-P(i,j))*inv_dy
+
+def scale_curl(curl_x, curl_y, curl_z, fieldtype):
+    ''' 1/J factor of the curl, multiplied in place (J = 1 without metric: not called)
+    '''
+    if fieldtype == 'E':
+        curl_x *= inv_J_UD
+        curl_y *= inv_J_LR
+        curl_z *= inv_J_N
+    elif fieldtype == 'B':
+        curl_x *= inv_J_LR
+        curl_y *= inv_J_UD
+        curl_z *= inv_J_C
+
+def curl(fieldx, fieldy, fieldz, fieldtype, out=None):
     ''' To take the curl of either E or B in General coord.
     curl^i = 1/J·(d_j·g_kq·A^q - d_k·g_jq·A^q)
     fieltype=='E': input -> LR,UD,c, output -> UD,LR,n
     fieltype=='B': input -> UD,LR,n, output -> LR,UD,c
+    out: optional tuple of the 3 output arrays
     '''
+    if numba_available:
+        if out is not None:
+            curl_x, curl_y, curl_z = out
+        elif fieldtype == 'E':
+            curl_x, curl_y, curl_z = np.empty((nxc, nyn)), np.empty((nxn, nyc)), np.empty((nxn, nyn))
+        else:
+            curl_x, curl_y, curl_z = np.empty((nxn, nyc)), np.empty((nxc, nyn)), np.empty((nxc, nyc))
+        if fieldtype == 'E':
+            curl_E_nb(fieldx, fieldy, fieldz, g11_LR, g12_LR, g13_LR, g21_UD, g22_UD, g23_UD, g31_C, g32_C, g33_C,\
+                      inv_dx, inv_dy, nxc, nyc, curl_x, curl_y, curl_z, curl_tile)
+        elif fieldtype == 'B':
+            curl_B_nb(fieldx, fieldy, fieldz, g11_UD, g12_UD, g13_UD, g21_LR, g22_LR, g23_LR, g31_N, g32_N, g33_N,\
+                      inv_dx, inv_dy, nxc, nyc, curl_x, curl_y, curl_z, curl_tile)
+        if metric:
+            scale_curl(curl_x, curl_y, curl_z, fieldtype)
+        return curl_x, curl_y, curl_z
+
     if fieldtype == 'E':
         fieldx_C = avg(fieldx, 'LR2C')
         fieldy_C = avg(fieldy, 'UD2C')
@@ -977,10 +1206,10 @@ def curl(fieldx, fieldy, fieldz, fieldtype):
         fieldy_LR = avg(avg(fieldy, 'UD2C'), 'C2LR')
         fieldz_LR = avg(fieldz, 'C2LR')
 
-        curl_x =   dirder(g31_C * fieldx_C + g32_C * fieldy_C + g33_C * fieldz, 'C2UD')/J_UD
-        curl_y = - dirder(g31_C * fieldx_C + g32_C * fieldy_C + g33_C * fieldz, 'C2LR')/J_LR
-        curl_z =   dirder(g21_UD * fieldx_UD + g22_UD * fieldy + g23_UD * fieldz_UD, 'UD2N')/J_N\
-                 - dirder(g11_LR * fieldx + g12_LR * fieldy_LR + g13_LR * fieldz_LR, 'LR2N')/J_N
+        curl_x =   dirder(g31_C * fieldx_C + g32_C * fieldy_C + g33_C * fieldz, 'C2UD')
+        curl_y = - dirder(g31_C * fieldx_C + g32_C * fieldy_C + g33_C * fieldz, 'C2LR')
+        curl_z =   dirder(g21_UD * fieldx_UD + g22_UD * fieldy + g23_UD * fieldz_UD, 'UD2N')\
+                 - dirder(g11_LR * fieldx + g12_LR * fieldy_LR + g13_LR * fieldz_LR, 'LR2N')
     elif fieldtype == 'B':
         fieldx_N = avg(fieldx, 'UD2N')
         fieldy_N = avg(fieldy, 'LR2N')
@@ -989,11 +1218,17 @@ def curl(fieldx, fieldy, fieldz, fieldtype):
         fieldy_UD = avg(avg(fieldy, 'LR2N'), 'N2UD')
         fieldz_UD = avg(fieldz, 'N2UD')
         
-        curl_x =   dirder(g31_N * fieldx_N + g32_N * fieldy_N + g33_N * fieldz, 'N2LR')/J_LR
-        curl_y = - dirder(g31_N * fieldx_N + g32_N * fieldy_N + g33_N * fieldz, 'N2UD')/J_UD
-        curl_z =   dirder(g21_LR * fieldx_LR + g22_LR * fieldy + g23_LR * fieldz_LR, 'LR2C')/J_C\
-                 - dirder(g11_UD * fieldx + g12_UD * fieldy_UD + g13_UD * fieldz_UD, 'UD2C')/J_C
+        curl_x =   dirder(g31_N * fieldx_N + g32_N * fieldy_N + g33_N * fieldz, 'N2LR')
+        curl_y = - dirder(g31_N * fieldx_N + g32_N * fieldy_N + g33_N * fieldz, 'N2UD')
+        curl_z =   dirder(g21_LR * fieldx_LR + g22_LR * fieldy + g23_LR * fieldz_LR, 'LR2C')\
+                 - dirder(g11_UD * fieldx + g12_UD * fieldy_UD + g13_UD * fieldz_UD, 'UD2C')
     
+    if metric:
+        scale_curl(curl_x, curl_y, curl_z, fieldtype)
+    if out is not None:
+        for res, comp in zip(out, (curl_x, curl_y, curl_z)):
+            res[...] = comp
+        return out
     return curl_x, curl_y, curl_z
 
 def curl_normalised(fieldx, fieldy, fieldz, fieldtype):
@@ -1099,47 +1334,181 @@ def div(fieldx, fieldy, fieldz, fieldtype):
     fieltype=='B': input -> UD,LR,n, output -> n,n,n
     '''
     if fieldtype == 'E':
-        div = (dirder(J_LR * fieldx, 'LR2C') + dirder(J_UD * fieldy, 'UD2C'))/J_C
+        div = (dirder(J_LR * fieldx, 'LR2C') + dirder(J_UD * fieldy, 'UD2C'))*inv_J_C
 
     elif fieldtype == 'B':
-        div = (dirder(J_UD * fieldx, 'UD2N') + dirder(J_LR * fieldy, 'LR2N'))/J_N
+        div = (dirder(J_UD * fieldx, 'UD2N') + dirder(J_LR * fieldy, 'LR2N'))*inv_J_N
 
     return div
 
-def phys_to_krylov(E1k, E2k, E3k, uk, vk, wk):
+def sum_squares(field):
+    ''' Sum of the squares of a 2D field (no squared temporary, works on slices)
+    '''
+    return np.einsum('ij,ij->', field, field)
+
+def phys_to_krylov(E1k, E2k, E3k, uk, vk, wk, out=None):
     ''' To populate the Krylov vector using physiscs vectors
     E1,E2,E3 are 2D arrays
     u,v,w of dimensions npart
     '''
     global nxc,nyc,nxn,nyn,npart
 
-    ykrylov = np.zeros(nxn*nyc+nxc*nyn+nxc*nyc+3*npart,np.float64)
-    ykrylov[0:nxn*nyc] = E1k.reshape(nxn*nyc)
-    ykrylov[nxn*nyc:nxn*nyc+nxc*nyn] = E2k.reshape(nxc*nyn)
-    ykrylov[nxn*nyc+nxc*nyn:nxn*nyc+nxc*nyn+nxc*nyc] = E3k.reshape(nxc*nyc)
-    ykrylov[nxn*nyc+nxc*nyn+nxc*nyc:nxn*nyc+nxc*nyn+nxc*nyc+npart] = uk
-    ykrylov[nxn*nyc+nxc*nyn+nxc*nyc+npart:nxn*nyc+nxc*nyn+nxc*nyc+2*npart] = vk
-    ykrylov[nxn*nyc+nxc*nyn+nxc*nyc+2*npart:nxn*nyc+nxc*nyn+nxc*nyc+3*npart] = wk
+    if out is None:
+        ykrylov = np.empty(nxn*nyc+nxc*nyn+nxc*nyc+3*npart,np.float64)
+    else:
+        ykrylov = out
+    # copy through the views of krylov_to_phys: no reshaped temporaries
+    for view, comp in zip(krylov_to_phys(ykrylov), (E1k, E2k, E3k, uk, vk, wk)):
+        view[...] = comp
     return ykrylov
 
 def krylov_to_phys(xkrylov):
     ''' To populate the physiscs vectors using the Krylov space vector
     E1,E2,E3 are 2D arrays of dimension (nx,ny)
     unew,vnew,wnew of dimensions npart1+npart2
+    the returned arrays are views of xkrylov (no copy)
     '''
     global nx,ny,npart
 
-    E1k = np.reshape(xkrylov[0:nxn*nyc],(nxn,nyc))
-    E2k = np.reshape(xkrylov[nxn*nyc:nxn*nyc+nxc*nyn],(nxc,nyn))
-    E3k = np.reshape(xkrylov[nxn*nyc+nxc*nyn:nxn*nyc+nxc*nyn+nxc*nyc],(nxc,nyc))
-    uk = xkrylov[nxn*nyc+nxc*nyn+nxc*nyc:nxn*nyc+nxc*nyn+nxc*nyc+npart]
-    vk = xkrylov[nxn*nyc+nxc*nyn+nxc*nyc+npart:nxn*nyc+nxc*nyn+nxc*nyc+2*npart]
-    wk = xkrylov[nxn*nyc+nxc*nyn+nxc*nyc+2*npart:nxn*nyc+nxc*nyn+nxc*nyc+3*npart]
+    nE1, nE2, nE3 = nxn*nyc, nxc*nyn, nxc*nyc
+    E1k = xkrylov[0:nE1].reshape(nxn, nyc)
+    E2k = xkrylov[nE1:nE1+nE2].reshape(nxc, nyn)
+    E3k = xkrylov[nE1+nE2:nE1+nE2+nE3].reshape(nxc, nyc)
+    uk, vk, wk = xkrylov[nE1+nE2+nE3:nE1+nE2+nE3+3*npart].reshape(3, npart)
     return E1k, E2k, E3k, uk, vk, wk
 
-def residual(xkrylov):
+def maxwell_preconditioner():
+    ''' Preconditioner of the Newton Krylov solver on the uniform grid (metric=False):
+    approximate inverse of the field block of the Jacobian, (I + dt^2/4 curl curl)^-1, 
+    where curl curl is replaced by -Laplacian on each component and inverted with FFTs
+    (the particle block and the periodic copies of the last faces are left unchanged)
+    '''
+    kx = 2./dx*np.sin(np.pi*np.arange(nxc)/nxc)
+    ky = 2./dy*np.sin(np.pi*np.arange(nyc//2+1)/nyc)
+    symbol = 1./(1. + dt**2/4.*(kx[:, None]**2 + ky[None, :]**2))
+
+    def smooth(field):
+        field[...] = np.fft.irfft2(np.fft.rfft2(field)*symbol, s=(nxc, nyc))
+
+    def apply(r):
+        z = np.array(r, np.float64).reshape(-1)
+        E1k, E2k, E3k, uk, vk, wk = krylov_to_phys(z)
+        smooth(E1k[0:nxc, :])
+        smooth(E2k[:, 0:nyc])
+        smooth(E3k)
+        return z
+
+    size = nxn*nyc + nxc*nyn + nxc*nyc + 3*npart
+    return LinearOperator((size, size), matvec=apply)
+
+def newton_gmres(func, x0, f_tol=1e-10, maxiter=50, inner_maxiter=20, M=None, eta_max=0.5):
+    ''' Jacobian-free Newton Krylov solver of func(x) = 0:
+    J·dx = -F is solved with GMRES, Jacobian-vector products by finite differences,
+    inner tolerance from the Eisenstat-Walker forcing eta_k = min(eta_max, |F_k|/|F_k-1|)
+    raises NoConvergence (as scipy's newton_krylov) if max|F| >= f_tol after maxiter steps
+    '''
+    xk = np.array(x0, np.float64)
+    Fk = func(xk)
+    normF = np.linalg.norm(Fk)
+    eta = eta_max
+    size = xk.size
+    for it in range(maxiter):
+        if np.abs(Fk).max() < f_tol:
+            break
+
+        def jac_vec(vec):
+            normv = np.linalg.norm(vec)
+            if normv == 0.:
+                return np.zeros(size, np.float64)
+            eps = np.sqrt(np.finfo(np.float64).eps)*(1. + np.linalg.norm(xk))/normv
+            return (func(xk + eps*vec, res_w) - Fk)/eps
+
+        jac = LinearOperator((size, size), matvec=jac_vec)
+        dxk, info = gmres(jac, -Fk, rtol=eta, atol=0., restart=inner_maxiter, maxiter=1, M=M)
+        if info < 0:
+            raise ValueError('GMRES breakdown at Newton iteration %d (info = %d)' % (it+1, info))
+        if info > 0:
+            # inexact Newton: the partial GMRES step is still a descent step, it is applied
+            warnings.warn('GMRES did not reach eta = %g at Newton iteration %d' % (eta, it+1))
+        xk += dxk
+        Fk = func(xk)
+        normF_old, normF = normF, np.linalg.norm(Fk)
+        eta = min(eta_max, normF/normF_old)
+        print('Newton iteration %d: max|F| = %g, eta = %g' % (it+1, np.abs(Fk).max(), eta))
+
+    if np.abs(Fk).max() >= f_tol:
+        raise NoConvergence('Newton-GMRES: max|F| = %g >= f_tol = %g after %d iterations'
+                            % (np.abs(Fk).max(), f_tol, maxiter))
+    return xk
+
+def periodic_E(E1u, E2u, E3u):
+    ''' To rebuild the E field on its Yee grids from the values on the nxc x nyc
+    independent points (the last face is the periodic copy of the first one)
+    '''
+    E1p = np.concatenate((E1u, E1u[0:1, :]), axis=0)
+    E2p = np.concatenate((E2u, E2u[:, 0:1]), axis=1)
+    return E1p, E2p, np.array(E3u)
+
+def curl_curl(E1k, E2k, E3k):
+    ''' To compute curl(curl(E)) on the independent points of the E grids
+    '''
+    cE1, cE2, cE3 = curl(E1k, E2k, E3k, 'E')
+    ccE1, ccE2, ccE3 = curl(cE1, cE2, cE3, 'B')
+    return ccE1[0:nxc, :], ccE2[:, 0:nyc], ccE3
+
+def maxwell_fft_operator():
+    ''' To invert, on the uniform grid (metric=False), the field operator of the 
+    implicit scheme I + dt^2/4 curl curl mode by mode in Fourier space.
+    The 3x3 symbol of each mode is measured applying the Yee stencils to a unit
+    impulse in each component, so the solution is exact for the discrete scheme
+    '''
+    symbol = np.zeros((nxc, nyc//2+1, 3, 3), np.complex128)
+    for b in range(3):
+        impulse = [np.zeros((nxc, nyc), np.float64) for comp in range(3)]
+        impulse[b][0, 0] = 1.
+        ccE = curl_curl(*periodic_E(*impulse))
+        for a in range(3):
+            symbol[:, :, a, b] = np.fft.rfft2(ccE[a])
+    return np.linalg.inv(np.eye(3) + dt**2/4.*symbol)
+
+def maxwell_fft_rhs(E1k, E2k, E3k, B1k, B2k, B3k):
+    ''' Part of the right hand side of the field equations known at the start of 
+    the time step: E - dt^2/4 curl curl(E) + dt curl(B)
+    '''
+    ccE1, ccE2, ccE3 = curl_curl(E1k, E2k, E3k)
+    cB1, cB2, cB3 = curl(B1k, B2k, B3k, 'B')
+    return (E1k[0:nxc, :] - dt**2/4.*ccE1 + dt*cB1[0:nxc, :],
+            E2k[:, 0:nyc] - dt**2/4.*ccE2 + dt*cB2[:, 0:nyc],
+            E3k - dt**2/4.*ccE3 + dt*cB3)
+
+def maxwell_fft_solve(J1k, J2k, J3k):
+    ''' New E field for the current J: solves (I + dt^2/4 curl curl) Enew = rhs - dt J
+    '''
+    rhs = (fft_rhs[0] - dt*J1k[0:nxc, :],
+           fft_rhs[1] - dt*J2k[:, 0:nyc],
+           fft_rhs[2] - dt*J3k)
+    rhsk = np.stack([np.fft.rfft2(comp) for comp in rhs], axis=-1)
+    Ek = np.einsum('xyab,xyb->xya', fft_inv, rhsk)
+    return periodic_E(*(np.fft.irfft2(Ek[:, :, a], s=(nxc, nyc)) for a in range(3)))
+
+def lorentz_residual(unew, uold, Ep, va, Ba, vb, Bb, res):
+    ''' Residual of one velocity component, written in res:
+    res = unew - uold - QM*(Ep + va*Ba - vb*Bb)*dt
+    '''
+    np.multiply(va, Ba, out=res)
+    np.add(Ep, res, out=res)
+    np.multiply(vb, Bb, out=tmp_w)
+    res -= tmp_w
+    res *= QM
+    res *= dt
+    np.subtract(unew, uold, out=tmp_w)
+    np.subtract(tmp_w, res, out=res)
+
+def residual(xkrylov, out=None):
     ''' Calculation of the residual of the equations
     This is the most important part: the definition of the problem
+    The intermediate arrays are the preallocated *_w buffers, the residual is 
+    written in out if given (otherwise in a new array)
     '''
     global E1, E2, E3, B1, B2, B3, u, v, w, QM, q, npart, dt
 
@@ -1148,61 +1517,84 @@ def residual(xkrylov):
     # u:            t = n+1/2 -> t = n 
     # unew:         t = n+3/2 -> t = n+1
     # ubar:         t = n+1   -> t = n+1/2    (=J1)
-    ubar = (unew + u)/2.
-    vbar = (vnew + v)/2.
-    wbar = (wnew + w)/2.
+    ubar, vbar, wbar = ubar_w, vbar_w, wbar_w
+    for new, old, bar in zip((unew, vnew, wnew), (u, v, w), (ubar, vbar, wbar)):
+        np.add(new, old, out=bar)
+        bar /= 2.
 
+    # velocities ubar/gbar computed once and shared by push, deposit and residual
     if relativistic:
         gold = np.sqrt(1.+u**2+v**2+w**2)
         gnew = np.sqrt(1.+unew**2+vnew**2+wnew**2)
         gbar = (gold+gnew)/2.
-    else:
-        gbar = np.ones(npart)
+        ubar /= gbar
+        vbar /= gbar
+        wbar /= gbar
+    upbar, vpbar, wpbar = ubar, vbar, wbar
     
     # x:            t = n     -> t = n
     # xnew:         t = n+1   -> t = n+1
     # xbar :        t = n+1/2 -> t = n+1/2
-    xbar = x + ubar/gbar*dt/2.
-    ybar = y + vbar/gbar*dt/2.
-
-    # periodic BC: modulo operator "%" which finds the reminder (ex. 10.1%10=0.1)
-    xbar = xbar%Lx
-    ybar = ybar%Ly
+    xbar, ybar = xbar_w, ybar_w
+    for pos, vel, bar, L in zip((x, y), (upbar, vpbar), (xbar, ybar), (Lx, Ly)):
+        np.multiply(vel, dt, out=bar)
+        bar /= 2.
+        np.add(pos, bar, out=bar)
+        # periodic BC: modulo operator "%" which finds the reminder (ex. 10.1%10=0.1)
+        bar %= L
     # conversion to general geom.
     if metric:
         xgenbar, ygenbar = cartesian_to_general_particle(xbar, ybar)
     else:
         xgenbar, ygenbar = xbar, ybar
     
-    Jx, Jy, Jz = particle_to_grid_J(xgenbar,ygenbar,ubar/gbar,vbar/gbar,wbar/gbar,q)
+    # indexes and weights shared by deposit and gather (only needed without numba)
+    plan = None if numba_available else compute_interp_plan(xgenbar, ygenbar)
+
+    Jx, Jy, Jz = particle_to_grid_J(xgenbar,ygenbar,upbar,vpbar,wpbar,q,plan,J_w)
     # J1:           t = n+1/2 -> t = n+1/2  (=curlB1)
     J1, J2, J3 = cartesian_to_general(Jx, Jy, Jz, 'J')
 
     # E1:           t = n+1/2 -> t = n
     # E1new:        t = n+3/2 -> t = n+1
     # E1bar:        t = n+1   -> t = n+1/2
-    E1bar = (E1new + E1)/2. 
-    E2bar = (E2new + E2)/2.
-    E3bar = (E3new + E3)/2.
+    E1bar, E2bar, E3bar = Ebar_w
+    for new, old, bar in zip((E1new, E2new, E3new), (E1, E2, E3), Ebar_w):
+        np.add(new, old, out=bar)
+        bar /= 2.
     
     # curlE1:       t = n -> t = n+1/2  (=E1bar)
     #E1bar1, E2bar1, E3bar1 = cartesian_to_general(E1bar, E2bar, E3bar, 'E')
     #curlE1, curlE2, curlE3 = curl(E1bar1, E2bar1, E3bar1, 'E')
-    curlE1, curlE2, curlE3 = curl(E1bar,E2bar,E3bar,'E')
+    curlE1, curlE2, curlE3 = curl(E1bar,E2bar,E3bar,'E',curlE_w)
 
     # B1:           t = -1/2 -> t = n
     # B1bar:        t =  1/2 -> t = n+1/2
-    B1bar = B1 - dt/2.*curlE1
-    B2bar = B2 - dt/2.*curlE2
-    B3bar = B3 - dt/2.*curlE3
+    B1bar, B2bar, B3bar = Bbar_w
+    for old, cE, bar in zip((B1, B2, B3), curlE_w, Bbar_w):
+        np.multiply(cE, dt/2., out=bar)
+        np.subtract(old, bar, out=bar)
     
-    #curlB1:        t = n+1/2 -> t = n+1/2  (=B1bar)
-    curlB1, curlB2, curlB3 = curl(B1bar,B2bar,B3bar,'B')
+    ykrylov = np.empty(np.shape(xkrylov), np.float64) if out is None else out
+    resE1, resE2, resE3, resu, resv, resw = krylov_to_phys(ykrylov)
+
+    if fft_fields:
+        # fields solved exactly for the current J: the iteration is on the particles only
+        E1s, E2s, E3s = maxwell_fft_solve(J1, J2, J3)
+        np.subtract(E1new, E1s, out=resE1)
+        np.subtract(E2new, E2s, out=resE2)
+        np.subtract(E3new, E3s, out=resE3)
+    else:
+        #curlB1:        t = n+1/2 -> t = n+1/2  (=B1bar)
+        curlB1, curlB2, curlB3 = curl(B1bar,B2bar,B3bar,'B',curlB_w)
 
-    #res:           t = n+1/2 -> t = n+1/2  (=curlB1,J1)
-    resE1 = E1new - E1 - dt*curlB1 + dt*J1
-    resE2 = E2new - E2 - dt*curlB2 + dt*J2
-    resE3 = E3new - E3 - dt*curlB3 + dt*J3
+        #res:           t = n+1/2 -> t = n+1/2  (=curlB1,J1)
+        for res, new, old, cB, Jk in zip((resE1, resE2, resE3), (E1new, E2new, E3new), (E1, E2, E3), curlB_w, (J1, J2, J3)):
+            np.subtract(new, old, out=res)
+            cB *= dt
+            res -= cB
+            Jk *= dt
+            res += Jk
 
     # Ex:           t = n -> t = n+1/2  (=E1bar)
     Ex, Ey, Ez = general_to_cartesian(E1bar, E2bar, E3bar, 'E')
@@ -1210,62 +1602,131 @@ def residual(xkrylov):
     Bx, By, Bz = general_to_cartesian(B1bar, B2bar, B3bar, 'B')
     
     # Exp           t = n -> t = n+1/2  (=E1bar)
-    Exp = grid_to_particle(xgenbar,ygenbar,Ex,'LR')
-    Eyp = grid_to_particle(xgenbar,ygenbar,Ey,'UD')
-    Ezp = grid_to_particle(xgenbar,ygenbar,Ez,'C') 
     # Bxp           t = n+1/2 -> t = n+1/2  (=B1bar)
-    Bxp = grid_to_particle(xgenbar,ygenbar,Bx,'UD')
-    Byp = grid_to_particle(xgenbar,ygenbar,By,'LR')
-    Bzp = grid_to_particle(xgenbar,ygenbar,Bz,'N') 
+    Exp, Eyp, Ezp, Bxp, Byp, Bzp = grid_to_particle_all(xgenbar, ygenbar, Ex, Ey, Ez, Bx, By, Bz, plan, EBp_w)
     
     # resu:         t = n -> t = n+1/2 (=Exp,Bxp,ubar)
-    resu = unew - u - QM * (Exp + vbar/gbar*Bzp - wbar/gbar*Byp)*dt
-    resv = vnew - v - QM * (Eyp - ubar/gbar*Bzp + wbar/gbar*Bxp)*dt
-    resw = wnew - w - QM * (Ezp + ubar/gbar*Byp - vbar/gbar*Bxp)*dt
+    lorentz_residual(unew, u, Exp, vpbar, Bzp, wpbar, Byp, resu)
+    lorentz_residual(vnew, v, Eyp, wpbar, Bxp, upbar, Bzp, resv)
+    lorentz_residual(wnew, w, Ezp, upbar, Byp, vpbar, Bxp, resw)
 
-    ykrylov = phys_to_krylov(resE1,resE2,resE3,resu,resv,resw)
     return  ykrylov
 
-def grid_to_particle(xk, yk, f, gridtype):
+def compute_interp_plan(xk, yk):
+    ''' To compute once the indexes and the bilinear weights of the particles 
+    for every grid type (shared by grid_to_particle and particle_to_grid_J)
+    plan[gridtype] = (i1, i2, j1, j2, wx1, wx2, wy1, wy2), the indexes are wrapped 
+    on the periodic directions, i.e. i2 can be nxn-1 on LR,N and j2 can be nyn-1 on UD,N
+    '''
+    # unshifted position (N)
+    xa = xk*inv_dx
+    ya = yk*inv_dy
+    i1N = np.floor(xa).astype(np.intp)
+    j1N = np.floor(ya).astype(np.intp)
+    wx2N = xa - i1N
+    wy2N = ya - j1N
+    xN = (i1N, i1N + 1, 1.0 - wx2N, wx2N)
+    yN = (j1N, j1N + 1, 1.0 - wy2N, wy2N)
+    # half cell shifted position (C)
+    xa = (xk-dx/2.)*inv_dx
+    ya = (yk-dy/2.)*inv_dy
+    i1C = np.floor(xa).astype(np.intp)
+    j1C = np.floor(ya).astype(np.intp)
+    wx2C = xa - i1C
+    wy2C = ya - j1C
+    xC = (i1C%nxc, (i1C + 1)%nxc, 1.0 - wx2C, wx2C)
+    yC = (j1C%nyc, (j1C + 1)%nyc, 1.0 - wy2C, wy2C)
+
+    plan = {}
+    for gridtype, (ix, jy) in (('LR', (xN, yC)), ('UD', (xC, yN)), ('C', (xC, yC)), ('N', (xN, yN))):
+        plan[gridtype] = (ix[0], ix[1], jy[0], jy[1], ix[2], ix[3], jy[2], jy[3])
+    return plan
+
+def grid_to_particle(xk, yk, f, gridtype, plan=None):
     ''' Interpolation of grid quantity to particle
     '''
-    global dx, dy, nx, ny, npart
-    
-    fp = np.zeros(npart,np.float64)
-
-    fx, fy = 0., 0.
-    if gridtype=='LR':
-      fy = dy/2.
-    elif gridtype=='UD':
-      fx = dx/2.
-    elif gridtype=='C':
-      fx, fy = dx/2., dy/2.
+    if plan is None:
+        plan = compute_interp_plan(xk, yk)
+    i1, i2, j1, j2, wx1, wx2, wy1, wy2 = plan[gridtype]
 
-    for i in range(npart):
-
-      #  interpolate field f from grid to particle */
-      xa = (xk[i]-fx)/dx
-      ya = (yk[i]-fy)/dy
-      i1 = int(np.floor(xa))
-      i2 = i1 + 1
-      j1 = int(np.floor(ya))
-      j2 = j1 + 1 
-      wx2 = xa - np.float64(i1)
-      wx1 = 1.0 - wx2
-      wy2 = ya - np.float64(j1)
-      wy1 = 1.0 - wy2
-      if gridtype=='LR':
-        j1, j2 = j1%nyc, j2%nyc
-      elif gridtype=='UD':
-        i1, i2 = i1%nxc, i2%nxc
-      elif gridtype=='C':
-        i1, i2 = i1%nxc, i2%nxc
-        j1, j2 = j1%nyc, j2%nyc
-
-      fp[i] = wx1* wy1 * f[i1,j1] + wx2* wy1 * f[i2,j1] + wx1* wy2 * f[i1,j2] + wx2* wy2 * f[i2,j2]
+    fp = wx1* wy1 * f[i1,j1] + wx2* wy1 * f[i2,j1] + wx1* wy2 * f[i1,j2] + wx2* wy2 * f[i2,j2]
     
     return fp
 
+@njit(cache=True, fastmath=True, parallel=True)
+def gather_all(xk, yk, Ex, Ey, Ez, Bx, By, Bz, dx, dy, nxc, nyc, Exp, Eyp, Ezp, Bxp, Byp, Bzp, wrap_x, wrap_y):
+    ''' Numba version of grid_to_particle for all the six fields at once:
+    the indexes and weights of the unshifted (N) and half cell shifted (C) 
+    positions are computed once per particle and combined for each grid
+    wrap_x[k+1] = k%nxc, wrap_y[k+1] = k%nyc: periodic indexes without integer division
+    '''
+    inv_dx, inv_dy = 1./dx, 1./dy
+    for i in prange(xk.shape[0]):
+      # unshifted position (N)
+      xa = xk[i]*inv_dx
+      ya = yk[i]*inv_dy
+      i1N = int(math.floor(xa))
+      j1N = int(math.floor(ya))
+      wx2N = xa - i1N
+      wx1N = 1.0 - wx2N
+      wy2N = ya - j1N
+      wy1N = 1.0 - wy2N
+      # shifted position (C) 
+      xa = (xk[i]-dx/2.)*inv_dx
+      ya = (yk[i]-dy/2.)*inv_dy
+      i1C = int(math.floor(xa))
+      j1C = int(math.floor(ya))
+      wx2C = xa - i1C
+      wx1C = 1.0 - wx2C
+      wy2C = ya - j1C
+      wy1C = 1.0 - wy2C
+      i2C = wrap_x[i1C+2]
+      j2C = wrap_y[j1C+2]
+      i1C = wrap_x[i1C+1]
+      j1C = wrap_y[j1C+1]
+
+      # LR: x from N, y from C
+      Exp[i] = wx1N* wy1C * Ex[i1N,j1C] + wx2N* wy1C * Ex[i1N+1,j1C] + wx1N* wy2C * Ex[i1N,j2C] + wx2N* wy2C * Ex[i1N+1,j2C]
+      Byp[i] = wx1N* wy1C * By[i1N,j1C] + wx2N* wy1C * By[i1N+1,j1C] + wx1N* wy2C * By[i1N,j2C] + wx2N* wy2C * By[i1N+1,j2C]
+      # UD: x from C, y from N
+      Eyp[i] = wx1C* wy1N * Ey[i1C,j1N] + wx2C* wy1N * Ey[i2C,j1N] + wx1C* wy2N * Ey[i1C,j1N+1] + wx2C* wy2N * Ey[i2C,j1N+1]
+      Bxp[i] = wx1C* wy1N * Bx[i1C,j1N] + wx2C* wy1N * Bx[i2C,j1N] + wx1C* wy2N * Bx[i1C,j1N+1] + wx2C* wy2N * Bx[i2C,j1N+1]
+      # C
+      Ezp[i] = wx1C* wy1C * Ez[i1C,j1C] + wx2C* wy1C * Ez[i2C,j1C] + wx1C* wy2C * Ez[i1C,j2C] + wx2C* wy2C * Ez[i2C,j2C]
+      # N
+      Bzp[i] = wx1N* wy1N * Bz[i1N,j1N] + wx2N* wy1N * Bz[i1N+1,j1N] + wx1N* wy2N * Bz[i1N,j1N+1] + wx2N* wy2N * Bz[i1N+1,j1N+1]
+
+def grid_to_particle_all(xk, yk, Ex, Ey, Ez, Bx, By, Bz, plan=None, out=None):
+    ''' Interpolation of the E (LR,UD,c) and B (UD,LR,n) fields to particle
+    out: optional tuple of the 6 output arrays
+    '''
+    if use_cuda:
+        if out is None:
+            out = tuple(np.empty(npart, np.float64) for i in range(6))
+        gather_all_gpu(xk, yk, Ex, Ey, Ez, Bx, By, Bz, out)
+        return out
+
+    if numba_available:
+        if out is None:
+            out = tuple(np.empty(npart, np.float64) for i in range(6))
+        gather_all(xk, yk, Ex, Ey, Ez, Bx, By, Bz, dx, dy, nxc, nyc, *out, wrap_x, wrap_y)
+        return out
+
+    if plan is None:
+        plan = compute_interp_plan(xk, yk)
+    Exp = grid_to_particle(xk,yk,Ex,'LR',plan)
+    Eyp = grid_to_particle(xk,yk,Ey,'UD',plan)
+    Ezp = grid_to_particle(xk,yk,Ez,'C',plan) 
+    Bxp = grid_to_particle(xk,yk,Bx,'UD',plan)
+    Byp = grid_to_particle(xk,yk,By,'LR',plan)
+    Bzp = grid_to_particle(xk,yk,Bz,'N',plan) 
+
+    if out is not None:
+        for res, comp in zip(out, (Exp, Eyp, Ezp, Bxp, Byp, Bzp)):
+            res[...] = comp
+        return out
+    return Exp, Eyp, Ezp, Bxp, Byp, Bzp
+
 def particle_to_grid_rho(xk, yk, q):
     ''' Interpolation particle to grid - charge rho -> c
     '''
@@ -1274,15 +1735,15 @@ def particle_to_grid_rho(xk, yk, q):
     rho = np.zeros(np.shape(xiC), np.float64)
 
     for i in range(npart):
-        xa = (xk[i]-dx/2.)/dx
-        ya = (yk[i]-dy/2.)/dy
+        xa = (xk[i]-dx/2.)*inv_dx
+        ya = (yk[i]-dy/2.)*inv_dy
         i1 = int(np.floor(xa))
         i2 = i1 + 1
         j1 = int(np.floor(ya))
         j2 = j1 + 1  
-        wx2 = xa - np.float64(i1)
+        wx2 = xa - i1
         wx1 = 1.0 - wx2
-        wy2 = ya - np.float64(j1)
+        wy2 = ya - j1
         wy1 = 1.0 - wy2
         i1, i2 = i1%nxc, i2%nxc
         j1, j2 = j1%nyc, j2%nyc
@@ -1297,79 +1758,263 @@ def particle_to_grid_rho(xk, yk, q):
 
     return rho 
 
-def particle_to_grid_J(xk, yk, uk, vk, wk, qk): 
+@njit(cache=True, fastmath=True, parallel=True)
+def particle_to_grid_J_nb(xk, yk, uk, vk, wk, qk, dx, dy, nxc, nyc, nxn, nyn, Jx, Jy, Jz, nthreads, wrap_x, wrap_y):
+    ''' Numba version of particle_to_grid_J: each thread deposits its own chunk of 
+    particles on a private copy of the grids, the copies are summed at the end
+    wrap_x[k+1] = k%nxc, wrap_y[k+1] = k%nyc: periodic indexes without integer division
+    '''
+    npart = xk.shape[0]
+    chunk = (npart + nthreads - 1)//nthreads
+    inv_dx, inv_dy = 1./dx, 1./dy
+
+    Jxt = np.zeros((nthreads, nxn, nyc), np.float64)
+    Jyt = np.zeros((nthreads, nxc, nyn), np.float64)
+    Jzt = np.zeros((nthreads, nxc, nyc), np.float64)
+
+    for t in prange(nthreads):
+      for i in range(t*chunk, min((t+1)*chunk, npart)):
+        qdxdy = qk[i]*inv_dx*inv_dy
+
+        # unshifted position (N)
+        xa = xk[i]*inv_dx
+        ya = yk[i]*inv_dy
+        i1N = int(math.floor(xa))
+        j1N = int(math.floor(ya))
+        wx2N = xa - i1N
+        wx1N = 1.0 - wx2N
+        wy2N = ya - j1N
+        wy1N = 1.0 - wy2N
+        i2N = i1N + 1
+        if i2N==nxn-1:
+          i2N=0
+        j2N = j1N + 1
+        if j2N==nyn-1:
+          j2N=0
+        # shifted position (C)
+        xa = (xk[i]-dx/2.)*inv_dx
+        ya = (yk[i]-dy/2.)*inv_dy
+        i1C = int(math.floor(xa))
+        j1C = int(math.floor(ya))
+        wx2C = xa - i1C
+        wx1C = 1.0 - wx2C
+        wy2C = ya - j1C
+        wy1C = 1.0 - wy2C
+        i1C, i2C = wrap_x[i1C+1], wrap_x[i1C+2]
+        j1C, j2C = wrap_y[j1C+1], wrap_y[j1C+2]
+
+        # LR: x from N, y from C
+        Jxt[t,i1N,j1C] += wx1N* wy1C * qdxdy * uk[i]
+        Jxt[t,i2N,j1C] += wx2N* wy1C * qdxdy * uk[i]
+        Jxt[t,i1N,j2C] += wx1N* wy2C * qdxdy * uk[i]
+        Jxt[t,i2N,j2C] += wx2N* wy2C * qdxdy * uk[i]
+
+        # UD: x from C, y from N
+        Jyt[t,i1C,j1N] += wx1C* wy1N * qdxdy * vk[i]
+        Jyt[t,i2C,j1N] += wx2C* wy1N * qdxdy * vk[i]
+        Jyt[t,i1C,j2N] += wx1C* wy2N * qdxdy * vk[i]
+        Jyt[t,i2C,j2N] += wx2C* wy2N * qdxdy * vk[i]
+
+        # C
+        Jzt[t,i1C,j1C] += wx1C* wy1C * qdxdy * wk[i]
+        Jzt[t,i2C,j1C] += wx2C* wy1C * qdxdy * wk[i]
+        Jzt[t,i1C,j2C] += wx1C* wy2C * qdxdy * wk[i]
+        Jzt[t,i2C,j2C] += wx2C* wy2C * qdxdy * wk[i]
+
+    # reduction of the private grids
+    for i in prange(nxn):
+      for j in range(nyc):
+        Jx[i,j] = 0.
+        for t in range(nthreads):
+          Jx[i,j] += Jxt[t,i,j]
+    for i in prange(nxc):
+      for j in range(nyn):
+        Jy[i,j] = 0.
+        for t in range(nthreads):
+          Jy[i,j] += Jyt[t,i,j]
+      for j in range(nyc):
+        Jz[i,j] = 0.
+        for t in range(nthreads):
+          Jz[i,j] += Jzt[t,i,j]
+
+    Jx[nxn-1,:] = Jx[0,:]
+    Jy[:,nyn-1] = Jy[:,0]
+
+use_cuda = GPU and cuda_available
+cuda_tpb = 256   # threads per block of the particle kernels
+
+if use_cuda:
+    @cuda.jit
+    def particle_to_grid_J_cuda(xk, yk, uk, vk, wk, qk, dx, dy, nxc, nyc, nxn, nyn, Jx, Jy, Jz):
+        ''' CUDA version of particle_to_grid_J: one thread per particle, atomic deposit
+        '''
+        i = cuda.grid(1)
+        if i >= xk.shape[0]:
+            return
+        inv_dx, inv_dy = 1./dx, 1./dy
+        qdxdy = qk[i]*inv_dx*inv_dy
+
+        # unshifted position (N)
+        xa = xk[i]*inv_dx
+        ya = yk[i]*inv_dy
+        i1N = int(math.floor(xa))
+        j1N = int(math.floor(ya))
+        wx2N = xa - i1N
+        wx1N = 1.0 - wx2N
+        wy2N = ya - j1N
+        wy1N = 1.0 - wy2N
+        i2N = i1N + 1
+        if i2N==nxn-1:
+          i2N=0
+        j2N = j1N + 1
+        if j2N==nyn-1:
+          j2N=0
+        # shifted position (C)
+        xa = (xk[i]-dx/2.)*inv_dx
+        ya = (yk[i]-dy/2.)*inv_dy
+        i1C = int(math.floor(xa))
+        j1C = int(math.floor(ya))
+        wx2C = xa - i1C
+        wx1C = 1.0 - wx2C
+        wy2C = ya - j1C
+        wy1C = 1.0 - wy2C
+        i1C, i2C = i1C%nxc, (i1C+1)%nxc
+        j1C, j2C = j1C%nyc, (j1C+1)%nyc
+
+        # LR: x from N, y from C
+        cuda.atomic.add(Jx, (i1N,j1C), wx1N* wy1C * qdxdy * uk[i])
+        cuda.atomic.add(Jx, (i2N,j1C), wx2N* wy1C * qdxdy * uk[i])
+        cuda.atomic.add(Jx, (i1N,j2C), wx1N* wy2C * qdxdy * uk[i])
+        cuda.atomic.add(Jx, (i2N,j2C), wx2N* wy2C * qdxdy * uk[i])
+
+        # UD: x from C, y from N
+        cuda.atomic.add(Jy, (i1C,j1N), wx1C* wy1N * qdxdy * vk[i])
+        cuda.atomic.add(Jy, (i2C,j1N), wx2C* wy1N * qdxdy * vk[i])
+        cuda.atomic.add(Jy, (i1C,j2N), wx1C* wy2N * qdxdy * vk[i])
+        cuda.atomic.add(Jy, (i2C,j2N), wx2C* wy2N * qdxdy * vk[i])
+
+        # C
+        cuda.atomic.add(Jz, (i1C,j1C), wx1C* wy1C * qdxdy * wk[i])
+        cuda.atomic.add(Jz, (i2C,j1C), wx2C* wy1C * qdxdy * wk[i])
+        cuda.atomic.add(Jz, (i1C,j2C), wx1C* wy2C * qdxdy * wk[i])
+        cuda.atomic.add(Jz, (i2C,j2C), wx2C* wy2C * qdxdy * wk[i])
+
+    @cuda.jit
+    def gather_all_cuda(xk, yk, Ex, Ey, Ez, Bx, By, Bz, dx, dy, nxc, nyc, Exp, Eyp, Ezp, Bxp, Byp, Bzp):
+        ''' CUDA version of gather_all: one thread per particle
+        '''
+        i = cuda.grid(1)
+        if i >= xk.shape[0]:
+            return
+        inv_dx, inv_dy = 1./dx, 1./dy
+        # unshifted position (N)
+        xa = xk[i]*inv_dx
+        ya = yk[i]*inv_dy
+        i1N = int(math.floor(xa))
+        j1N = int(math.floor(ya))
+        wx2N = xa - i1N
+        wx1N = 1.0 - wx2N
+        wy2N = ya - j1N
+        wy1N = 1.0 - wy2N
+        # shifted position (C) 
+        xa = (xk[i]-dx/2.)*inv_dx
+        ya = (yk[i]-dy/2.)*inv_dy
+        i1C = int(math.floor(xa))
+        j1C = int(math.floor(ya))
+        wx2C = xa - i1C
+        wx1C = 1.0 - wx2C
+        wy2C = ya - j1C
+        wy1C = 1.0 - wy2C
+        i2C = (i1C + 1)%nxc
+        j2C = (j1C + 1)%nyc
+        i1C = i1C%nxc
+        j1C = j1C%nyc
+
+        # LR: x from N, y from C
+        Exp[i] = wx1N* wy1C * Ex[i1N,j1C] + wx2N* wy1C * Ex[i1N+1,j1C] + wx1N* wy2C * Ex[i1N,j2C] + wx2N* wy2C * Ex[i1N+1,j2C]
+        Byp[i] = wx1N* wy1C * By[i1N,j1C] + wx2N* wy1C * By[i1N+1,j1C] + wx1N* wy2C * By[i1N,j2C] + wx2N* wy2C * By[i1N+1,j2C]
+        # UD: x from C, y from N
+        Eyp[i] = wx1C* wy1N * Ey[i1C,j1N] + wx2C* wy1N * Ey[i2C,j1N] + wx1C* wy2N * Ey[i1C,j1N+1] + wx2C* wy2N * Ey[i2C,j1N+1]
+        Bxp[i] = wx1C* wy1N * Bx[i1C,j1N] + wx2C* wy1N * Bx[i2C,j1N] + wx1C* wy2N * Bx[i1C,j1N+1] + wx2C* wy2N * Bx[i2C,j1N+1]
+        # C
+        Ezp[i] = wx1C* wy1C * Ez[i1C,j1C] + wx2C* wy1C * Ez[i2C,j1C] + wx1C* wy2C * Ez[i1C,j2C] + wx2C* wy2C * Ez[i2C,j2C]
+        # N
+        Bzp[i] = wx1N* wy1N * Bz[i1N,j1N] + wx2N* wy1N * Bz[i1N+1,j1N] + wx1N* wy2N * Bz[i1N,j1N+1] + wx2N* wy2N * Bz[i1N+1,j1N+1]
+
+def particle_to_grid_J_gpu(xk, yk, uk, vk, wk, qk, Jx, Jy, Jz):
+    ''' Deposit of the current on the GPU: particles and grids copied to/from the device
+    '''
+    blocks = (xk.shape[0] + cuda_tpb - 1)//cuda_tpb
+    d_part = [cuda.to_device(np.ascontiguousarray(arr)) for arr in (xk, yk, uk, vk, wk, qk)]
+    d_J = [cuda.to_device(np.zeros(np.shape(Jk), np.float64)) for Jk in (Jx, Jy, Jz)]
+    particle_to_grid_J_cuda[blocks, cuda_tpb](*d_part, dx, dy, nxc, nyc, nxn, nyn, *d_J)
+    for Jk, d_Jk in zip((Jx, Jy, Jz), d_J):
+        Jk[...] = d_Jk.copy_to_host()
+    Jx[nxn-1,:] = Jx[0,:]
+    Jy[:,nyn-1] = Jy[:,0]
+
+def gather_all_gpu(xk, yk, Ex, Ey, Ez, Bx, By, Bz, out):
+    ''' Interpolation of the six fields to the particles on the GPU
+    '''
+    blocks = (xk.shape[0] + cuda_tpb - 1)//cuda_tpb
+    d_in = [cuda.to_device(np.ascontiguousarray(arr)) for arr in (xk, yk, Ex, Ey, Ez, Bx, By, Bz)]
+    d_out = [cuda.device_array(xk.shape[0], np.float64) for i in range(6)]
+    gather_all_cuda[blocks, cuda_tpb](*d_in, dx, dy, nxc, nyc, *d_out)
+    for res, d_res in zip(out, d_out):
+        res[...] = d_res.copy_to_host()
+
+def scatter_bincount(shape, i1, i2, j1, j2, wx1, wx2, wy1, wy2, val):
+    ''' Bilinear scatter of the particle quantity val over a grid of given shape 
+    (the four corner contributions are accumulated with np.bincount)
+    '''
+    size = shape[0]*shape[1]
+    field = np.bincount(i1*shape[1] + j1, weights=wx1*wy1*val, minlength=size)\
+          + np.bincount(i2*shape[1] + j1, weights=wx2*wy1*val, minlength=size)\
+          + np.bincount(i1*shape[1] + j2, weights=wx1*wy2*val, minlength=size)\
+          + np.bincount(i2*shape[1] + j2, weights=wx2*wy2*val, minlength=size)
+    return field.reshape(shape)
+
+def particle_to_grid_J(xk, yk, uk, vk, wk, qk, plan=None, out=None): 
     ''' Interpolation particle to grid - current -> LR, UD, c
+    out: optional tuple of the 3 output arrays
     ''' 
     global dx, dy, nxc, nyc, nxn, nyn, npart
-  
-    Jx = np.zeros(np.shape(xiLR),np.float64)
-    Jy = np.zeros(np.shape(xiUD),np.float64)
-    Jz = np.zeros(np.shape(xiC),np.float64)
-
-    for i in range(npart):
-
-      #  interpolate p -> LR
-      xa = xk[i]/dx 
-      ya = (yk[i]-dy/2.)/dy
-      i1 = int(np.floor(xa))
-      i2 = i1 + 1
-      if i2==nxn-1:
-        i2=0
-      j1 = int(np.floor(ya))
-      j2 = j1 + 1  
-      wx2 = xa - np.float64(i1)
-      wx1 = 1.0 - wx2
-      wy2 = ya - np.float64(j1)
-      wy1 = 1.0 - wy2
-      j1, j2 = j1%nyc, j2%nyc
-
-      Jx[i1,j1] += wx1* wy1 * qk[i] * uk[i]/dx/dy
-      Jx[i2,j1] += wx2* wy1 * qk[i] * uk[i]/dx/dy
-      Jx[i1,j2] += wx1* wy2 * qk[i] * uk[i]/dx/dy
-      Jx[i2,j2] += wx2* wy2 * qk[i] * uk[i]/dx/dy
-
-      # interpolate p -> UD
-      xa = (xk[i]-dx/2.)/dx 
-      ya = yk[i]/dy
-      i1 = int(np.floor(xa))
-      i2 = i1 + 1
-      j1 = int(np.floor(ya))
-      j2 = j1 + 1  
-      if j2==nyn-1:
-        j2=0
-      wx2 = xa - np.float64(i1)
-      wx1 = 1.0 - wx2
-      wy2 = ya - np.float64(j1)
-      wy1 = 1.0 - wy2
-      i1, i2 = i1%nxc, i2%nxc
-
-      Jy[i1,j1] += wx1* wy1 * qk[i] * vk[i]/dx/dy
-      Jy[i2,j1] += wx2* wy1 * qk[i] * vk[i]/dx/dy
-      Jy[i1,j2] += wx1* wy2 * qk[i] * vk[i]/dx/dy
-      Jy[i2,j2] += wx2* wy2 * qk[i] * vk[i]/dx/dy
-
-      # interpolate p -> c
-      xa = (xk[i]-dx/2.)/dx 
-      ya = (yk[i]-dy/2.)/dy
-      i1 = int(np.floor(xa))
-      i2 = i1 + 1
-      j1 = int(np.floor(ya))
-      j2 = j1 + 1  
-      wx2 = xa - np.float64(i1)
-      wx1 = 1.0 - wx2
-      wy2 = ya - np.float64(j1)
-      wy1 = 1.0 - wy2
-      i1, i2 = i1%nxc, i2%nxc
-      j1, j2 = j1%nyc, j2%nyc
-
-      Jz[i1,j1] += wx1* wy1 * qk[i] * wk[i]/dx/dy
-      Jz[i2,j1] += wx2* wy1 * qk[i] * wk[i]/dx/dy
-      Jz[i1,j2] += wx1* wy2 * qk[i] * wk[i]/dx/dy
-      Jz[i2,j2] += wx2* wy2 * qk[i] * wk[i]/dx/dy
 
+    if use_cuda:
+        Jx, Jy, Jz = out if out is not None else (np.empty(np.shape(xi), np.float64) for xi in (xiLR, xiUD, xiC))
+        particle_to_grid_J_gpu(xk, yk, uk, vk, wk, qk, Jx, Jy, Jz)
+        return Jx, Jy, Jz
+
+    if numba_available:
+        if out is None:
+            Jx = np.zeros(np.shape(xiLR),np.float64)
+            Jy = np.zeros(np.shape(xiUD),np.float64)
+            Jz = np.zeros(np.shape(xiC),np.float64)
+        else:
+            Jx, Jy, Jz = out
+            for Jk in out:
+                Jk.fill(0.)
+        particle_to_grid_J_nb(xk, yk, uk, vk, wk, qk, dx, dy, nxc, nyc, nxn, nyn, Jx, Jy, Jz, get_num_threads(), wrap_x, wrap_y)
+        return Jx, Jy, Jz
+
+    if plan is None:
+        plan = compute_interp_plan(xk, yk)
+    qdxdy = qk*inv_dx*inv_dy
+
+    Jx = scatter_bincount((nxn, nyc), *plan['LR'], qdxdy * uk)
+    Jy = scatter_bincount((nxc, nyn), *plan['UD'], qdxdy * vk)
+    Jz = scatter_bincount((nxc, nyc), *plan['C'], qdxdy * wk)
+
+    # periodic BC: fold the contributions on the last LR/UD faces
+    Jx[0,:] += Jx[nxn-1,:]
     Jx[nxn-1,:] = Jx[0,:]
+    Jy[:,0] += Jy[:,nyn-1]
     Jy[:,nyn-1] = Jy[:,0]
 
+    if out is not None:
+        for res, comp in zip(out, (Jx, Jy, Jz)):
+            res[...] = comp
+        return out
     return Jx, Jy, Jz
 
 def poynting_flux_nometric():
@@ -1585,6 +2230,9 @@ if metric:
 else:
     xgen, ygen = x, y
 
+# reciprocals of the Jacobians: curl and div multiply instead of dividing
+inv_J_UD, inv_J_LR, inv_J_C, inv_J_N = 1./J_UD, 1./J_LR, 1./J_C, 1./J_N
+
 stop_geom = time.time()
 
 #print(g11_C)
@@ -1722,12 +2370,12 @@ if metric:
                          + J_N[0:nxn-1,0:nyn-1] * g32_N[0:nxn-1,0:nyn-1] * B3[0:nxn-1,0:nyn-1] * avg(B2, 'LR2N')[0:nxn-1,0:nyn-1] \
                          + J_N[0:nxn-1,0:nyn-1] * g33_N[0:nxn-1,0:nyn-1] * B3[0:nxn-1,0:nyn-1] * B3[0:nxn-1,0:nyn-1])/2.*dx*dy]
 else:
-    histEnergyE1=[np.sum(E1[0:nxn-1,:]**2)/2.*dx*dy]
-    histEnergyE2=[np.sum(E2[:,0:nyn-1]**2)/2.*dx*dy]
-    histEnergyE3=[np.sum(E3[:,:]**2)/2.*dx*dy]
-    histEnergyB1=[np.sum(B1[:,0:nyn-1]**2)/2.*dx*dy]
-    histEnergyB2=[np.sum(B2[0:nxn-1,:]**2)/2.*dx*dy]
-    histEnergyB3=[np.sum(B3[0:nxn-1,0:nyn-1]**2)/2.*dx*dy]
+    histEnergyE1=[sum_squares(E1[0:nxn-1,:])/2.*dx*dy]
+    histEnergyE2=[sum_squares(E2[:,0:nyn-1])/2.*dx*dy]
+    histEnergyE3=[sum_squares(E3[:,:])/2.*dx*dy]
+    histEnergyB1=[sum_squares(B1[:,0:nyn-1])/2.*dx*dy]
+    histEnergyB2=[sum_squares(B2[0:nxn-1,:])/2.*dx*dy]
+    histEnergyB3=[sum_squares(B3[0:nxn-1,0:nyn-1])/2.*dx*dy]
 
 histEnergyTot=[histEnergyP1[0]+histEnergyP2[0]+histEnergyE1[0]+histEnergyE2[0]+histEnergyE3[0]+histEnergyB1[0]+histEnergyB2[0]+histEnergyB3[0]]
 
@@ -1780,15 +2428,37 @@ if plot_save:
 
 cpu_time = np.zeros(nt+1, np.float64)
 
+if NK_method and not metric:
+    M_inv = maxwell_preconditioner()
+else:
+    M_inv = None
+
+# scratch arrays of residual(), allocated once and reused by every call
+ubar_w, vbar_w, wbar_w, xbar_w, ybar_w, tmp_w = (np.empty(npart, np.float64) for i in range(6))
+EBp_w = tuple(np.empty(npart, np.float64) for i in range(6))
+J_w = (np.empty((nxn, nyc)), np.empty((nxc, nyn)), np.empty((nxc, nyc)))
+Ebar_w = (np.empty((nxn, nyc)), np.empty((nxc, nyn)), np.empty((nxc, nyc)))
+curlE_w = (np.empty((nxc, nyn)), np.empty((nxn, nyc)), np.empty((nxn, nyn)))
+Bbar_w = (np.empty((nxc, nyn)), np.empty((nxn, nyc)), np.empty((nxn, nyn)))
+curlB_w = (np.empty((nxn, nyc)), np.empty((nxc, nyn)), np.empty((nxc, nyc)))
+res_w = np.empty(nxn*nyc + nxc*nyn + nxc*nyc + 3*npart, np.float64)
+
+fft_fields = FFT_fields and not metric
+if fft_fields:
+    fft_inv = maxwell_fft_operator()
+
 for it in range(1,nt+1):
     plt.clf()
     #start = time.time()
 
+    if fft_fields:
+        fft_rhs = maxwell_fft_rhs(E1, E2, E3, B1, B2, B3)
+
     if NK_method:
         # The following is python's NK methods
         #guess = zeros(2*nxn*nyc+2*nxc*nyn+nxc*nxc+nxn*nxn+3*2*part,np.float64)
         guess = phys_to_krylov(E1, E2, E3, u, v, w)
-        sol = newton_krylov(residual, guess, method='lgmres', verbose=1, f_tol=1e-18)#, f_rtol=1e-7)
+        sol = newton_gmres(residual, guess, f_tol=1e-10, inner_maxiter=20, M=M_inv)
         print('Residual: %g' % abs(residual(sol)).max())
     elif Picard:
         # The following is a Picard iteration
@@ -1800,9 +2470,9 @@ for it in range(1,nt+1):
         xkrylov = guess
         while err > tol and k<=kmax:
             k+=1
-            xkold = xkrylov
-            xkrylov = xkrylov - residual(xkrylov)
-            err = np.linalg.norm(xkrylov-xkold)
+            # guess is a fresh vector every step: it can be updated in place
+            xkrylov -= residual(xkrylov, res_w)
+            err = np.linalg.norm(res_w)
             print(k, err)
         sol = xkrylov
 
@@ -1824,11 +2494,11 @@ for it in range(1,nt+1):
     vbar = (vnew + v)/2.
     x += ubar/gbar*dt
     y += vbar/gbar*dt
-    x = x%Lx
-    y = y%Ly
-    u = unew
-    v = vnew
-    w = wnew
+    x %= Lx
+    y %= Ly
+    u[:] = unew
+    v[:] = vnew
+    w[:] = wnew
 
     E1bar = (E1new + E1)/2.
     E2bar = (E2new + E2)/2.
@@ -2015,12 +2685,12 @@ for it in range(1,nt+1):
                         + J_N[0:nxn-1,0:nyn-1] * g32_N[0:nxn-1,0:nyn-1] * B3[0:nxn-1,0:nyn-1] * avg(B2, 'LR2N')[0:nxn-1,0:nyn-1] \
                         + J_N[0:nxn-1,0:nyn-1] * g33_N[0:nxn-1,0:nyn-1] * B3[0:nxn-1,0:nyn-1] * B3[0:nxn-1,0:nyn-1])/2.*dx*dy
     else:
-        energyE1 = np.sum(E1[0:nxn-1,:]**2)/2.*dx*dy
-        energyE2 = np.sum(E2[:,0:nyn-1]**2)/2.*dx*dy
-        energyE3 = np.sum(E3[:,:]**2)/2.*dx*dy
-        energyB1 = np.sum(B1[:,0:nyn-1]**2)/2.*dx*dy
-        energyB2 = np.sum(B2[0:nxn-1,:]**2)/2.*dx*dy
-        energyB3 = np.sum(B3[0:nxn-1,0:nyn-1]**2)/2.*dx*dy
+        energyE1 = sum_squares(E1[0:nxn-1,:])/2.*dx*dy
+        energyE2 = sum_squares(E2[:,0:nyn-1])/2.*dx*dy
+        energyE3 = sum_squares(E3[:,:])/2.*dx*dy
+        energyB1 = sum_squares(B1[:,0:nyn-1])/2.*dx*dy
+        energyB2 = sum_squares(B2[0:nxn-1,:])/2.*dx*dy
+        energyB3 = sum_squares(B3[0:nxn-1,0:nyn-1])/2.*dx*dy
     
     energyTot = energyP1 + energyP2 + energyE1 + energyE2 + energyE3 + energyB1 + energyB2 + energyB3
 
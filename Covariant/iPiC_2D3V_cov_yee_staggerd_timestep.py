@@ -7,11 +7,30 @@ MIT License.
 """
 
 import numpy as np
-from scipy.optimize import newton_krylov, minimize
-from numpy import cosh, zeros_like, mgrid, zeros, ones
+from numpy import mgrid, zeros, ones
 import matplotlib.pyplot as plt
 import time
-import sys
+import math
+try:
+    from numba import njit, prange, get_num_threads
+    numba_available = True
+except ImportError:
+    # without numba the geometry is built with plain numpy and the particle kernels are python loops
+    numba_available = False
+    prange = range
+    get_num_threads = lambda: 1
+    def njit(*args, **kwargs):
+        return lambda func: func
+try:
+    from numba import cuda
+    cuda_available = cuda.is_available()
+except ImportError:
+    cuda_available = False
+try:
+    import numexpr as ne
+    numexpr_available = True
+except ImportError:
+    numexpr_available = False
 
 
 #TODO: Fix cart to gen and gen to cart
@@ -26,17 +45,28 @@ perturb = True           # perturbed metric tensor
 # method flags
 NK_method = False
 Picard = True
+GPU = False                 # particle deposit & gather as numba.cuda kernels (if a CUDA device is found)
 # physics flags
 electron_and_ion = True     # background of ions when QM1=QM2=-1
 stable_plasma = True        # stable plasma set up
 couter_stream_inst = False  # counterstream inst. set up
 landau_damping = False      # landau damping set u
 relativistic = False        # relativisitc  set up
+# precision flag
+DTYPE = np.float64          # particle precision (np.float32 halves the particle memory traffic)
+FTYPE = np.float64          # field precision (np.float32 halves the stencil memory traffic)
+KTYPE = np.result_type(FTYPE, DTYPE)   # precision of the solver unknowns (E and particle velocities)
+solver_tol = 1e-14 if KTYPE == np.float64 else 1e-6   # Picard/NK tolerance above the float32 round-off
 # plot flags   
 log_file = True             # to save the log file in PATH1
 plot_dir = True             # to save the plots in PATH1
 plot_each_step = False      # to visualise each time step (memory consuming)
 plot_data = False           # to plot data in PATH1
+diag_all_steps = True       # diagnostics on every cycle (False: only on the plotting cycles and the last one)
+
+if not plot_each_step:
+    # nothing is shown on screen: render off-screen
+    plt.switch_backend('Agg')
 
 # parameters
 nx, ny = 50, 50
@@ -49,6 +79,7 @@ nt = 201
 
 ndpi = 100  # number of dpi per img (stay low 100 for monitoring purpose!)
 every = 10    # how often to plot
+sort_every = 10  # how often to re-sort the particles along the Morton curve (0 -> never)
 eps = 0.5    # amplitude of the pertutbation
 n = 1.      # mode of oscillation
 B0 = 0.01   # B field perturbation
@@ -78,64 +109,121 @@ V0z2 = V0 # Stream velocity
 VT2 = alpha*V0 # thermal velocity
 
 npart = npart1 + npart2
-QM = zeros(npart, np.float64)
+
+class Particles:
+    '''Particle state as a structure of arrays: pos = (x, y), vel = (u, v, w)
+    every component (x, y, u, v, w, q, qm) is a contiguous 1D array
+    '''
+    __slots__ = ('pos', 'vel', 'q', 'qm')
+
+    def __init__(self, npart, dtype=DTYPE):
+        # the rows are padded to a multiple of 8 values (64 bytes in float64): all the
+        # components start with the same alignment, the padding is never touched
+        npad = -(-npart//8)*8
+        self.pos = zeros((2, npad), dtype)[:, :npart]
+        self.vel = zeros((3, npad), dtype)[:, :npart]
+        self.q = zeros(npart, dtype)
+        self.qm = zeros(npart, dtype)
+
+P = Particles(npart)
+# x, y, u, v, w, q, QM are views on P: update them in place
+x, y = P.pos
+u, v, w = P.vel
+q, QM = P.q, P.qm
+
 QM[0:npart1] = QM1
 QM[npart1:npart] = QM2
 
 # INIT PARTICLES
 np.random.seed(1)
 
-if nppc==0:
-    dxp = 0.
-    dyp = 0.
-else:
-    dxp = Lx/np.sqrt(npart1)
-    dyp = Ly/np.sqrt(npart1)
-
-xp, yp = mgrid[dxp/2.:Lx-dxp/2.:(np.sqrt(npart1)*1j), dyp/2.:Ly-dyp/2.:(np.sqrt(npart1)*1j)]
-
-x = zeros(npart, np.float64)
-x[0:npart1] = xp.reshape(npart1)
 x[0:npart1] = Lx*np.random.rand(npart1)
 x[npart1:npart] = x[0:npart1]
 
-y = zeros(npart, np.float64)
-y[0:npart1] = yp.reshape(npart1)
 y[0:npart1] = Ly*np.random.rand(npart1)
 y[npart1:npart] = y[0:npart1]
 
-u = zeros(npart, np.float64)
+# one draw for both species, then per-species scaling
 if stable_plasma: 
-    u[0:npart1] = VT1*np.random.randn(npart1)
-    u[npart1:npart] = VT2*np.random.randn(npart2)
+    u[:] = np.random.randn(npart)
+    u[0:npart1] *= VT1
+    u[npart1:npart] *= VT2
 if couter_stream_inst:
-    u[0:npart1] = V0x1+VT1*np.random.randn(npart1)
-    u[npart1:npart] = V0x2+VT2*np.random.randn(npart2)
+    u[:] = np.random.randn(npart)
+    u[0:npart1] *= VT1
+    u[npart1:npart] *= VT2
+    u[0:npart1] += V0x1
+    u[npart1:npart] += V0x2
     # velocity in the odd position are negative 
-    u[1:npart:2] = - u[1:npart:2]
+    u[1:npart:2] *= -1.
     # to guarantee 50% of +u0 to e- and the other 50% to e+ and same fo -u0
     np.random.shuffle(u)
 
-v = zeros(npart, np.float64)
-v[0:npart1] = VT1*np.random.randn(npart1)
-v[npart1:npart] = VT2*np.random.randn(npart2)
+v[:] = np.random.randn(npart)
+v[0:npart1] *= VT1
+v[npart1:npart] *= VT2
 if landau_damping:
     v[0:npart1] = V0y1+VT1*np.sin(x[0:npart1]/Lx)
     v[npart1:npart] = V0y2+VT2*np.sin(x[npart1:npart]/Lx)
 
-w = zeros(npart, np.float64)
-w[0:npart1] = VT1*np.random.randn(npart1)
-w[npart1:npart] = VT2*np.random.randn(npart2)
+w[:] = np.random.randn(npart)
+w[0:npart1] *= VT1
+w[npart1:npart] *= VT2
 
-q = zeros(npart, np.float64)
-q[0:npart1] = np.ones(npart1)*WP1**2/(QM1*npart1/Lx/Ly) 
-q[npart1:npart] = np.ones(npart2)*WP2**2/(QM2*npart2/Lx/Ly)
+if npart > 0:
+    q[0:npart1] = WP1**2/(QM1*npart1/Lx/Ly)
+    q[npart1:npart] = WP2**2/(QM2*npart2/Lx/Ly)
+# |q/QM| of the energy diagnostics, constant within a species (the resort does not change it)
+mass = np.abs(q/QM)
 
 if relativistic:
-    g = 1./np.sqrt(1.-(u**2+v**2+w**2))
-    u = u*g
-    v = v*g
-    w = w*g
+    # g = 1/sqrt(1-(u**2+v**2+w**2)) in place
+    g = u*u
+    g += v*v
+    g += w*w
+    np.subtract(1., g, out=g)
+    np.sqrt(g, out=g)
+    np.reciprocal(g, out=g)
+    u *= g
+    v *= g
+    w *= g
+
+@njit(cache=True)
+def morton_encode_2d(ix, iy):
+    '''Z-order code of the cell indexes (ix, iy): interleave their bits (up to 16 bits each)
+    '''
+    mc = np.empty(ix.shape[0], np.int64)
+    for p in range(ix.shape[0]):
+      a, b = ix[p] & 0xFFFF, iy[p] & 0xFFFF
+      a = (a | (a << 8)) & 0x00FF00FF
+      a = (a | (a << 4)) & 0x0F0F0F0F
+      a = (a | (a << 2)) & 0x33333333
+      a = (a | (a << 1)) & 0x55555555
+      b = (b | (b << 8)) & 0x00FF00FF
+      b = (b | (b << 4)) & 0x0F0F0F0F
+      b = (b | (b << 2)) & 0x33333333
+      b = (b | (b << 1)) & 0x55555555
+      mc[p] = a | (b << 1)
+    return mc
+
+def resort_particles():
+    '''Reorder each species along the Morton curve of its cells, so that particles
+    close in space are close in memory for the gather and the deposit
+    '''
+    ix = (x // dx).astype(np.int64) % nx
+    iy = (y // dy).astype(np.int64) % ny
+    mc = morton_encode_2d(ix, iy)
+    for start, stop in ((0, npart1), (npart1, npart)):
+        order = np.argsort(mc[start:stop], kind='stable') + start
+        P.pos[:, start:stop] = P.pos[:, order]
+        P.vel[:, start:stop] = P.vel[:, order]
+        q[start:stop] = q[order]
+        QM[start:stop] = QM[order]
+        if relativistic:
+            g[start:stop] = g[order]
+
+if sort_every > 0:
+    resort_particles()
 
 # INIT LOGIC GRID
 # grid of left-right faces LR
@@ -164,19 +252,21 @@ yN = etaN.copy()
 # defined on grid centres c: Ez, Jz, rho
 # defined on grid corners n: Bz
 
-E1 = zeros(np.shape(xiLR), np.float64)
-E2 = zeros(np.shape(xiUD), np.float64)
-E3 = zeros(np.shape(xiC), np.float64)
-B1 = zeros(np.shape(xiUD), np.float64)
-B2 = zeros(np.shape(xiLR), np.float64)
-B3 = zeros(np.shape(xiN), np.float64)
+E1 = zeros(np.shape(xiLR), FTYPE)
+E2 = zeros(np.shape(xiUD), FTYPE)
+E3 = zeros(np.shape(xiC), FTYPE)
+B1 = zeros(np.shape(xiUD), FTYPE)
+B2 = zeros(np.shape(xiLR), FTYPE)
+B3 = zeros(np.shape(xiN), FTYPE)
+# DIAGNOSTICS
+# all the time series live in one (nt+1, ndiag) record: the row of a cycle is contiguous
+diag_names = ['E1time', 'E2time', 'E3time', 'B1time', 'B2time', 'B3time',
+              'divE', 'divE_rho', 'divB',
+              'energyP', 'energyP1', 'energyP2', 'energyE', 'energyE1', 'energyE2', 'energyE3',
+              'energyB', 'energyB1', 'energyB2', 'energyB3', 'energyTot', 'momentumTot']
+diag = zeros((nt+1, len(diag_names)), np.float64)
 #time series
-E1time = zeros(nt+1, np.float64)
-E2time = zeros(nt+1, np.float64)
-E3time = zeros(nt+1, np.float64)
-B1time = zeros(nt+1, np.float64)
-B2time = zeros(nt+1, np.float64)
-B3time = zeros(nt+1, np.float64)
+E1time, E2time, E3time, B1time, B2time, B3time = (diag[:, i] for i in range(6))
 
 if nppc==0: 
     # delta perturbation of magnetic field
@@ -184,327 +274,152 @@ if nppc==0:
     # double sinusoidal perturbation
     #B3 = B0 * np.sin(2. * np.pi * n * xiN / Lx) * np.sin(2. * np.pi * n * etaN / Ly)
 
-rho = zeros(np.shape(xiC), np.float64)
-rho_ion = zeros(np.shape(xiC), np.float64)
-
-# INIT JACOBIAN MATRIX
-# defined on grid LR:        (j11e, j21e, j31e)E1, J1
-#                            (j11b, j21b, j31b)B1
-# defined on grid UD:        (J12e, J22e, J32e)E2, J2
-#                            (J12b, J22b, J32b)B2
-# defined on grid centres c: (J13e, J23e, J33e)E3, J3
-# defined on grid nodes n:   (J13b, J23b, J33b)B3
-
-J11_LR, J22_LR, J33_LR = (np.ones_like(xiLR) for i in range(3))
-J12_LR, J13_LR, J21_LR, J23_LR, J31_LR, J32_LR = (np.zeros_like(xiLR, np.float64) for i in range(6))
-
-J11_UD, J22_UD, J33_UD = (np.ones_like(xiUD) for i in range(3))
-J12_UD, J13_UD, J21_UD, J23_UD, J31_UD, J32_UD = (np.zeros_like(xiUD, np.float64) for i in range(6))
+rho = zeros(np.shape(xiC), FTYPE)
+rho_ion = zeros(np.shape(xiC), FTYPE)
 
-J11_C, J22_C, J33_C = (np.ones_like(xiC) for i in range(3))
-J12_C, J13_C, J21_C, J23_C, J31_C, J32_C = (np.zeros_like(xiC, np.float64) for i in range(6))
+# GEOMETRY
+# The map only perturbs the (xi, eta) plane: J13 = J23 = J31 = J32 = 0 and J33 = 1,
+# hence g13 = g23 = 0 and g33 = 1. Only the 2x2 block of the Jacobian and its
+# determinant are stored on each grid type; the metric and the inverse Jacobian
+# are derived on the fly.
 
-J11_N, J22_N, J33_N = (np.ones_like(xiN) for i in range(3))
-J12_N, J13_N, J21_N, J23_N, J31_N, J32_N = (np.zeros_like(xiN, np.float64) for i in range(6))
-
-"""
-if perturb:
-    # simusoidal perturbation map
-    J11_LR = 1. + 2. * np.pi * eps * np.cos(2. * np.pi * xiLR / Lx) * np.sin(2. * np.pi * etaLR / Ly) / Lx
-    J12_LR = 2. * np.pi * eps * np.sin(2. * np.pi * xiLR / Lx) * np.cos(2. * np.pi * etaLR / Ly) / Ly
-    J13_LR = np.zeros(np.shape(xiLR), np.float64)
-    J21_LR = 2. * np.pi * eps * np.cos(2. * np.pi * xiLR / Lx) * np.sin(2. * np.pi * etaLR / Ly) / Lx
-    J22_LR = 1. + 2. * np.pi * eps * np.sin(2. * np.pi * xiLR / Lx) * np.cos(2. * np.pi * etaLR / Ly) / Ly
-    J23_LR = np.zeros(np.shape(xiLR), np.float64)
-    J31_LR = np.zeros(np.shape(xiLR), np.float64)
-    J32_LR = np.zeros(np.shape(xiLR), np.float64)
-    J33_LR = np.ones(np.shape(xiLR), np.float64)
-
-    J11_UD = 1. + 2. * np.pi * eps * np.cos(2. * np.pi * xiUD / Lx) * np.sin(2. * np.pi * etaUD / Ly) / Lx
-    J12_UD = 2. * np.pi * eps * np.sin(2. * np.pi * xiUD / Lx) * np.cos(2. * np.pi * etaUD / Ly) / Ly
-    J13_UD = np.zeros(np.shape(xiUD), np.float64)
-    J21_UD = 2. * np.pi * eps * np.cos(2. * np.pi * xiUD / Lx) * np.sin(2. * np.pi * etaUD / Ly) / Lx
-    J22_UD = 1. + 2. * np.pi * eps * np.sin(2. * np.pi * xiUD / Lx) * np.cos(2. * np.pi * etaUD / Ly) / Ly
-    J23_UD = np.zeros(np.shape(xiUD), np.float64)
-    J31_UD = np.zeros(np.shape(xiUD), np.float64)
-    J32_UD = np.zeros(np.shape(xiUD), np.float64)
-    J33_UD = np.ones(np.shape(xiUD), np.float64)
-
-    J11_C = 1. + 2. * np.pi * eps * np.cos(2. * np.pi * xiC / Lx) * np.sin(2. * np.pi * etaC / Ly) / Lx
-    J12_C = 2. * np.pi * eps * np.sin(2. * np.pi * xiC / Lx) * np.cos(2. * np.pi * etaC / Ly) / Ly
-    J13_C = np.zeros(np.shape(xiC), np.float64)
-    J21_C = 2. * np.pi * eps * np.cos(2. * np.pi * xiC / Lx) * np.sin(2. * np.pi * etaC / Ly) / Lx
-    J22_C = 1. + 2. * np.pi * eps * np.sin(2. * np.pi * xiC / Lx) * np.cos(2. * np.pi * etaC / Ly) / Ly
-    J23_C = np.zeros(np.shape(xiC), np.float64)
-    J31_C = np.zeros(np.shape(xiC), np.float64)
-    J32_C = np.zeros(np.shape(xiC), np.float64)
-    J33_C = np.ones(np.shape(xiC), np.float64)
-
-    J11_N = 1. + 2. * np.pi * eps * np.cos(2. * np.pi * xiN / Lx) * np.sin(2. * np.pi * etaN / Ly) / Lx
-    J12_N = 2. * np.pi * eps * np.sin(2. * np.pi * xiN / Lx) * np.cos(2. * np.pi * etaN / Ly) / Ly
-    J13_N = np.zeros(np.shape(xiN), np.float64)
-    J21_N = 2. * np.pi * eps * np.cos(2. * np.pi * xiN / Lx) * np.sin(2. * np.pi * etaN / Ly) / Lx
-    J22_N = 1. + 2. * np.pi * eps * np.sin(2. * np.pi * xiN / Lx) * np.cos(2. * np.pi * etaN / Ly) / Ly
-    J23_N = np.zeros(np.shape(xiN), np.float64)
-    J31_N = np.zeros(np.shape(xiN), np.float64)
-    J32_N = np.zeros(np.shape(xiN), np.float64)
-    J33_N = np.ones(np.shape(xiN), np.float64)
-else:
-    # identity matrix 
-    J11_LR = np.ones(np.shape(xiLR), np.float64)
-    J12_LR = np.zeros(np.shape(xiLR), np.float64)
-    J13_LR = np.zeros(np.shape(xiLR), np.float64)
-    J21_LR = np.zeros(np.shape(xiLR), np.float64)
-    J22_LR = np.ones(np.shape(xiLR), np.float64)
-    J23_LR = np.zeros(np.shape(xiLR), np.float64)
-    J31_LR = np.zeros(np.shape(xiLR), np.float64)
-    J32_LR = np.zeros(np.shape(xiLR), np.float64)
-    J33_LR = np.ones(np.shape(xiLR), np.float64)
-
-    J11_UD = np.ones(np.shape(xiUD), np.float64)
-    J12_UD = np.zeros(np.shape(xiUD), np.float64)
-    J13_UD = np.zeros(np.shape(xiUD), np.float64)
-    J21_UD = np.zeros(np.shape(xiUD), np.float64)
-    J22_UD = np.ones(np.shape(xiUD), np.float64)
-    J23_UD = np.zeros(np.shape(xiUD), np.float64)
-    J31_UD = np.zeros(np.shape(xiUD), np.float64)
-    J32_UD = np.zeros(np.shape(xiUD), np.float64)
-    J33_UD = np.ones(np.shape(xiUD), np.float64)
-
-    J11_C = np.ones(np.shape(xiC), np.float64)
-    J12_C = np.zeros(np.shape(xiC), np.float64)
-    J13_C = np.zeros(np.shape(xiC), np.float64)
-    J21_C = np.zeros(np.shape(xiC), np.float64)
-    J22_C = np.ones(np.shape(xiC), np.float64)
-    J23_C = np.zeros(np.shape(xiC), np.float64)
-    J31_C = np.zeros(np.shape(xiC), np.float64)
-    J32_C = np.zeros(np.shape(xiC), np.float64)
-    J33_C = np.ones(np.shape(xiC), np.float64)
-
-    J11_N = np.ones(np.shape(xiN), np.float64)
-    J12_N = np.zeros(np.shape(xiN), np.float64)
-    J13_N = np.zeros(np.shape(xiN), np.float64)
-    J21_N = np.zeros(np.shape(xiN), np.float64)
-    J22_N = np.ones(np.shape(xiN), np.float64)
-    J23_N = np.zeros(np.shape(xiN), np.float64)
-    J31_N = np.zeros(np.shape(xiN), np.float64)
-    J32_N = np.zeros(np.shape(xiN), np.float64)
-    J33_N = np.ones(np.shape(xiN), np.float64)
-"""
-# INIT JACOBIAN DETERMINANT
+class Geom2D:
+    '''Jacobian block (J11, J12, J21, J22), Jacobian determinant (det = J) and
+    inverse Jacobian determinant (inv_det = j) on one grid type
+    '''
+    is_identity = False
 
-J_UD = np.ones(np.shape(xiUD), np.float64)
-J_LR = np.ones(np.shape(xiLR), np.float64)
-J_C = np.ones(np.shape(xiC), np.float64)
-J_N = np.ones(np.shape(xiN), np.float64)
+    def __init__(self, shape):
+        # one contiguous buffer, the components are views on it (filled by define_geometry)
+        self.buf = np.empty((6,) + tuple(shape), np.float64)
+        self.J11, self.J12, self.J21, self.J22, self.det, self.inv_det = self.buf
 
-# DEFINE INVERSE JACOBIAN MATRIX
-# defined on grid LR:        (j11, j21, j31)E1, J1
-#                            (j11, j21, j31)B1
-# defined on grid UD:        (j12, j22, j32)E2, J2
-#                            (j12, j22, j32)B2
-# defined on grid centres c: (j12, j23, j33)E3, J3
-# defined on grid nodes n:   (j12, j23, j33)B3
+    @property
+    def g11(self):
+        return self.J11**2 + self.J21**2
 
-"""
-j11_LR = np.zeros(np.shape(xiLR), np.float64)
-j12_LR = np.zeros(np.shape(xiLR), np.float64)
-j13_LR = np.zeros(np.shape(xiLR), np.float64)
-j21_LR = np.zeros(np.shape(xiLR), np.float64)
-j22_LR = np.zeros(np.shape(xiLR), np.float64)
-j23_LR = np.zeros(np.shape(xiLR), np.float64)
-j31_LR = np.zeros(np.shape(xiLR), np.float64)
-j32_LR = np.zeros(np.shape(xiLR), np.float64)
-j33_LR = np.zeros(np.shape(xiLR), np.float64)
-
-j11_UD = np.zeros(np.shape(xiUD), np.float64)
-j12_UD = np.zeros(np.shape(xiUD), np.float64)
-j13_UD = np.zeros(np.shape(xiUD), np.float64)
-j21_UD = np.zeros(np.shape(xiUD), np.float64)
-j22_UD = np.zeros(np.shape(xiUD), np.float64)
-j23_UD = np.zeros(np.shape(xiUD), np.float64)
-j31_UD = np.zeros(np.shape(xiUD), np.float64)
-j32_UD = np.zeros(np.shape(xiUD), np.float64)
-j33_UD = np.zeros(np.shape(xiUD), np.float64)
-
-j11_C = np.zeros(np.shape(xiC), np.float64)
-j12_C = np.zeros(np.shape(xiC), np.float64)
-j13_C = np.zeros(np.shape(xiC), np.float64)
-j21_C = np.zeros(np.shape(xiC), np.float64)
-j22_C = np.zeros(np.shape(xiC), np.float64)
-j23_C = np.zeros(np.shape(xiC), np.float64)
-j31_C = np.zeros(np.shape(xiC), np.float64)
-j32_C = np.zeros(np.shape(xiC), np.float64)
-j33_C = np.zeros(np.shape(xiC), np.float64)
-
-j11_N = np.zeros(np.shape(xiN), np.float64)
-j12_N = np.zeros(np.shape(xiN), np.float64)
-j13_N = np.zeros(np.shape(xiN), np.float64)
-j21_N = np.zeros(np.shape(xiN), np.float64)
-j22_N = np.zeros(np.shape(xiN), np.float64)
-j23_N = np.zeros(np.shape(xiN), np.float64)
-j31_N = np.zeros(np.shape(xiN), np.float64)
-j32_N = np.zeros(np.shape(xiN), np.float64)
-j33_N = np.zeros(np.shape(xiN), np.float64)
-"""
+    @property
+    def g12(self):
+        return self.J11 * self.J12 + self.J21 * self.J22
 
-j11_LR, j22_LR, j33_LR = (np.ones_like(xiLR) for i in range(3))
-j12_LR, j13_LR, j21_LR, j23_LR, j31_LR, j32_LR = (np.zeros_like(xiLR, np.float64) for i in range(6))
+    @property
+    def g22(self):
+        return self.J12**2 + self.J22**2
 
-j11_UD, j22_UD, j33_UD = (np.ones_like(xiUD) for i in range(3))
-j12_UD, j13_UD, j21_UD, j23_UD, j31_UD, j32_UD = (np.zeros_like(xiUD, np.float64) for i in range(6))
+    @property
+    def j11(self):
+        return self.J22 * self.inv_det
 
-j11_C, j22_C, j33_C = (np.ones_like(xiC) for i in range(3))
-j12_C, j13_C, j21_C, j23_C, j31_C, j32_C = (np.zeros_like(xiC, np.float64) for i in range(6))
+    @property
+    def j12(self):
+        return - self.J12 * self.inv_det
 
-j11_N, j22_N, j33_N = (np.ones_like(xiN) for i in range(3))
-j12_N, j13_N, j21_N, j23_N, j31_N, j32_N = (np.zeros_like(xiN, np.float64) for i in range(6))
+    @property
+    def j21(self):
+        return - self.J21 * self.inv_det
 
-# INIT IVERSE JACOBIAN DETERMINANT
+    @property
+    def j22(self):
+        return self.J11 * self.inv_det
 
-j_LR = np.ones(np.shape(xiLR), np.float64)
-j_UD = np.ones(np.shape(xiUD), np.float64)
-j_C = np.ones(np.shape(xiC), np.float64)
-j_N = np.ones(np.shape(xiN), np.float64)
+class IdentityGeom:
+    '''Cartesian geometry (perturb=False): constant components, no arrays;
+    the field operators skip the metric altogether when is_identity
+    '''
+    is_identity = True
+    J11 = J22 = det = inv_det = 1.
+    J12 = J21 = 0.
+    g11 = g22 = j11 = j22 = 1.
+    g12 = j12 = j21 = 0.
 
-# INIT METRIC TENSOR
-# defined on grid LR:        (g11, g21, g31)E1
-#                            (g11, g21, g31)B1
-# defined on grid UD:        (g12, g22, g32)E2
-#                            (g12, g22, g32)B2
-# defined on grid centres c: (g12, g23, g33)E3
-# defined on grid corners n: (g12, g23, g33)B3
+if perturb:
+    geomLR = Geom2D(np.shape(xiLR))
+    geomUD = Geom2D(np.shape(xiUD))
+    geomC = Geom2D(np.shape(xiC))
+    geomN = Geom2D(np.shape(xiN))
+else:
+    geomLR = geomUD = geomC = geomN = IdentityGeom()
 
-"""
-g11_LR = np.zeros(np.shape(xiLR), np.float64)
-g12_LR = np.zeros(np.shape(xiLR), np.float64)
-g13_LR = np.zeros(np.shape(xiLR), np.float64)
-g21_LR = np.zeros(np.shape(xiLR), np.float64)
-g22_LR = np.zeros(np.shape(xiLR), np.float64)
-g23_LR = np.zeros(np.shape(xiLR), np.float64)
-g31_LR = np.zeros(np.shape(xiLR), np.float64)
-g32_LR = np.zeros(np.shape(xiLR), np.float64)
-g33_LR = np.zeros(np.shape(xiLR), np.float64)
-
-g11_UD = np.zeros(np.shape(xiUD), np.float64)
-g12_UD = np.zeros(np.shape(xiUD), np.float64)
-g13_UD = np.zeros(np.shape(xiUD), np.float64)
-g21_UD = np.zeros(np.shape(xiUD), np.float64)
-g22_UD = np.zeros(np.shape(xiUD), np.float64)
-g23_UD = np.zeros(np.shape(xiUD), np.float64)
-g31_UD = np.zeros(np.shape(xiUD), np.float64)
-g32_UD = np.zeros(np.shape(xiUD), np.float64)
-g33_UD = np.zeros(np.shape(xiUD), np.float64)
-
-g11_C = np.zeros(np.shape(xiC), np.float64)
-g12_C = np.zeros(np.shape(xiC), np.float64)
-g13_C = np.zeros(np.shape(xiC), np.float64)
-g21_C = np.zeros(np.shape(xiC), np.float64)
-g22_C = np.zeros(np.shape(xiC), np.float64)
-g23_C = np.zeros(np.shape(xiC), np.float64)
-g31_C = np.zeros(np.shape(xiC), np.float64)
-g32_C = np.zeros(np.shape(xiC), np.float64)
-g33_C = np.zeros(np.shape(xiC), np.float64)
-
-g11_N = np.zeros(np.shape(xiN), np.float64)
-g12_N = np.zeros(np.shape(xiN), np.float64)
-g13_N = np.zeros(np.shape(xiN), np.float64)
-g21_N = np.zeros(np.shape(xiN), np.float64)
-g22_N = np.zeros(np.shape(xiN), np.float64)
-g23_N = np.zeros(np.shape(xiN), np.float64)
-g31_N = np.zeros(np.shape(xiN), np.float64)
-g32_N = np.zeros(np.shape(xiN), np.float64)
-g33_N = np.zeros(np.shape(xiN), np.float64)
-"""
+# Divergence (the remaining diagnostics are nt long)
+# defined on grid c: divE, divE_rho
+# defined on grid n: divB
+divE, divE_rho, divB = (diag[:nt, i] for i in range(6, 9))
 
-g11_LR, g22_LR, g33_LR = (np.ones_like(xiLR) for i in range(3))
-g12_LR, g13_LR, g21_LR, g23_LR, g31_LR, g32_LR = (np.zeros_like(xiLR, np.float64) for i in range(6))
-
-g11_UD, g22_UD, g33_UD = (np.ones_like(xiUD) for i in range(3))
-g12_UD, g13_UD, g21_UD, g23_UD, g31_UD, g32_UD = (np.zeros_like(xiUD, np.float64) for i in range(6))
-
-g11_C, g22_C, g33_C = (np.ones_like(xiC) for i in range(3))
-g12_C, g13_C, g21_C, g23_C, g31_C, g32_C = (np.zeros_like(xiC, np.float64) for i in range(6))
-
-g11_N, g22_N, g33_N = (np.ones_like(xiN) for i in range(3))
-g12_N, g13_N, g21_N, g23_N, g31_N, g32_N = (np.zeros_like(xiN, np.float64) for i in range(6))
-
-# Divergence
-# defined on grid c:
-divE = zeros(nt, np.float64)
-divE_rho = zeros(nt, np.float64)
-# defined on grid n: 
-divB = zeros(nt, np.float64)
-
-# Energy
-energyP = zeros(nt, np.float64) # particles
-energyP1 = zeros(nt, np.float64) # particles1
-energyP2 = zeros(nt, np.float64) # particles2
-energyE = zeros(nt, np.float64) # Total E
-energyE1 = zeros(nt, np.float64) # E1 field
-energyE2 = zeros(nt, np.float64) # E2 field
-energyE3 = zeros(nt, np.float64) # E3 field
-energyB = zeros(nt, np.float64) # B field
-energyB1 = zeros(nt, np.float64) # B1 field
-energyB2 = zeros(nt, np.float64) # B2 field
-energyB3 = zeros(nt, np.float64) # B3 field
-energyTot = zeros(nt, np.float64) # B field
-momentumTot = zeros(nt, np.float64) # Total momentum
+# Energy: particles (P, P1, P2), E field (E, E1, E2, E3), B field (B, B1, B2, B3), total
+energyP, energyP1, energyP2, energyE, energyE1, energyE2, energyE3, \
+energyB, energyB1, energyB2, energyB3, energyTot, momentumTot = (diag[:nt, i] for i in range(9, 22))
 
 if log_file == True:
-    f = open(PATH1 + 'log_file.txt', 'w')
-    print('* METRIC:', file=f)
-    print('- perturbation: ', perturb, file=f)
-    print('* METHOD:', file=f)
-    print('- NK method: ', NK_method, file=f)
-    print('- Picard iteration: ', Picard, file=f)
-    print('* PHYSICS:', file=f)
-    print('- perturbation amplitude B0 (if nppc=0): ', B0, file=f)
-    print('- mode of oscillation (if nppc=0): ', n, file=f)
-    print('- stable plasma: ', stable_plasma, file=f)
-    print('- electrons & ions: ', electron_and_ion, file=f)
-    print('- counter stream inst.: ', couter_stream_inst, file=f)
-    print('- landau damping: ', landau_damping, file=f)
-    print('- relativistic: ', relativistic, file=f)
-    print('* PARAMETER:', file=f)
-    print('- number nodes (x-axes): ', nx, file=f)
-    print('- number nodes (y-axes): ', ny, file=f)
-    print('- length of the domain (x-axes): ', Lx, file=f)
-    print('- length of the domain (y-axes): ', Ly, file=f)
-    print('- time steps: ', dt, file=f)
-    print('- number of time steps: ', nt, file=f)
-    print('- number of part. per cell: ', nppc, file=f) 
-    print('* SPECIES 1:', file=f)
-    print('- number of particles : ', npart1, file=f)
-    print('- plasma frequency : ', WP1, file=f)
-    print('- charge to mass : ', QM1, file=f)
-    print('- velocity field: ', '(', V0x1, ',', V0y1, ',', V0z1, ')', file=f)
-    print('- thermal velocity: ', VT1, file=f)
-    print('* SPECIES 2:', file=f)
-    print('- number of particles : ', npart2, file=f)
-    print('- plasma frequency : ', WP2, file=f)
-    print('- charge to mass : ', QM2, file=f)
-    print('- velocity field: ', '(', V0x2, ',', V0y2, ',', V0z2, ')', file=f)
-    print('- thermal velocity: ', VT2, file=f)
-    f.close()
+    with open(PATH1 + 'log_file.txt', 'w') as f:
+        f.write(f"""* METRIC:
+- perturbation:  {perturb}
+* METHOD:
+- NK method:  {NK_method}
+- Picard iteration:  {Picard}
+* PHYSICS:
+- perturbation amplitude B0 (if nppc=0):  {B0}
+- mode of oscillation (if nppc=0):  {n}
+- stable plasma:  {stable_plasma}
+- electrons & ions:  {electron_and_ion}
+- counter stream inst.:  {couter_stream_inst}
+- landau damping:  {landau_damping}
+- relativistic:  {relativistic}
+* PARAMETER:
+- number nodes (x-axes):  {nx}
+- number nodes (y-axes):  {ny}
+- length of the domain (x-axes):  {Lx}
+- length of the domain (y-axes):  {Ly}
+- time steps:  {dt}
+- number of time steps:  {nt}
+- number of part. per cell:  {nppc}
+* SPECIES 1:
+- number of particles :  {npart1}
+- plasma frequency :  {WP1}
+- charge to mass :  {QM1}
+- velocity field:  ( {V0x1} , {V0y1} , {V0z1} )
+- thermal velocity:  {VT1}
+* SPECIES 2:
+- number of particles :  {npart2}
+- plasma frequency :  {WP2}
+- charge to mass :  {QM2}
+- velocity field:  ( {V0x2} , {V0y2} , {V0z2} )
+- thermal velocity:  {VT2}
+""")
+
+figures = {}
+
+def reuse_figure(kind, figsize=None):
+    '''
+    To get one figure per plot kind, cleared and made current, instead of a new figure per plot.
+    '''
+    if kind not in figures:
+        figures[kind] = plt.figure(figsize=figsize)
+    fig = figures[kind]
+    plt.figure(fig.number)
+    fig.clf()
+    return fig
 
 def myplot_map(xgrid, ygrid, field, title='a', xlabel='b', ylabel='c'):
     '''
     To plot the map of a vector fied over a grid.
     '''
-    plt.figure()
-    plt.pcolor(xgrid, ygrid, field)
+    reuse_figure('map')
+    plt.pcolormesh(xgrid, ygrid, field)
     plt.title(title)
     plt.xlabel(xlabel)
     plt.ylabel(ylabel)
     plt.colorbar()
 
-def myplot_func(field, title= 'a', xlabel= 'b', ylabel= 'c'):
+def myplot_func(field, title= 'a', xlabel= 'b', ylabel= 'c', t=None):
     '''
     To plot the behavior of a scalar fied in time.
+    t (optional) are the cycles of the values in field (default: all of them)
     '''
-    plt.figure()
-    plt.plot(field)
+    reuse_figure('func')
+    if t is None:
+        plt.plot(field)
+    else:
+        plt.plot(t, field)
     plt.title(title)
     plt.xlabel(xlabel)
     plt.ylabel(ylabel)
@@ -513,7 +428,7 @@ def myplot_particle_map(posx, posy):
     '''
     To plot particles position over the domain.
     '''
-    plt.figure()
+    reuse_figure('particle_map')
     plt.plot(posx[0:npart1],posy[0:npart1],'b.')
     plt.plot(posx[npart1:npart],posy[npart1:npart],'r.')
     plt.xlim((0,Lx))
@@ -525,7 +440,7 @@ def myplot_particle_map(posx, posy):
 def myplot_phase_space(pos, vel, limx=(0, 0), limy=(0, 0), xlabel='b', ylabel='c'):
     '''To plot the phase space in one direction
     '''
-    plt.figure()
+    reuse_figure('phase_space')
     plt.plot(pos[0:npart1], vel[0:npart1], 'b.')
     plt.plot(pos[npart1:npart], vel[npart1:npart], 'r.')
     plt.xlim(limx)
@@ -535,426 +450,697 @@ def myplot_phase_space(pos, vel, limx=(0, 0), limy=(0, 0), xlabel='b', ylabel='c
     plt.ylabel(ylabel)
 
 def perturbed_inverse_jacobian_elements(x, y):
-    j11 = 1. + 2. * np.pi * eps * np.cos(2. * np.pi * x / Lx) * np.sin(2. * np.pi * y / Ly) / Lx
-    j12 = 2. * np.pi * eps * np.sin(2. * np.pi * x / Lx) * np.cos(2. * np.pi * y / Ly) / Ly
+    kx, ky = 2. * np.pi / Lx, 2. * np.pi / Ly
+    if numexpr_available:
+        # one fused (multithreaded) pass per trig product, no temporaries
+        cxsy = ne.evaluate('cos(kx * x) * sin(ky * y)', local_dict={'kx': kx, 'ky': ky, 'x': x, 'y': y})
+        sxcy = ne.evaluate('sin(kx * x) * cos(ky * y)', local_dict={'kx': kx, 'ky': ky, 'x': x, 'y': y})
+    else:
+        cxsy = np.cos(kx * x) * np.sin(ky * y)
+        sxcy = np.sin(kx * x) * np.cos(ky * y)
+    j11 = 1. + eps * kx * cxsy
+    j12 = eps * ky * sxcy
     j13 = np.zeros(np.shape(x), np.float64)
-    j21 = 2. * np.pi * eps * np.cos(2. * np.pi * x / Lx) * np.sin(2. * np.pi * y / Ly) / Lx
-    j22 = 1. + 2. * np.pi * eps * np.sin(2. * np.pi * x / Lx) * np.cos(2. * np.pi * y / Ly) / Ly
+    j21 = eps * kx * cxsy
+    j22 = 1. + eps * ky * sxcy
     j23 = np.zeros(np.shape(x), np.float64)
     j31 = np.zeros(np.shape(x), np.float64)
     j32 = np.zeros(np.shape(x), np.float64)
     j33 = np.ones(np.shape(x), np.float64)
     return j11, j12, j13, j21, j22, j23, j31, j32, j33
 
+def forward_jacobian_elements(j11, j12, j21, j22):
+    '''Closed-form inverse of the upper 2x2 block of the inverse Jacobian (zeta is not perturbed)
+    '''
+    det = j11 * j22 - j12 * j21
+    return j22 / det, - j12 / det, - j21 / det, j11 / det, det
+
+@njit(cache=True, fastmath=True, parallel=True)
+def build_geom(x, y, Lx, Ly, eps, out):
+    '''Fused numba version of perturbed_inverse_jacobian_elements + forward_jacobian_elements on one grid,
+    out = (J11, J12, J21, J22, det, inv_det) is the Geom2D buffer
+    '''
+    kx, ky = 2. * np.pi / Lx, 2. * np.pi / Ly
+    for i in prange(x.shape[0]):
+      for j in range(x.shape[1]):
+        sx, cx = np.sin(kx * x[i,j]), np.cos(kx * x[i,j])
+        sy, cy = np.sin(ky * y[i,j]), np.cos(ky * y[i,j])
+        j11 = 1. + eps * kx * cx * sy
+        j12 = eps * ky * sx * cy
+        j21 = eps * kx * cx * sy
+        j22 = 1. + eps * ky * sx * cy
+        d = j11 * j22 - j12 * j21
+        out[0,i,j] = j22 / d
+        out[1,i,j] = - j12 / d
+        out[2,i,j] = - j21 / d
+        out[3,i,j] = j11 / d
+        out[4,i,j] = 1. / d
+        out[5,i,j] = d
+
+def build_geom_block(geom, x, y):
+    '''Geometry of one grid type: the same compiled kernel (or numpy expressions) serves LR, UD, C and N
+    '''
+    if numba_available:
+        build_geom(x, y, Lx, Ly, eps, geom.buf)
+    else:
+        j11, j12, j13, j21, j22, j23, j31, j32, j33 = perturbed_inverse_jacobian_elements(x, y)
+        geom.J11[...], geom.J12[...], geom.J21[...], geom.J22[...], geom.inv_det[...] = forward_jacobian_elements(j11, j12, j21, j22)
+        geom.det[...] = 1. / geom.inv_det
+
 def define_geometry():
     '''To construct the structure of the general geometry (for each grid type):
+    - Get the inverse Jacobian matrix and its determinant
     - Get the Jacobian matrix and its determinant
-    - Get the inverse Jacobian matrix isolate the components and calculate its determinant
-    - Get the metric tensor components
     '''
-    for i in range(np.shape(xiLR)[0]):
-        for j in range(np.shape(xiLR)[1]):
-            j11_LR[i, j], j12_LR[i, j], j13_LR[i, j], j21_LR[i, j], j22_LR[i, j], j23_LR[i, j], j31_LR[i, j], j32_LR[i, j], j33_LR[i, j] = perturbed_inverse_jacobian_elements(xLR[i,j], yLR[i, j])
-            inverse_jacobian_LR = np.array([[j11_LR[i, j], j12_LR[i, j], j13_LR[i, j]], [j21_LR[i, j], j22_LR[i, j], j23_LR[i, j]], [j31_LR[i, j], j32_LR[i, j], j33_LR[i, j]]])
-            jacobian_LR = np.linalg.inv(inverse_jacobian_LR)
-            j_LR[i, j] = np.linalg.det(inverse_jacobian_LR)
-            J_LR[i, j] = np.linalg.det(jacobian_LR)
-            J11_LR[i, j] = jacobian_LR[0, 0]
-            J21_LR[i, j] = jacobian_LR[1, 0]
-            J31_LR[i, j] = jacobian_LR[2, 0]
-            J12_LR[i, j] = jacobian_LR[0, 1]
-            J22_LR[i, j] = jacobian_LR[1, 1]
-            J32_LR[i, j] = jacobian_LR[2, 1]
-            J13_LR[i, j] = jacobian_LR[0, 2]
-            J23_LR[i, j] = jacobian_LR[1, 2]
-            J33_LR[i, j] = jacobian_LR[2, 2]
-            g11_LR[i, j] = jacobian_LR[0, 0] * jacobian_LR[0, 0] + jacobian_LR[1, 0] * jacobian_LR[1, 0] + jacobian_LR[2, 0] * jacobian_LR[2, 0]
-            g21_LR[i, j] = jacobian_LR[0, 0] * jacobian_LR[0, 1] + jacobian_LR[1, 0] * jacobian_LR[1, 1] + jacobian_LR[2, 0] * jacobian_LR[2, 1]
-            g31_LR[i, j] = jacobian_LR[0, 0] * jacobian_LR[0, 2] + jacobian_LR[1, 0] * jacobian_LR[1, 2] + jacobian_LR[2, 0] * jacobian_LR[2, 2]
-            g12_LR[i, j] = jacobian_LR[0, 0] * jacobian_LR[0, 1] + jacobian_LR[1, 0] * jacobian_LR[1, 1] + jacobian_LR[2, 0] * jacobian_LR[2, 1]
-            g22_LR[i, j] = jacobian_LR[0, 1] * jacobian_LR[0, 1] + jacobian_LR[1, 1] * jacobian_LR[1, 1] + jacobian_LR[2, 1] * jacobian_LR[2, 1]
-            g32_LR[i, j] = jacobian_LR[0, 1] * jacobian_LR[0, 2] + jacobian_LR[1, 1] * jacobian_LR[1, 2] + jacobian_LR[2, 1] * jacobian_LR[2, 2]
-            g13_LR[i, j] = jacobian_LR[0, 0] * jacobian_LR[0, 2] + jacobian_LR[1, 0] * jacobian_LR[1, 2] + jacobian_LR[2, 0] * jacobian_LR[2, 2]
-            g23_LR[i, j] = jacobian_LR[0, 1] * jacobian_LR[0, 2] + jacobian_LR[1, 1] * jacobian_LR[1, 2] + jacobian_LR[2, 1] * jacobian_LR[2, 2]
-            g33_LR[i, j] = jacobian_LR[0, 2] * jacobian_LR[0, 2] + jacobian_LR[1, 2] * jacobian_LR[1, 2] + jacobian_LR[2, 2] * jacobian_LR[2, 2]
-
-    for i in range(np.shape(xiUD)[0]):
-        for j in range(np.shape(xiUD)[1]):
-            j11_UD[i, j], j12_UD[i, j], j13_UD[i, j], j21_UD[i, j], j22_UD[i, j], j23_UD[i, j], j31_UD[i, j], j32_UD[i, j], j33_UD[i, j] = perturbed_inverse_jacobian_elements(xUD[i, j], yUD[i, j])
-            inverse_jacobian_UD = np.array([[j11_UD[i, j], j12_UD[i, j], j13_UD[i, j]], [j21_UD[i, j], j22_UD[i, j], j23_UD[i, j]],[j31_UD[i, j], j32_UD[i, j], j33_UD[i, j]]])
-            jacobian_UD = np.linalg.inv(inverse_jacobian_UD)
-            j_UD[i, j] = np.linalg.det(inverse_jacobian_UD)
-            J_UD[i, j] = np.linalg.det(jacobian_UD)
-            J11_UD[i, j] = jacobian_UD[0, 0]
-            J21_UD[i, j] = jacobian_UD[1, 0]
-            J31_UD[i, j] = jacobian_UD[2, 0]
-            J12_UD[i, j] = jacobian_UD[0, 1]
-            J22_UD[i, j] = jacobian_UD[1, 1]
-            J32_UD[i, j] = jacobian_UD[2, 1]
-            J13_UD[i, j] = jacobian_UD[0, 2]
-            J23_UD[i, j] = jacobian_UD[1, 2]
-            J33_UD[i, j] = jacobian_UD[2, 2]
-            g11_UD[i, j] = jacobian_UD[0, 0] * jacobian_UD[0, 0] + jacobian_UD[1, 0] * jacobian_UD[1, 0] + jacobian_UD[2, 0] * jacobian_UD[2, 0]
-            g21_UD[i, j] = jacobian_UD[0, 0] * jacobian_UD[0, 1] + jacobian_UD[1, 0] * jacobian_UD[1, 1] + jacobian_UD[2, 0] * jacobian_UD[2, 1]
-            g31_UD[i, j] = jacobian_UD[0, 0] * jacobian_UD[0, 2] + jacobian_UD[1, 0] * jacobian_UD[1, 2] + jacobian_UD[2, 0] * jacobian_UD[2, 2]
-            g12_UD[i, j] = jacobian_UD[0, 0] * jacobian_UD[0, 1] + jacobian_UD[1, 0] * jacobian_UD[1, 1] + jacobian_UD[2, 0] * jacobian_UD[2, 1]
-            g22_UD[i, j] = jacobian_UD[0, 1] * jacobian_UD[0, 1] + jacobian_UD[1, 1] * jacobian_UD[1, 1] + jacobian_UD[2, 1] * jacobian_UD[2, 1]
-            g32_UD[i, j] = jacobian_UD[0, 1] * jacobian_UD[0, 2] + jacobian_UD[1, 1] * jacobian_UD[1, 2] + jacobian_UD[2, 1] * jacobian_UD[2, 2]
-            g13_UD[i, j] = jacobian_UD[0, 0] * jacobian_UD[0, 2] + jacobian_UD[1, 0] * jacobian_UD[1, 2] + jacobian_UD[2, 0] * jacobian_UD[2, 2]
-            g23_UD[i, j] = jacobian_UD[0, 1] * jacobian_UD[0, 2] + jacobian_UD[1, 1] * jacobian_UD[1, 2] + jacobian_UD[2, 1] * jacobian_UD[2, 2]
-            g33_UD[i, j] = jacobian_UD[0, 2] * jacobian_UD[0, 2] + jacobian_UD[1, 2] * jacobian_UD[1, 2] + jacobian_UD[2, 2] * jacobian_UD[2, 2]
-
-    for i in range(np.shape(xiC)[0]):
-        for j in range(np.shape(xiC)[1]):
-            j11_C[i, j], j12_C[i, j], j13_C[i, j], j21_C[i, j], j22_C[i, j], j23_C[i, j], j31_C[i, j], j32_C[i, j], j33_C[i, j] = perturbed_inverse_jacobian_elements(xC[i, j], yC[i, j])
-            inverse_jacobian_C = np.array([[j11_C[i, j], j12_C[i, j], j13_C[i, j]], [j21_C[i, j], j22_C[i, j], j23_C[i, j]],[j31_C[i, j], j32_C[i, j], j33_C[i, j]]])
-            jacobian_C = np.linalg.inv(inverse_jacobian_C)
-            j_C[i, j] = np.linalg.det(inverse_jacobian_C)
-            J_C[i, j] = np.linalg.det(jacobian_C)
-            J11_C[i, j] = jacobian_C[0, 0]
-            J21_C[i, j] = jacobian_C[1, 0]
-            J31_C[i, j] = jacobian_C[2, 0]
-            J12_C[i, j] = jacobian_C[0, 1]
-            J22_C[i, j] = jacobian_C[1, 1]
-            J32_C[i, j] = jacobian_C[2, 1]
-            J13_C[i, j] = jacobian_C[0, 2]
-            J23_C[i, j] = jacobian_C[1, 2]
-            J33_C[i, j] = jacobian_C[2, 2]
-            g11_C[i, j] = jacobian_C[0, 0] * jacobian_C[0, 0] + jacobian_C[1, 0] * jacobian_C[1, 0] + jacobian_C[2, 0] * jacobian_C[2, 0]
-            g21_C[i, j] = jacobian_C[0, 0] * jacobian_C[0, 1] + jacobian_C[1, 0] * jacobian_C[1, 1] + jacobian_C[2, 0] * jacobian_C[2, 1]
-            g31_C[i, j] = jacobian_C[0, 0] * jacobian_C[0, 2] + jacobian_C[1, 0] * jacobian_C[1, 2] + jacobian_C[2, 0] * jacobian_C[2, 2]
-            g12_C[i, j] = jacobian_C[0, 0] * jacobian_C[0, 1] + jacobian_C[1, 0] * jacobian_C[1, 1] + jacobian_C[2, 0] * jacobian_C[2, 1]
-            g22_C[i, j] = jacobian_C[0, 1] * jacobian_C[0, 1] + jacobian_C[1, 1] * jacobian_C[1, 1] + jacobian_C[2, 1] * jacobian_C[2, 1]
-            g32_C[i, j] = jacobian_C[0, 1] * jacobian_C[0, 2] + jacobian_C[1, 1] * jacobian_C[1, 2] + jacobian_C[2, 1] * jacobian_C[2, 2]
-            g13_C[i, j] = jacobian_C[0, 0] * jacobian_C[0, 2] + jacobian_C[1, 0] * jacobian_C[1, 2] + jacobian_C[2, 0] * jacobian_C[2, 2]
-            g23_C[i, j] = jacobian_C[0, 1] * jacobian_C[0, 2] + jacobian_C[1, 1] * jacobian_C[1, 2] + jacobian_C[2, 1] * jacobian_C[2, 2]
-            g33_C[i, j] = jacobian_C[0, 2] * jacobian_C[0, 2] + jacobian_C[1, 2] * jacobian_C[1, 2] + jacobian_C[2, 2] * jacobian_C[2, 2]
-
-    for i in range(np.shape(xiN)[0]):
-        for j in range(np.shape(xiN)[1]):
-            j11_N[i, j], j12_N[i, j], j13_N[i, j], j21_N[i, j], j22_N[i, j], j23_N[i, j], j31_N[i, j], j32_N[i, j], j33_N[i, j] = perturbed_inverse_jacobian_elements(xN[i, j], yN[i, j])
-            inverse_jacobian_N = np.array([[j11_N[i, j], j12_N[i, j], j13_N[i, j]], [j21_N[i, j], j22_N[i, j], j23_N[i, j]],[j31_N[i, j], j32_N[i, j], j33_N[i, j]]])
-            jacobian_N = np.linalg.inv(inverse_jacobian_N)
-            j_N[i, j] = np.linalg.det(inverse_jacobian_N)
-            J_N[i, j] = np.linalg.det(jacobian_N)
-            J11_N[i, j] = jacobian_N[0, 0]
-            J21_N[i, j] = jacobian_N[1, 0]
-            J31_N[i, j] = jacobian_N[2, 0]
-            J12_N[i, j] = jacobian_N[0, 1]
-            J22_N[i, j] = jacobian_N[1, 1]
-            J32_N[i, j] = jacobian_N[2, 1]
-            J13_N[i, j] = jacobian_N[0, 2]
-            J23_N[i, j] = jacobian_N[1, 2]
-            J33_N[i, j] = jacobian_N[2, 2]
-            g11_N[i, j] = jacobian_N[0, 0] * jacobian_N[0, 0] + jacobian_N[1, 0] * jacobian_N[1, 0] + jacobian_N[2, 0] * jacobian_N[2, 0]
-            g21_N[i, j] = jacobian_N[0, 0] * jacobian_N[0, 1] + jacobian_N[1, 0] * jacobian_N[1, 1] + jacobian_N[2, 0] * jacobian_N[2, 1]
-            g31_N[i, j] = jacobian_N[0, 0] * jacobian_N[0, 2] + jacobian_N[1, 0] * jacobian_N[1, 2] + jacobian_N[2, 0] * jacobian_N[2, 2]
-            g12_N[i, j] = jacobian_N[0, 0] * jacobian_N[0, 1] + jacobian_N[1, 0] * jacobian_N[1, 1] + jacobian_N[2, 0] * jacobian_N[2, 1]
-            g22_N[i, j] = jacobian_N[0, 1] * jacobian_N[0, 1] + jacobian_N[1, 1] * jacobian_N[1, 1] + jacobian_N[2, 1] * jacobian_N[2, 1]
-            g32_N[i, j] = jacobian_N[0, 1] * jacobian_N[0, 2] + jacobian_N[1, 1] * jacobian_N[1, 2] + jacobian_N[2, 1] * jacobian_N[2, 2]
-            g13_N[i, j] = jacobian_N[0, 0] * jacobian_N[0, 2] + jacobian_N[1, 0] * jacobian_N[1, 2] + jacobian_N[2, 0] * jacobian_N[2, 2]
-            g23_N[i, j] = jacobian_N[0, 1] * jacobian_N[0, 2] + jacobian_N[1, 1] * jacobian_N[1, 2] + jacobian_N[2, 1] * jacobian_N[2, 2]
-            g33_N[i, j] = jacobian_N[0, 2] * jacobian_N[0, 2] + jacobian_N[1, 2] * jacobian_N[1, 2] + jacobian_N[2, 2] * jacobian_N[2, 2]
-
-def cartesian_to_general(cartx, carty, cartz, fieldtype):
+    for geom, x, y in ((geomLR, xLR, yLR), (geomUD, xUD, yUD), (geomC, xC, yC), (geomN, xN, yN)):
+        build_geom_block(geom, x, y)
+
+def cross_avg(fieldx, fieldy, fieldtype):
+    ''' To average each in-plane component on the grid of the other one, through the centres
+    fieltype=='E' or 'J': input -> LR,UD, output -> fieldy on LR, fieldx on UD
+    fieltype=='B':        input -> UD,LR, output -> fieldy on UD, fieldx on LR
+    '''
+    if fieldtype == 'B':
+        return avg(avg(fieldy, 'LR2C'), 'C2UD'), avg(avg(fieldx, 'UD2C'), 'C2LR')
+    return avg(avg(fieldy, 'UD2C'), 'C2LR'), avg(avg(fieldx, 'LR2C'), 'C2UD')
+
+def cartesian_to_general(cartx, carty, cartz, fieldtype, cross=None):
     ''' To convert fields from Cartesian coord. (x, y, z) to General Skew coord. (xi, eta, zeta)
     fieltype=='E' or 'J': input -> LR,UD,c, output -> LR,UD,c
     fieltype=='B':        input -> UD,LR,n, output -> UD,LR,n
+    cross (optional) is cross_avg(cartx, carty, fieldtype) when already available
     '''
+    if geomLR.is_identity:
+        return cartx.copy(), carty.copy(), cartz.copy()
+    if cross is None:
+        cross = cross_avg(cartx, carty, fieldtype)
     if (fieldtype == 'E') or (fieldtype == 'J'):
-        carty_LR = avg(avg(carty, 'UD2C'), 'C2LR')
-        cartz_LR = avg(cartz, 'C2LR')
-        cartx_UD = avg(avg(cartx, 'LR2C'), 'C2UD')
-        cartz_UD = avg(cartz, 'C2UD')
-        cartx_C = avg(cartx, 'LR2C')
-        carty_C = avg(carty, 'UD2C')
-        genx1 = J11_LR * cartx    + J12_LR * carty_LR + J13_LR * cartz_LR
-        genx2 = J21_UD * cartx_UD + J22_UD * carty    + J23_UD * cartz_UD
-        genx3 = J31_C  * cartx_C  + J32_C  * carty_C  + J33_C  * cartz
+        carty_LR, cartx_UD = cross
+        genx1 = geomLR.J11 * cartx    + geomLR.J12 * carty_LR
+        genx2 = geomUD.J21 * cartx_UD + geomUD.J22 * carty
     elif fieldtype == 'B':
-        carty_UD = avg(avg(carty, 'LR2C'), 'C2UD')
-        cartz_UD = avg(cartz, 'N2UD')
-        cartx_LR = avg(avg(cartx, 'UD2C'), 'C2LR')
-        cartz_LR = avg(cartz, 'N2LR')
-        cartx_N = avg(cartx, 'UD2N')
-        carty_N = avg(carty, 'LR2N')
-        genx1 = J11_UD * cartx    + J12_UD * carty_UD + J13_UD * cartz_UD
-        genx2 = J21_LR * cartx_LR + J22_LR * carty    + J23_LR * cartz_LR
-        genx3 = J31_N  * cartx_N  + J32_N  * carty_N  + J33_N  * cartz
+        carty_UD, cartx_LR = cross
+        genx1 = geomUD.J11 * cartx    + geomUD.J12 * carty_UD
+        genx2 = geomLR.J21 * cartx_LR + geomLR.J22 * carty
+    genx3 = cartz.copy()
     
     return genx1, genx2, genx3
 
-def general_to_cartesian(genx1, genx2, genx3, fieldtype):
+def general_to_cartesian(genx1, genx2, genx3, fieldtype, cross=None):
     ''' To convert fields from General coord. (xi, eta, zeta) to Cartesian coord (x, y, z)
     fieltype=='E' or 'J': input -> LR,UD,c, output -> LR,UD,c
     fieltype=='B':        input -> UD,LR,n, output -> UD,LR,n
+    cross (optional) is cross_avg(genx1, genx2, fieldtype) when already available
     '''
+    if geomLR.is_identity:
+        return genx1.copy(), genx2.copy(), genx3.copy()
+    if cross is None:
+        cross = cross_avg(genx1, genx2, fieldtype)
     if (fieldtype == 'E') or (fieldtype == 'J'):
-        genx2_LR = avg(avg(genx2, 'UD2C'), 'C2LR')
-        genx3_LR = avg(genx3, 'C2LR')
-        genx1_UD = avg(avg(genx1, 'LR2C'), 'C2UD')
-        genx3_UD = avg(genx3, 'C2UD')
-        genx1_C = avg(genx1, 'LR2C')
-        genx2_C = avg(genx2, 'UD2C')
-        cartx = j11_LR * genx1 + j12_LR * genx2_LR + j13_LR * genx3_LR
-        carty = j21_UD * genx1_UD + j22_UD * genx2 + j23_UD * genx3_UD
-        cartz = j31_C * genx1_C + j32_C * genx2_C + j33_C * genx3
+        genx2_LR, genx1_UD = cross
+        cartx = geomLR.j11 * genx1 + geomLR.j12 * genx2_LR
+        carty = geomUD.j21 * genx1_UD + geomUD.j22 * genx2
     elif fieldtype == 'B':
-        genx2_UD = avg(avg(genx2, 'LR2C'), 'C2UD')
-        genx3_UD = avg(genx3, 'N2UD')
-        genx1_LR = avg(avg(genx1, 'UD2C'), 'C2LR')
-        genx3_LR = avg(genx3, 'N2LR')
-        genx1_N = avg(genx1, 'UD2N')
-        genx2_N = avg(genx2, 'LR2N')
-        cartx = j11_UD * genx1 + j12_UD * genx2_UD + j13_UD * genx3_UD
-        carty = j21_LR * genx1_LR + j22_LR * genx2 + j23_LR * genx3_LR
-        cartz = j31_N * genx1_N + j32_N * genx2_N + j33_N * genx3
+        genx2_UD, genx1_LR = cross
+        cartx = geomUD.j11 * genx1 + geomUD.j12 * genx2_UD
+        carty = geomLR.j21 * genx1_LR + geomLR.j22 * genx2
+    cartz = genx3.copy()
     
     return cartx, carty, cartz
 
-def cartesian_to_general_particle(cartx, carty):
+@njit(cache=True, fastmath=True, parallel=True)
+def cartesian_to_general_particle_nb(cartx, carty, Lx, Ly, eps, genx1, genx2):
+    for i in prange(cartx.shape[0]):
+      shift = eps*math.sin(2*np.pi*cartx[i]/Lx)*math.sin(2*np.pi*carty[i]/Ly)
+      genx1[i] = cartx[i] + shift
+      genx2[i] = carty[i] + shift
+
+def cartesian_to_general_particle(cartx, carty, out=None):
     '''To convert the particles position from Cartesian geom. to General geom.
+    out (optional) is a preallocated (genx1, genx2) pair to be overwritten
     '''
-    genx1 = cartx + eps*np.sin(2*np.pi*cartx/Lx)*np.sin(2*np.pi*carty/Ly)
-    genx2 = carty + eps*np.sin(2*np.pi*cartx/Lx)*np.sin(2*np.pi*carty/Ly)
+    genx1, genx2 = (np.empty_like(cartx), np.empty_like(carty)) if out is None else out
+    if numba_available:
+        cartesian_to_general_particle_nb(cartx, carty, Lx, Ly, eps, genx1, genx2)
+        return genx1, genx2
 
-    return genx1, genx2
+    shift = eps*np.sin(2*np.pi*cartx/Lx)*np.sin(2*np.pi*carty/Ly)
+    np.add(cartx, shift, out=genx1)
+    np.add(carty, shift, out=genx2)
 
-def diff_for_inversion(param, target):
-    xi, eta = cartesian_to_general_particle(param[0], param[1])
-    return (xi - target[0]) ** 2 + (eta - target[1]) ** 2
+    return genx1, genx2
 
-def cart_grid_calculator(xi, eta):
+def cart_grid_calculator(xi, eta, tol=1e-14, maxiter=50):
+    '''To invert the map (x, y) -> (xi, eta) on a whole grid: Newton iterations on all the
+    points at once, the 2x2 Jacobian of the map is the perturbed inverse Jacobian
+    '''
     if xi.shape != eta.shape:
         raise ValueError
-    x = np.zeros_like(xi)
-    y = np.zeros_like(eta)
-
-    init0 = xi.copy()
-    init1 = eta.copy()
-
-    init = np.stack((init0, init1), axis=-1)
-    target = np.stack((xi, eta), axis=-1)
-
-    bnds = ((None, None), (None, None))           #use this to set bounds on the values of x and y
-    for i in range(xi.shape[0]):
-        for j in range(xi.shape[1]):
-            res = minimize(lambda param: diff_for_inversion(param, target[i, j, :]), init[i, j, :], bounds=bnds, tol=1e-16)
-            x[i, j] = res.x[0]
-            y[i, j] = res.x[1]
+    x = xi.copy()
+    y = eta.copy()
+    kx, ky = 2. * np.pi / Lx, 2. * np.pi / Ly
+
+    for it in range(maxiter):
+        sx, cx = np.sin(kx * x), np.cos(kx * x)
+        sy, cy = np.sin(ky * y), np.cos(ky * y)
+        shift = eps * sx * sy
+        rx = x + shift - xi
+        ry = y + shift - eta
+        if max(np.max(np.abs(rx)), np.max(np.abs(ry))) < tol:
+            break
+        a11 = 1. + eps * kx * cx * sy
+        a12 = eps * ky * sx * cy
+        a21 = eps * kx * cx * sy
+        a22 = 1. + eps * ky * sx * cy
+        det = a11 * a22 - a12 * a21
+        x -= (a22 * rx - a12 * ry) / det
+        y -= (a11 * ry - a21 * rx) / det
     return x, y
 
-def dirder(field, dertype):
+# Both dirder and avg combine two neighbouring values along one direction,
+# out = (field[hi] + c*field[lo])/s with c = -1, s = spacing (derivative) or c = 1, s = 2 (average).
+# The backward stencils go from centres to faces/nodes and wrap periodically on the first face.
+# c and s stay run-time arguments: with fastmath the division by s is already hoisted out of the
+# loops, and kernels specialised per dertype with baked-in constants were not measurably faster.
+# All the grids are C-ordered and every kernel runs j (stride 1) innermost, also for the x-stencils
+# that read rows i and i-1: Fortran-ordered x-fields would only make these loops strided.
+@njit(cache=True, fastmath=True, parallel=True)
+def stagger_bx_nb(field, out, c, s):  # C2LR, UD2N: backward x-stencil
+    n, m = field.shape
+    for i in prange(n):
+      im = i-1 if i > 0 else n-1
+      for j in range(m):
+        out[i,j] = (field[i,j] + c*field[im,j])/s
+    for j in range(m):
+      out[n,j] = out[0,j]
+
+@njit(cache=True, fastmath=True, parallel=True)
+def stagger_by_nb(field, out, c, s):  # C2UD, LR2N: backward y-stencil
+    n, m = field.shape
+    for i in prange(n):
+      out[i,0] = (field[i,0] + c*field[i,m-1])/s
+      for j in range(1, m):
+        out[i,j] = (field[i,j] + c*field[i,j-1])/s
+      out[i,m] = out[i,0]
+
+@njit(cache=True, fastmath=True, parallel=True)
+def stagger_fx_nb(field, out, c, s):  # N2UD, LR2C: forward x-stencil
+    n, m = out.shape
+    for i in prange(n):
+      for j in range(m):
+        out[i,j] = (field[i+1,j] + c*field[i,j])/s
+
+@njit(cache=True, fastmath=True, parallel=True)
+def stagger_fy_nb(field, out, c, s):  # N2LR, UD2C: forward y-stencil
+    n, m = out.shape
+    for i in prange(n):
+      for j in range(m):
+        out[i,j] = (field[i,j+1] + c*field[i,j])/s
+
+def stagger_bx_np(field, out, c, s):
+    n = field.shape[0]
+    out[1:n] = (field[1:n] + c*field[0:n-1])/s
+    out[0] = (field[0] + c*field[n-1])/s
+    out[n] = out[0]
+
+def stagger_fx_np(field, out, c, s):
+    out[...] = (field[1:] + c*field[:-1])/s
+
+def stagger_by_np(field, out, c, s):
+    stagger_bx_np(field.T, out.T, c, s)
+
+def stagger_fy_np(field, out, c, s):
+    stagger_fx_np(field.T, out.T, c, s)
+
+if numba_available:
+    stagger_bx, stagger_by, stagger_fx, stagger_fy = stagger_bx_nb, stagger_by_nb, stagger_fx_nb, stagger_fy_nb
+else:
+    stagger_bx, stagger_by, stagger_fx, stagger_fy = stagger_bx_np, stagger_by_np, stagger_fx_np, stagger_fy_np
+
+# dertype -> (stencil, output shape, c, s)
+DIRDER = {'C2UD': (stagger_by, (nxc, nyn), -1., dy),  # centres to UD faces, y-derivative
+          'C2LR': (stagger_bx, (nxn, nyc), -1., dx),  # centres to LR faces, x-derivative
+          'UD2N': (stagger_bx, (nxn, nyn), -1., dx),  # UD faces to nodes, x-derivative
+          'LR2N': (stagger_by, (nxn, nyn), -1., dy),  # LR faces to nodes, y-derivative
+          'N2LR': (stagger_fy, (nxn, nyc), -1., dy),  # nodes to LR faces, y-derivative
+          'N2UD': (stagger_fx, (nxc, nyn), -1., dx),  # nodes to UD faces, x-derivative
+          'LR2C': (stagger_fx, (nxc, nyc), -1., dx),  # LR faces to centres, x-derivative
+          'UD2C': (stagger_fy, (nxc, nyc), -1., dy)}  # UD faces to centres, y-derivative
+
+# avgtype -> (stencil, output shape, c, s)
+AVG = {'C2UD': (stagger_by, (nxc, nyn), 1., 2.),
+       'C2LR': (stagger_bx, (nxn, nyc), 1., 2.),
+       'UD2N': (stagger_bx, (nxn, nyn), 1., 2.),
+       'LR2N': (stagger_by, (nxn, nyn), 1., 2.),
+       'N2LR': (stagger_fy, (nxn, nyc), 1., 2.),
+       'N2UD': (stagger_fx, (nxc, nyn), 1., 2.),
+       'LR2C': (stagger_fx, (nxc, nyc), 1., 2.),
+       'UD2C': (stagger_fy, (nxc, nyc), 1., 2.)}
+
+def dirder(field, dertype, out=None):
     ''' To take the directional derivative of a quantity
     dertype defines input/output grid type and direction
+    out (optional) is a preallocated array of the output grid to be overwritten
     '''
-    global nxn, nyn, nxc, nyc, dx, dy
-
-    if dertype == 'C2UD':  # centres to UD faces, y-derivative
-      derfield = zeros((nxc, nyn), np.float64)
-
-      derfield[0:nxc, 1:nyn-1] = (field[0:nxc, 1:nyc]-field[0:nxc, 0:nyc-1])/dy
-      derfield[0:nxc, 0] = (field[0:nxc, 0]-field[0:nxc, nyc-1])/dy
-      derfield[0:nxc, nyn-1] = derfield[0:nxc, 0]
-
-    elif dertype == 'C2LR':  # centres to LR faces, x-derivative
-      derfield = zeros((nxn, nyc), np.float64)
-
-      derfield[1:nxn-1, 0:nyc] = (field[1:nxc, 0:nyc]-field[0:nxc-1, 0:nyc])/dx
-      derfield[0, 0:nyc] = (field[0, 0:nyc]-field[nxc-1, 0:nyc])/dx
-      derfield[nxn-1, 0:nyc] = derfield[0, 0:nyc]
-
-    elif dertype == 'UD2N':  # UD faces to nodes, x-derivative
-      derfield = zeros((nxn, nyn), np.float64)
-
-      derfield[1:nxn-1, 0:nyn] = (field[1:nxc, 0:nyn]-field[0:nxc-1, 0:nyn])/dx
-      derfield[0, 0:nyn] = (field[0, 0:nyn]-field[nxc-1, 0:nyn])/dx
-      derfield[nxn-1, 0:nyn] = derfield[0, 0:nyn]
-
-    elif dertype == 'LR2N':  # LR faces to nodes, y-derivative
-      derfield = zeros((nxn, nyn), np.float64)
-
-      derfield[0:nxn, 1:nyn-1] = (field[0:nxn, 1:nyc]-field[0:nxn, 0:nyc-1])/dy
-      derfield[0:nxn, 0] = (field[0:nxn, 0]-field[0:nxn, nyc-1])/dy
-      derfield[0:nxn, nyn-1] = derfield[0:nxn, 0]
-
-    elif dertype == 'N2LR':  # nodes to LR faces, y-derivative
-      derfield = zeros((nxn, nyc), np.float64)
-
-      derfield[0:nxn, 0:nyc] = (field[0:nxn, 1:nyn]-field[0:nxn, 0:nyn-1])/dy
-
-    elif dertype == 'N2UD':  # nodes to UD faces, x-derivative
-      derfield = zeros((nxc, nyn), np.float64)
-
-      derfield[0:nxc, 0:nyn] = (field[1:nxn, 0:nyn]-field[0:nxn-1, 0:nyn])/dx
-
-    elif dertype == 'LR2C':  # LR faces to centres, x-derivative
-      derfield = zeros((nxc, nyc), np.float64)
-
-      derfield[0:nxc, 0:nyc] = (field[1:nxn, 0:nyc]-field[0:nxn-1, 0:nyc])/dx
-
-    elif dertype == 'UD2C':  # UD faces to centres, y-derivative
-      derfield = zeros((nxc, nyc), np.float64)
-
-      derfield[0:nxc, 0:nyc] = (field[0:nxc, 1:nyn]-field[0:nxc, 0:nyn-1])/dy
-
-    return derfield
+    stencil, shape, c, s = DIRDER[dertype]
+    if out is None:
+        out = np.empty(shape, field.dtype)
+    stencil(field, out, c, s)
+    return out
 
-def avgC2N(fieldC):
+def avgC2N(fieldC, out=None):
     ''' To average a 2D field defined on centres to the nodes
+    out (optional) is a preallocated array of the nodes to be overwritten
     '''
-    global nx,ny
-
-    fieldN = zeros((nx,ny),np.float64)
-
-    fieldN[1:nx-1,1:ny-1] = (fieldC[0:nx-2,0:ny-2]+fieldC[1:nx-1,0:ny-2]+fieldC[0:nx-2,1:ny-1]+fieldC[1:nx-1,1:ny-1])/4.
-    fieldN[0,1:ny-1] = (fieldC[0,0:ny-2]+fieldC[0,1:ny-1]+fieldC[nx-2,0:ny-2]+fieldC[nx-2,1:ny-1])/4.
-    fieldN[nx-1,1:ny-1] = fieldN[0,1:ny-1]
-    fieldN[1:nx-1,0] = (fieldC[0:nx-2,0]+fieldC[1:nx-1,0]+fieldC[0:nx-2,ny-2]+fieldC[1:nx-1,ny-2])/4.
-    fieldN[1:nx-1,ny-1] = fieldN[1:nx-1,0]
-    fieldN[0,0] = (fieldC[0,0]+fieldC[0,ny-2]+fieldC[nx-2,0]+fieldC[nx-2,ny-2])/4.
-    fieldN[0,ny-1] = fieldN[0,0]
-    fieldN[nx-1,0] = fieldN[0,0]
-    fieldN[nx-1,ny-1] = fieldN[0,0]
-    return fieldN
-
-def avg(field, avgtype):
+    # periodic wrap pad once, then a single 4-point stencil: the last row/column
+    # of nodes comes out equal to the first one
+    padded = np.pad(fieldC, 1, mode='wrap')
+    if out is None:
+        out = np.empty((nxn, nyn), fieldC.dtype)
+    out[...] = (padded[:-1,:-1]+padded[1:,:-1]+padded[:-1,1:]+padded[1:,1:])/4.
+    return out
+
+def avgN2C(fieldN, out=None):
+    ''' To average a 2D field defined on the nodes to the centres (N2LR then LR2C in one stencil)
+    out (optional) is a preallocated array of the centres to be overwritten
+    '''
+    if out is None:
+        out = np.empty((nxc, nyc), fieldN.dtype)
+    out[...] = (fieldN[:-1,:-1]+fieldN[1:,:-1]+fieldN[:-1,1:]+fieldN[1:,1:])/4.
+    return out
+
+def avg(field, avgtype, out=None):
     ''' To take the average of a quantity
         avgtype defines input/output grid type and direction
+        out (optional) is a preallocated array of the output grid to be overwritten
     '''
-    global nxn, nyn, nxc, nyc, dx, dy
-
-    if avgtype == 'C2UD':  # centres to UD faces, y-average
-      avgfield = zeros((nxc, nyn), np.float64)
-
-      avgfield[0:nxc, 1:nyn-1] = (field[0:nxc, 1:nyc]+field[0:nxc, 0:nyc-1])/2.
-      avgfield[0:nxc, 0] = (field[0:nxc, 0]+field[0:nxc, nyc-1])/2.
-      avgfield[0:nxc, nyn-1] = avgfield[0:nxc, 0]
-
-    elif avgtype == 'C2LR':  # centres to LR faces, x-average
-      avgfield = zeros((nxn, nyc), np.float64)
-
-      avgfield[1:nxn-1, 0:nyc] = (field[1:nxc, 0:nyc]+field[0:nxc-1, 0:nyc])/2.
-      avgfield[0, 0:nyc] = (field[0, 0:nyc]+field[nxc-1, 0:nyc])/2.
-      avgfield[nxn-1, 0:nyc] = avgfield[0, 0:nyc]
-
-    elif avgtype == 'UD2N':  # UD faces to nodes, x-average
-      avgfield = zeros((nxn, nyn), np.float64)
-
-      avgfield[1:nxn-1, 0:nyn] = (field[1:nxc, 0:nyn]+field[0:nxc-1, 0:nyn])/2.
-      avgfield[0, 0:nyn] = (field[0, 0:nyn]+field[nxc-1, 0:nyn])/2.
-      avgfield[nxn-1, 0:nyn] = avgfield[0, 0:nyn]
-
-    elif avgtype == 'LR2N':  # LR faces to nodes, y-average
-      avgfield = zeros((nxn, nyn), np.float64)
-
-      avgfield[0:nxn, 1:nyn-1] = (field[0:nxn, 1:nyc]+field[0:nxn, 0:nyc-1])/2.
-      avgfield[0:nxn, 0] = (field[0:nxn, 0]+field[0:nxn, nyc-1])/2.
-      avgfield[0:nxn, nyn-1] = avgfield[0:nxn, 0]
-
-    elif avgtype == 'N2LR':  # nodes to LR faces, y-average
-      avgfield = zeros((nxn, nyc), np.float64)
-
-      avgfield[0:nxn, 0:nyc] = (field[0:nxn, 1:nyn]+field[0:nxn, 0:nyn-1])/2.
-
-    elif avgtype == 'N2UD':  # nodes to UD faces, x-average
-      avgfield = zeros((nxc, nyn), np.float64)
-
-      avgfield[0:nxc, 0:nyn] = (field[1:nxn, 0:nyn]+field[0:nxn-1, 0:nyn])/2.
-
-    elif avgtype == 'LR2C':  # LR faces to centres, x-average
-      avgfield = zeros((nxc, nyc), np.float64)
-
-      avgfield[0:nxc, 0:nyc] = (field[1:nxn, 0:nyc]+field[0:nxn-1, 0:nyc])/2.
-
-    elif avgtype == 'UD2C':  # UD faces to centres, y-average
-      avgfield = zeros((nxc, nyc), np.float64)
-
-      avgfield[0:nxc, 0:nyc] = (field[0:nxc, 1:nyn]+field[0:nxc, 0:nyn-1])/2.
-
-    return avgfield
-
-def curl(fieldx, fieldy, fieldz, fieldtype):
+    stencil, shape, c, s = AVG[avgtype]
+    if out is None:
+        out = np.empty(shape, field.dtype)
+    stencil(field, out, c, s)
+    return out
+
+# Fused curl: the cross averages, metric products, differences and 1/J are evaluated
+# pointwise from the geometry buffers (J11, J12, J21, J22, det, ...), no full-grid temporaries.
+# The helpers take the periodic neighbour indexes (jc, jm / ic, im) from the caller
+@njit(cache=True, fastmath=True)
+def lr_to_ud_nb(f, i, jc, jm):  # LR -> C -> UD average at the UD point (i, j)
+    return ((f[i+1,jc] + f[i,jc])/2. + (f[i+1,jm] + f[i,jm])/2.)/2.
+
+@njit(cache=True, fastmath=True)
+def ud_to_lr_nb(f, ic, im, j):  # UD -> C -> LR average at the LR point (i, j)
+    return ((f[ic,j+1] + f[ic,j])/2. + (f[im,j+1] + f[im,j])/2.)/2.
+
+@njit(cache=True, fastmath=True)
+def ud_to_lr_via_n_nb(f, ic, im, j):  # UD -> N -> LR average at the LR point (i, j)
+    return ((f[ic,j+1] + f[im,j+1])/2. + (f[ic,j] + f[im,j])/2.)/2.
+
+@njit(cache=True, fastmath=True)
+def lr_to_ud_via_n_nb(f, i, jc, jm):  # LR -> N -> UD average at the UD point (i, j)
+    return ((f[i+1,jc] + f[i+1,jm])/2. + (f[i,jc] + f[i,jm])/2.)/2.
+
+@njit(cache=True, fastmath=True)
+def metric_nb(g, i, j):  # g11, g12, g22 from the Jacobian block of a geometry buffer
+    J11, J12, J21, J22 = g[0,i,j], g[1,i,j], g[2,i,j], g[3,i,j]
+    return J11**2 + J21**2, J11*J12 + J21*J22, J12**2 + J22**2
+
+@njit(cache=True, fastmath=True)
+def curl_E_at_nb(fx, fy, fz, gLR, gUD, gN, dx, dy, i, j, ic, im, jc, jm):
+    # curl of E at the UD (i < nxc), LR (j < nyc) and N points (i, j), 0. where not defined
+    nxc, nyc = fz.shape
+    cx, cy = 0., 0.
+    if i < nxc:  # UD
+      cx = (fz[i,jc]-fz[i,jm])/dy/gUD[4,i,j]
+    if j < nyc:  # LR
+      cy = - ((fz[ic,j]-fz[im,j])/dx)/gLR[4,i,j]
+    # N: d_x(g12·A^1 + g22·A^2)_UD - d_y(g11·A^1 + g12·A^2)_LR
+    _, g12, g22 = metric_nb(gUD, ic, j)
+    a_hi = g12*lr_to_ud_nb(fx, ic, jc, jm) + g22*fy[ic,j]
+    _, g12, g22 = metric_nb(gUD, im, j)
+    a_lo = g12*lr_to_ud_nb(fx, im, jc, jm) + g22*fy[im,j]
+    g11, g12, _ = metric_nb(gLR, i, jc)
+    b_hi = g11*fx[i,jc] + g12*ud_to_lr_nb(fy, ic, im, jc)
+    g11, g12, _ = metric_nb(gLR, i, jm)
+    b_lo = g11*fx[i,jm] + g12*ud_to_lr_nb(fy, ic, im, jm)
+    cz = (a_hi-a_lo)/dx/gN[4,i,j] - (b_hi-b_lo)/dy/gN[4,i,j]
+    return cx, cy, cz
+
+@njit(cache=True, fastmath=True, parallel=True)
+def curl_E_nb(fx, fy, fz, gLR, gUD, gN, dx, dy, curl_x, curl_y, curl_z):
+    nxc, nyc = fz.shape
+    for i in prange(nxc+1):
+      ic = i % nxc
+      im = i-1 if i > 0 else nxc-1
+      for j in range(nyc+1):
+        jc = j if j < nyc else 0
+        jm = j-1 if j > 0 else nyc-1
+        cx, cy, cz = curl_E_at_nb(fx, fy, fz, gLR, gUD, gN, dx, dy, i, j, ic, im, jc, jm)
+        if i < nxc:
+          curl_x[i,j] = cx
+        if j < nyc:
+          curl_y[i,j] = cy
+        curl_z[i,j] = cz
+
+@njit(cache=True, fastmath=True, parallel=True)
+def update_B_nb(fx, fy, fz, B1, B2, B3, gLR, gUD, gN, dx, dy, dt, B1new, B2new, B3new, B1bar, B2bar, B3bar):
+    ''' Bnew = B - dt*curlE and Bbar = (Bnew + B)/2 in one sweep: curlE stays in registers
+    '''
+    nxc, nyc = fz.shape
+    for i in prange(nxc+1):
+      ic = i % nxc
+      im = i-1 if i > 0 else nxc-1
+      for j in range(nyc+1):
+        jc = j if j < nyc else 0
+        jm = j-1 if j > 0 else nyc-1
+        cx, cy, cz = curl_E_at_nb(fx, fy, fz, gLR, gUD, gN, dx, dy, i, j, ic, im, jc, jm)
+        if i < nxc:
+          B1new[i,j] = B1[i,j] - cx*dt
+          B1bar[i,j] = (B1new[i,j] + B1[i,j])/2.
+        if j < nyc:
+          B2new[i,j] = B2[i,j] - cy*dt
+          B2bar[i,j] = (B2new[i,j] + B2[i,j])/2.
+        B3new[i,j] = B3[i,j] - cz*dt
+        B3bar[i,j] = (B3new[i,j] + B3[i,j])/2.
+
+@njit(cache=True, fastmath=True, parallel=True)
+def curl_B_nb(fx, fy, fz, gLR, gUD, gC, dx, dy, curl_x, curl_y, curl_z):
+    nxn, nyn = fz.shape
+    nxc, nyc = nxn-1, nyn-1
+    for i in prange(nxn):
+      ip = (i+1) % nxc
+      im = i-1 if i > 0 else nxc-1
+      for j in range(nyn):
+        jp = j+1 if j < nyc-1 else 0
+        jm = j-1 if j > 0 else nyc-1
+        if j < nyc:  # LR
+          curl_x[i,j] = (fz[i,j+1]-fz[i,j])/dy/gLR[4,i,j]
+        if i < nxc:  # UD
+          curl_y[i,j] = - ((fz[i+1,j]-fz[i,j])/dx)/gUD[4,i,j]
+        if i < nxc and j < nyc:
+          # C: d_x(g12·A^1 + g22·A^2)_LR - d_y(g11·A^1 + g12·A^2)_UD
+          _, g12, g22 = metric_nb(gLR, i+1, j)
+          a_hi = g12*ud_to_lr_via_n_nb(fx, ip, i, j) + g22*fy[i+1,j]
+          _, g12, g22 = metric_nb(gLR, i, j)
+          a_lo = g12*ud_to_lr_via_n_nb(fx, i, im, j) + g22*fy[i,j]
+          g11, g12, _ = metric_nb(gUD, i, j+1)
+          b_hi = g11*fx[i,j+1] + g12*lr_to_ud_via_n_nb(fy, i, jp, j)
+          g11, g12, _ = metric_nb(gUD, i, j)
+          b_lo = g11*fx[i,j] + g12*lr_to_ud_via_n_nb(fy, i, j, jm)
+          curl_z[i,j] = (a_hi-a_lo)/dx/gC[4,i,j] - (b_hi-b_lo)/dy/gC[4,i,j]
+
+def curl(fieldx, fieldy, fieldz, fieldtype, cross=None):
     ''' To take the curl of either E or B in General coord.
     curl^i = 1/J·(d_j·g_kq·A^q - d_k·g_jq·A^q)
     fieltype=='E': input -> LR,UD,c, output -> UD,LR,n
     fieltype=='B': input -> UD,LR,n, output -> LR,UD,c
+    cross (optional, 'E' only) is cross_avg(fieldx, fieldy, 'E') when already available
     '''
+    if geomLR.is_identity:
+        if fieldtype == 'E':
+            return dirder(fieldz, 'C2UD'), - dirder(fieldz, 'C2LR'), dirder(fieldy, 'UD2N') - dirder(fieldx, 'LR2N')
+        elif fieldtype == 'B':
+            return dirder(fieldz, 'N2LR'), - dirder(fieldz, 'N2UD'), dirder(fieldy, 'LR2C') - dirder(fieldx, 'UD2C')
+
+    if numba_available:
+        if fieldtype == 'E':
+            curl_x, curl_y, curl_z = (np.empty(shape, fieldx.dtype) for shape in ((nxc, nyn), (nxn, nyc), (nxn, nyn)))
+            curl_E_nb(fieldx, fieldy, fieldz, geomLR.buf, geomUD.buf, geomN.buf, dx, dy, curl_x, curl_y, curl_z)
+        elif fieldtype == 'B':
+            curl_x, curl_y, curl_z = (np.empty(shape, fieldx.dtype) for shape in ((nxn, nyc), (nxc, nyn), (nxc, nyc)))
+            curl_B_nb(fieldx, fieldy, fieldz, geomLR.buf, geomUD.buf, geomC.buf, dx, dy, curl_x, curl_y, curl_z)
+        return curl_x, curl_y, curl_z
+
     if fieldtype == 'E':
-        fieldx_C = avg(fieldx, 'LR2C')
-        fieldy_C = avg(fieldy, 'UD2C')
-        fieldx_UD = avg(avg(fieldx, 'LR2C'), 'C2UD')
-        fieldz_UD = avg(fieldz, 'C2UD')
-        fieldy_LR = avg(avg(fieldy, 'UD2C'), 'C2LR')
-        fieldz_LR = avg(fieldz, 'C2LR')
-
-        curl_x =   dirder(g31_C * fieldx_C + g32_C * fieldy_C + g33_C * fieldz, 'C2UD')/J_UD
-        curl_y = - dirder(g31_C * fieldx_C + g32_C * fieldy_C + g33_C * fieldz, 'C2LR')/J_LR
-        curl_z =   dirder(g21_UD * fieldx_UD + g22_UD * fieldy + g23_UD * fieldz_UD, 'UD2N')/J_N\
-                 - dirder(g11_LR * fieldx + g12_LR * fieldy_LR + g13_LR * fieldz_LR, 'LR2N')/J_N
+        if cross is None:
+            cross = cross_avg(fieldx, fieldy, 'E')
+        fieldy_LR, fieldx_UD = cross
+
+        curl_x =   dirder(fieldz, 'C2UD')/geomUD.det
+        curl_y = - dirder(fieldz, 'C2LR')/geomLR.det
+        curl_z =   dirder(geomUD.g12 * fieldx_UD + geomUD.g22 * fieldy, 'UD2N')/geomN.det\
+                 - dirder(geomLR.g11 * fieldx + geomLR.g12 * fieldy_LR, 'LR2N')/geomN.det
     elif fieldtype == 'B':
-        fieldx_N = avg(fieldx, 'UD2N')
-        fieldy_N = avg(fieldy, 'LR2N')
         fieldx_LR = avg(avg(fieldx, 'UD2N'), 'N2LR')
-        fieldz_LR = avg(fieldz, 'N2LR')
         fieldy_UD = avg(avg(fieldy, 'LR2N'), 'N2UD')
-        fieldz_UD = avg(fieldz, 'N2UD')
         
-        curl_x =   dirder(g31_N * fieldx_N + g32_N * fieldy_N + g33_N * fieldz, 'N2LR')/J_LR
-        curl_y = - dirder(g31_N * fieldx_N + g32_N * fieldy_N + g33_N * fieldz, 'N2UD')/J_UD
-        curl_z =   dirder(g21_LR * fieldx_LR + g22_LR * fieldy + g23_LR * fieldz_LR, 'LR2C')/J_C\
-                 - dirder(g11_UD * fieldx + g12_UD * fieldy_UD + g13_UD * fieldz_UD, 'UD2C')/J_C
+        curl_x =   dirder(fieldz, 'N2LR')/geomLR.det
+        curl_y = - dirder(fieldz, 'N2UD')/geomUD.det
+        curl_z =   dirder(geomLR.g12 * fieldx_LR + geomLR.g22 * fieldy, 'LR2C')/geomC.det\
+                 - dirder(geomUD.g11 * fieldx + geomUD.g12 * fieldy_UD, 'UD2C')/geomC.det
     
     return curl_x, curl_y, curl_z
 
+@njit(cache=True, fastmath=True, parallel=True)
+def field_energies_nb(E1, E2, E3, B1, B2, B3, gC):
+    ''' Sums over the centres of the perturbed-metric energy densities (without the dx*dy/2):
+    the averages to C are done pointwise, one sweep instead of one numpy pass per term
+    '''
+    nxc, nyc = E3.shape
+    sE1, sE2, sE3, sB1, sB2, sB3 = 0., 0., 0., 0., 0., 0.
+    for i in prange(nxc):
+      for j in range(nyc):
+        J = gC[4,i,j]
+        g11, g12, g22 = metric_nb(gC, i, j)
+        # LR2C and UD2C of E (LR, UD) and Bbar (UD, LR) and of their squares
+        e1 = (E1[i+1,j] + E1[i,j])/2.
+        e2 = (E2[i,j+1] + E2[i,j])/2.
+        b1 = (B1[i,j+1] + B1[i,j])/2.
+        b2 = (B2[i+1,j] + B2[i,j])/2.
+        e1sq = (E1[i+1,j]**2 + E1[i,j]**2)/2.
+        e2sq = (E2[i,j+1]**2 + E2[i,j]**2)/2.
+        b1sq = (B1[i,j+1]**2 + B1[i,j]**2)/2.
+        b2sq = (B2[i+1,j]**2 + B2[i,j]**2)/2.
+        # N2LR then LR2C of B3**2
+        b3sq = ((B3[i+1,j+1]**2 + B3[i+1,j]**2)/2. + (B3[i,j+1]**2 + B3[i,j]**2)/2.)/2.
+        sE1 += J * (g11 * e1sq + g12 * e1 * e2)
+        sE2 += J * (g12 * e2 * e1 + g22 * e2sq)
+        sE3 += J * E3[i,j]**2
+        sB1 += J * (g11 * b1sq + g12 * b1 * b2)
+        sB2 += J * (g12 * b2 * b1 + g22 * b2sq)
+        sB3 += J * b3sq
+    return sE1, sE2, sE3, sB1, sB2, sB3
+
 def div(fieldx, fieldy, fieldz, fieldtype):
     ''' To take the divergence of either E or B in in General coord.
     div = 1/J·d_i(J·A^i)
     fieltype=='E': input -> LR,UD,c, output -> c,c,c
     fieltype=='B': input -> UD,LR,n, output -> n,n,n
     '''
+    if geomLR.is_identity:
+        if fieldtype == 'E':
+            return dirder(fieldx, 'LR2C') + dirder(fieldy, 'UD2C')
+        elif fieldtype == 'B':
+            return dirder(fieldx, 'UD2N') + dirder(fieldy, 'LR2N')
+
     if fieldtype == 'E':
-        div = (dirder(J_LR * fieldx, 'LR2C') + dirder(J_UD * fieldy, 'UD2C'))/J_C
+        div = (dirder(geomLR.det * fieldx, 'LR2C') + dirder(geomUD.det * fieldy, 'UD2C'))/geomC.det
 
     elif fieldtype == 'B':
-        div = (dirder(J_UD * fieldx, 'UD2N') + dirder(J_LR * fieldy, 'LR2N'))/J_N
+        div = (dirder(geomUD.det * fieldx, 'UD2N') + dirder(geomLR.det * fieldy, 'LR2N'))/geomN.det
 
     return div
 
-def phys_to_krylov(E1k, E2k, E3k, uk, vk, wk):
+def sum_squares(field):
+    ''' Sum of the squares of a 2D field (no squared temporary, works on slices)
+    '''
+    return np.einsum('ij,ij->', field, field)
+
+@njit(cache=True, fastmath=True, parallel=True)
+def field_sums_nb(E1, E2, E3, B1, B2, B3):
+    ''' sum of each of the six field components (LR, UD, c, UD, LR, n) in one sweep over the nodes
+    '''
+    nxn, nyn = B3.shape
+    nxc, nyc = E3.shape
+    sE1, sE2, sE3, sB1, sB2, sB3 = 0., 0., 0., 0., 0., 0.
+    for i in prange(nxn):
+      for j in range(nyn):
+        if j < nyc:
+          sE1 += E1[i,j]
+          sB2 += B2[i,j]
+        if i < nxc:
+          sE2 += E2[i,j]
+          sB1 += B1[i,j]
+          if j < nyc:
+            sE3 += E3[i,j]
+        sB3 += B3[i,j]
+    return sE1, sE2, sE3, sB1, sB2, sB3
+
+# Diagnostics of the divergence: the sums are accumulated pointwise, div is never stored
+@njit(cache=True, fastmath=True, parallel=True)
+def div_E_sums_nb(fx, fy, rho, gLR, gUD, gC, dx, dy):
+    ''' sum(div(E)) and sum(|div(E)| - |rho|) over the centres
+    '''
+    nxc, nyc = rho.shape
+    s_div, s_rho = 0., 0.
+    for i in prange(nxc):
+      for j in range(nyc):
+        d = ((gLR[4,i+1,j]*fx[i+1,j] - gLR[4,i,j]*fx[i,j])/dx
+             + (gUD[4,i,j+1]*fy[i,j+1] - gUD[4,i,j]*fy[i,j])/dy)/gC[4,i,j]
+        s_div += d
+        s_rho += abs(d) - abs(rho[i,j])
+    return s_div, s_rho
+
+@njit(cache=True, fastmath=True, parallel=True)
+def div_E_sums_cart_nb(fx, fy, rho, dx, dy):
+    ''' div_E_sums_nb without the metric (perturb=False)
+    '''
+    nxc, nyc = rho.shape
+    s_div, s_rho = 0., 0.
+    for i in prange(nxc):
+      for j in range(nyc):
+        d = (fx[i+1,j] - fx[i,j])/dx + (fy[i,j+1] - fy[i,j])/dy
+        s_div += d
+        s_rho += abs(d) - abs(rho[i,j])
+    return s_div, s_rho
+
+@njit(cache=True, fastmath=True, parallel=True)
+def div_B_sum_nb(fx, fy, gLR, gUD, gN, dx, dy):
+    ''' sum(div(B)) over the nodes (the periodic copies included)
+    '''
+    nxc, nyc = fx.shape[0], fy.shape[1]
+    s_div = 0.
+    for i in prange(nxc+1):
+      ix = i % nxc
+      im = ix-1 if ix > 0 else nxc-1
+      for j in range(nyc+1):
+        jy = j % nyc
+        jm = jy-1 if jy > 0 else nyc-1
+        s_div += ((gUD[4,ix,j]*fx[ix,j] - gUD[4,im,j]*fx[im,j])/dx
+                  + (gLR[4,i,jy]*fy[i,jy] - gLR[4,i,jm]*fy[i,jm])/dy)/gN[4,i,j]
+    return s_div
+
+def phys_to_krylov(E1k, E2k, E3k, uk, vk, wk, out=None):
     ''' To populate the Krylov vector using physiscs vectors
     E1,E2,E3 are 2D arrays
     u,v,w of dimensions npart
+    out (optional) is a preallocated Krylov vector to be overwritten
     '''
     global nxc,nyc,nxn,nyn,npart
 
-    ykrylov = zeros(nxn*nyc+nxc*nyn+nxc*nyc+3*npart,np.float64)
-    ykrylov[0:nxn*nyc] = E1k.reshape(nxn*nyc)
-    ykrylov[nxn*nyc:nxn*nyc+nxc*nyn] = E2k.reshape(nxc*nyn)
-    ykrylov[nxn*nyc+nxc*nyn:nxn*nyc+nxc*nyn+nxc*nyc] = E3k.reshape(nxc*nyc)
-    ykrylov[nxn*nyc+nxc*nyn+nxc*nyc:nxn*nyc+nxc*nyn+nxc*nyc+npart] = uk
-    ykrylov[nxn*nyc+nxc*nyn+nxc*nyc+npart:nxn*nyc+nxc*nyn+nxc*nyc+2*npart] = vk
-    ykrylov[nxn*nyc+nxc*nyn+nxc*nyc+2*npart:nxn*nyc+nxc*nyn+nxc*nyc+3*npart] = wk
+    if out is None:
+        ykrylov = np.empty(nxn*nyc+nxc*nyn+nxc*nyc+3*npart,KTYPE)
+    else:
+        ykrylov = out
+    # copy through the views of krylov_to_phys: one pass per component, no reshaped temporaries
+    for view, comp in zip(krylov_to_phys(ykrylov), (E1k, E2k, E3k, uk, vk, wk)):
+        view[...] = comp
     return ykrylov
 
-def krylov_to_phys(xkrylov):
+def krylov_to_phys(xkrylov, out=None):
     ''' To populate the physiscs vectors using the Krylov space vector
     E1,E2,E3 are 2D arrays of dimension (nx,ny)
     unew,vnew,wnew of dimensions npart1+npart2
+    the returned arrays are views of xkrylov (no copy)
+    out (optional) is a tuple of six preallocated arrays the views are copied into
     '''
     global nx,ny,npart
 
-    E1k = np.reshape(xkrylov[0:nxn*nyc],(nxn,nyc))
-    E2k = np.reshape(xkrylov[nxn*nyc:nxn*nyc+nxc*nyn],(nxc,nyn))
-    E3k = np.reshape(xkrylov[nxn*nyc+nxc*nyn:nxn*nyc+nxc*nyn+nxc*nyc],(nxc,nyc))
-    uk = xkrylov[nxn*nyc+nxc*nyn+nxc*nyc:nxn*nyc+nxc*nyn+nxc*nyc+npart]
-    vk = xkrylov[nxn*nyc+nxc*nyn+nxc*nyc+npart:nxn*nyc+nxc*nyn+nxc*nyc+2*npart]
-    wk = xkrylov[nxn*nyc+nxc*nyn+nxc*nyc+2*npart:nxn*nyc+nxc*nyn+nxc*nyc+3*npart]
-    return E1k, E2k, E3k, uk, vk, wk
+    nE1, nE2, nE3 = nxn*nyc, nxc*nyn, nxc*nyc
+    E1k = xkrylov[0:nE1].reshape(nxn, nyc)
+    E2k = xkrylov[nE1:nE1+nE2].reshape(nxc, nyn)
+    E3k = xkrylov[nE1+nE2:nE1+nE2+nE3].reshape(nxc, nyc)
+    uk, vk, wk = xkrylov[nE1+nE2+nE3:nE1+nE2+nE3+3*npart].reshape(3, npart)
+    if out is None:
+        return E1k, E2k, E3k, uk, vk, wk
+    for comp, view in zip(out, (E1k, E2k, E3k, uk, vk, wk)):
+        np.copyto(comp, view)
+    return out
+
+# Periodic wrap of the particle positions by one subtraction instead of a float modulo:
+# a particle moves less than a box length per step, so a is always in [-L, 2L)
+@njit(cache=True, fastmath=True)
+def wrap_nb(a, L):
+    # branchless: the comparisons become 0./1. factors, the loops stay vectorisable
+    return a - L*(a >= L) + L*(a < 0.)
+
+def wrap(a, L):
+    ''' In place periodic wrap of the positions a in [-L, 2L) to [0, L)
+    '''
+    np.subtract(a, L, out=a, where=a >= L)
+    np.add(a, L, out=a, where=a < 0.)
+    return a
+
+@njit(cache=True, fastmath=True, parallel=True)
+def push_position_nb(x, y, unew, vnew, dt, Lx, Ly):
+    ''' x = (x + unew*dt) % Lx, y = (y + vnew*dt) % Ly in place, one pass over the particles
+    '''
+    for i in prange(x.shape[0]):
+      x[i] = wrap_nb(x[i] + unew[i]*dt, Lx)
+      y[i] = wrap_nb(y[i] + vnew[i]*dt, Ly)
+
+@njit(cache=True, fastmath=True, parallel=True)
+def position_bar_nb(x, y, unew, vnew, dt, Lx, Ly, xbar, ybar):
+    for i in prange(x.shape[0]):
+      xbar[i] = wrap_nb(((x[i] + unew[i]*dt) + x[i])/2., Lx)
+      ybar[i] = wrap_nb(((y[i] + vnew[i]*dt) + y[i])/2., Ly)
+
+@njit(cache=True, fastmath=True, parallel=True)
+def particle_residual_nb(unew, vnew, wnew, u, v, w, QM, Exp, Eyp, Ezp, Bxp, Byp, Bzp, dt, resu, resv, resw):
+    for i in prange(u.shape[0]):
+      ubar = (unew[i] + u[i])/2.
+      vbar = (vnew[i] + v[i])/2.
+      wbar = (wnew[i] + w[i])/2.
+      resu[i] = unew[i] - u[i] - QM[i] * (Exp[i] + vbar * Bzp[i] - wbar * Byp[i]) * dt
+      resv[i] = vnew[i] - v[i] - QM[i] * (Eyp[i] - ubar * Bzp[i] + wbar * Bxp[i]) * dt
+      resw[i] = wnew[i] - w[i] - QM[i] * (Ezp[i] + ubar * Byp[i] - vbar * Bxp[i]) * dt
+
+def step_terms(Bnew):
+    ''' Terms of the residual that only depend on the state at the start of the step
+    (E, B, x, y): Bnew = B - dt*curlE, Bbar, dt*curlB(Bnew) and the E, Bbar fields at
+    the particles. Evaluated once per time step, before the nonlinear solve
+    Bnew: the (UD, LR, n) arrays to be overwritten with B - dt*curlE
+    '''
+    # E is averaged across its components once, for both curl and the conversion to Cartesian
+    E_cross = None if geomLR.is_identity else cross_avg(E1, E2, 'E')
+
+    # Bnew = B - dt*curlE (becomes B at the end of the step),
+    # Bbar = (Bnew + B)/2 is written on the Bbar_w buffers
+    B1new, B2new, B3new = Bnew
+    B1bar, B2bar, B3bar = Bbar_w
+    if numba_available and not geomLR.is_identity:
+        update_B_nb(E1, E2, E3, B1, B2, B3, geomLR.buf, geomUD.buf, geomN.buf, dx, dy, dt,
+                    B1new, B2new, B3new, B1bar, B2bar, B3bar)
+    else:
+        curlE = curl(E1, E2, E3, 'E', E_cross)
+        for new, old, curl_k, bar in zip(Bnew, (B1, B2, B3), curlE, Bbar_w):
+            np.multiply(curl_k, dt, out=new)
+            np.subtract(old, new, out=new)
+            np.add(new, old, out=bar)
+            bar /= 2.
+
+    dtcurlB = curl(B1new, B2new, B3new,'B')
+    for curlB in dtcurlB:
+        curlB *= dt
+
+    Ex, Ey, Ez = general_to_cartesian(E1, E2, E3, 'E', E_cross)
+    Bx, By, Bz = general_to_cartesian(B1bar, B2bar, B3bar, 'B')
+
+    # the particles at x (general coordinates) are kept in xgen, ygen by the main loop
+    EBp = (grid_to_particle(xgen, ygen, Ex, 'LR', out=EBp_w[0]),
+           grid_to_particle(xgen, ygen, Ey, 'UD', out=EBp_w[1]),
+           grid_to_particle(xgen, ygen, Ez, 'C', out=EBp_w[2]),
+           grid_to_particle(xgen, ygen, Bx, 'UD', out=EBp_w[3]),
+           grid_to_particle(xgen, ygen, By, 'LR', out=EBp_w[4]),
+           grid_to_particle(xgen, ygen, Bz, 'N', out=EBp_w[5]))
+
+    return (B1new, B2new, B3new), (B1bar, B2bar, B3bar), dtcurlB, EBp
+
+@njit(cache=True, fastmath=True, parallel=True)
+def particle_energy_nb(u, v, w, mass, lo, hi):
+    ''' Kinetic energy of the particles lo..hi-1, sum((u^2+v^2+w^2)/2*|q/QM|)
+    (fastmath lets the reduction be split over several vector accumulators)
+    '''
+    energy = 0.
+    for i in prange(lo, hi):
+      energy += (u[i]**2 + v[i]**2 + w[i]**2)/2.*mass[i]
+    return energy
 
 def residual(xkrylov):
     ''' Calculation of the residual of the equations
     This is the most important part: the definition of the problem
+    The intermediate arrays are the preallocated *_w buffers (or arrays owned by this call),
+    updated in place; the residual components are written straight into the returned vector.
+    dtcurlB and EBp come from step_terms(): only J and the new E, u depend on xkrylov
     '''
     #global E1, E2, E3, B1, B2, B3, x, y, u, v, w, QM, q, npart, dt
     E1new, E2new, E3new, unew, vnew, wnew = krylov_to_phys(xkrylov)
@@ -966,67 +1152,66 @@ def residual(xkrylov):
     #                   x           xbar        xnew
     #                   curlE       curlB
     #                               J/xgen1
-    #                   Ep/Bp/xgen2
-
-
-    xnew = x + unew*dt
-    ynew = y + vnew*dt
+    #                   Ep/Bp/xgen (step_terms)
 
-    xbar = (xnew + x)/2.
-    ybar = (ynew + y)/2.
 
-    xbar = xbar % Lx
-    ybar = ybar % Ly
+    # xbar = ((x + unew*dt) + x)/2 % Lx
+    xbar, ybar = xbar_w, ybar_w
+    if numba_available:
+        position_bar_nb(x, y, unew, vnew, dt, Lx, Ly, xbar, ybar)
+    else:
+        for bar, pos, vel, L in ((xbar, x, unew, Lx), (ybar, y, vnew, Ly)):
+            np.multiply(vel, dt, out=bar)
+            bar += pos
+            bar += pos
+            bar /= 2.
+            wrap(bar, L)
 
     if perturb:
-        xgen1, ygen1 = cartesian_to_general_particle(xbar, ybar)
+        xgen1, ygen1 = cartesian_to_general_particle(xbar, ybar, out=xgenbar_w)
     else:
         xgen1, ygen1 = xbar, ybar
 
-    Jx, Jy, Jz = particle_to_grid_J(xgen1, ygen1, unew, vnew, wnew, q)
+    Jx, Jy, Jz = particle_to_grid_J(xgen1, ygen1, unew, vnew, wnew, q, out=J_w)
 
     J1, J2, J3 = cartesian_to_general(Jx, Jy, Jz, 'J')
 
-    curlE1, curlE2, curlE3 = curl(E1, E2, E3, 'E')
-
-    B1new = B1 - dt * curlE1
-    B2new = B2 - dt * curlE2
-    B3new = B3 - dt * curlE3
-
-    curlB1, curlB2, curlB3 = curl(B1new, B2new, B3new,'B')
-
-    resE1 = E1new - E1 - dt * curlB1 + dt * J1
-    resE2 = E2new - E2 - dt * curlB2 + dt * J2
-    resE3 = E3new - E3 - dt * curlB3 + dt * J3
+    # resE = E1new - E1 - dt*curlB + dt*J, J is owned by this call
+    ykrylov = np.empty_like(xkrylov)
+    resE1, resE2, resE3, resu, resv, resw = krylov_to_phys(ykrylov)
+    for res, new, old, curlB, J in zip((resE1, resE2, resE3), (E1new, E2new, E3new), (E1, E2, E3),
+                                      dtcurlB, (J1, J2, J3)):
+        np.subtract(new, old, out=res)
+        res -= curlB
+        J *= dt
+        res += J
+
+    Exp, Eyp, Ezp, Bxp, Byp, Bzp = EBp
+
+    # resu = unew - u - QM*(Exp + vbar*Bzp - wbar*Byp)*dt
+    if numba_available:
+        particle_residual_nb(unew, vnew, wnew, u, v, w, QM, Exp, Eyp, Ezp, Bxp, Byp, Bzp, dt, resu, resv, resw)
+        return ykrylov
+
+    # numpy: the force is accumulated on force_w (EBp is reused by every call of the step)
+    ubar, vbar, wbar = ubar_w, vbar_w, wbar_w
+    for bar, new, old in zip((ubar, vbar, wbar), (unew, vnew, wnew), (u, v, w)):
+        np.add(new, old, out=bar)
+        bar /= 2.
+    tmp, force = tmp_w, force_w
+    for res, new, old, Ep, op1, v1, b1, op2, v2, b2 in (
+            (resu, unew, u, Exp, np.add, vbar, Bzp, np.subtract, wbar, Byp),
+            (resv, vnew, v, Eyp, np.subtract, ubar, Bzp, np.add, wbar, Bxp),
+            (resw, wnew, w, Ezp, np.add, ubar, Byp, np.subtract, vbar, Bxp)):
+        np.multiply(v1, b1, out=tmp)
+        op1(Ep, tmp, out=force)
+        np.multiply(v2, b2, out=tmp)
+        op2(force, tmp, out=force)
+        force *= QM
+        force *= dt
+        np.subtract(new, old, out=res)
+        res -= force
 
-    B1bar = (B1new + B1) / 2.
-    B2bar = (B2new + B2) / 2.
-    B3bar = (B3new + B3) / 2.
-
-    ubar = (unew + u) / 2.
-    vbar = (vnew + v) / 2.
-    wbar = (wnew + w) / 2.
-
-    Ex, Ey, Ez = general_to_cartesian(E1, E2, E3, 'E')
-    Bx, By, Bz = general_to_cartesian(B1bar, B2bar, B3bar, 'B')
-
-    if perturb:
-        xgen2, ygen2 = cartesian_to_general_particle(x, y)
-    else:
-        xgen2, ygen2 = x, y
-
-    Exp = grid_to_particle(xgen2, ygen2, Ex, 'LR')
-    Eyp = grid_to_particle(xgen2, ygen2, Ey, 'UD')
-    Ezp = grid_to_particle(xgen2, ygen2, Ez, 'C')
-    Bxp = grid_to_particle(xgen2, ygen2, Bx, 'UD')
-    Byp = grid_to_particle(xgen2, ygen2, By, 'LR')
-    Bzp = grid_to_particle(xgen2, ygen2, Bz, 'N')
-
-    resu = unew - u - QM * (Exp + vbar * Bzp - wbar * Byp) * dt
-    resv = vnew - v - QM * (Eyp - ubar * Bzp + wbar * Bxp) * dt
-    resw = wnew - w - QM * (Ezp + ubar * Byp - vbar * Bxp) * dt
-
-    ykrylov = phys_to_krylov(resE1, resE2, resE3, resu, resv, resw)
     return ykrylov
 
 
@@ -1114,12 +1299,113 @@ return  ykrylov
 """
 
 
-def grid_to_particle(xk, yk, f, gridtype):
+# periodic index tables of the particle kernels: wrap_x[k+1] = k%nxc for k = -1..nxc+1,
+# node_x[k+1] = k%nxn for the node directions (no actual wrap inside the domain)
+wrap_x = np.arange(-1, nxc+2) % nxc
+wrap_y = np.arange(-1, nyc+2) % nyc
+node_x = np.arange(-1, nxn+2) % nxn
+node_y = np.arange(-1, nyn+2) % nyn
+
+@njit(cache=True, fastmath=True, parallel=True)
+def grid_to_particle_nb(xk, yk, f, fx, fy, dx, dy, wx, wy, fp):
+    ''' Numba version of grid_to_particle: the indexes are wrapped with the tables 
+    wx[k+1], wy[k+1] (wrap_* in the periodic directions, node_* otherwise)
+    '''
+    for i in prange(xk.shape[0]):
+      xa = (xk[i]-fx)/dx
+      ya = (yk[i]-fy)/dy
+      i1 = int(math.floor(xa))
+      j1 = int(math.floor(ya))
+      wx2 = xa - i1
+      wx1 = 1.0 - wx2
+      wy2 = ya - j1
+      wy1 = 1.0 - wy2
+      i1, i2 = wx[i1+1], wx[i1+2]
+      j1, j2 = wy[j1+1], wy[j1+2]
+      fp[i] = wx1* wy1 * f[i1,j1] + wx2* wy1 * f[i2,j1] + wx1* wy2 * f[i1,j2] + wx2* wy2 * f[i2,j2]
+
+use_cuda = GPU and cuda_available
+cuda_tpb = 256   # threads per block of the particle kernels
+
+if use_cuda:
+    @cuda.jit
+    def grid_to_particle_cuda(xk, yk, f, fx, fy, dx, dy, wx, wy, fp):
+        ''' CUDA version of grid_to_particle_nb: one thread per particle
+        '''
+        i = cuda.grid(1)
+        if i >= xk.shape[0]:
+            return
+        xa = (xk[i]-fx)/dx
+        ya = (yk[i]-fy)/dy
+        i1 = int(math.floor(xa))
+        j1 = int(math.floor(ya))
+        wx2 = xa - i1
+        wx1 = 1.0 - wx2
+        wy2 = ya - j1
+        wy1 = 1.0 - wy2
+        i1, i2 = wx[i1+1], wx[i1+2]
+        j1, j2 = wy[j1+1], wy[j1+2]
+        fp[i] = wx1* wy1 * f[i1,j1] + wx2* wy1 * f[i2,j1] + wx1* wy2 * f[i1,j2] + wx2* wy2 * f[i2,j2]
+
+    @cuda.jit
+    def particle_to_grid_J_cuda(xk, yk, uk, vk, wk, qk, dx, dy, wrap_x, wrap_y, Jx, Jy, Jz):
+        ''' CUDA version of particle_to_grid_J_nb: one thread per particle, atomic deposit
+        '''
+        i = cuda.grid(1)
+        if i >= xk.shape[0]:
+            return
+        qdxdy = qk[i]/dx/dy
+        # (fx, fy) shift and grid of the three components: LR, UD, c
+        for comp in range(3):
+            if comp == 0:
+                fx, fy, J, val = 0., dy/2., Jx, uk[i]
+            elif comp == 1:
+                fx, fy, J, val = dx/2., 0., Jy, vk[i]
+            else:
+                fx, fy, J, val = dx/2., dy/2., Jz, wk[i]
+            xa = (xk[i]-fx)/dx
+            ya = (yk[i]-fy)/dy
+            i1 = int(math.floor(xa))
+            j1 = int(math.floor(ya))
+            wx2 = xa - i1
+            wx1 = 1.0 - wx2
+            wy2 = ya - j1
+            wy1 = 1.0 - wy2
+            i1, i2 = wrap_x[i1+1], wrap_x[i1+2]
+            j1, j2 = wrap_y[j1+1], wrap_y[j1+2]
+            cuda.atomic.add(J, (i1,j1), wx1* wy1 * qdxdy * val)
+            cuda.atomic.add(J, (i2,j1), wx2* wy1 * qdxdy * val)
+            cuda.atomic.add(J, (i1,j2), wx1* wy2 * qdxdy * val)
+            cuda.atomic.add(J, (i2,j2), wx2* wy2 * qdxdy * val)
+
+def grid_to_particle_gpu(xk, yk, f, fx, fy, wx, wy, fp):
+    ''' Interpolation to the particles on the GPU: particles and grid copied to/from the device
+    '''
+    blocks = (xk.shape[0] + cuda_tpb - 1)//cuda_tpb
+    d_in = [cuda.to_device(np.ascontiguousarray(arr)) for arr in (xk, yk, f)]
+    d_fp = cuda.device_array(xk.shape[0], np.float64)
+    grid_to_particle_cuda[blocks, cuda_tpb](*d_in, fx, fy, dx, dy, cuda.to_device(wx), cuda.to_device(wy), d_fp)
+    fp[...] = d_fp.copy_to_host()
+
+def particle_to_grid_J_gpu(xk, yk, uk, vk, wk, qk, Jx, Jy, Jz):
+    ''' Deposit of the current on the GPU: particles and grids copied to/from the device
+    '''
+    blocks = (xk.shape[0] + cuda_tpb - 1)//cuda_tpb
+    d_part = [cuda.to_device(np.ascontiguousarray(arr)) for arr in (xk, yk, uk, vk, wk, qk)]
+    d_J = [cuda.to_device(np.zeros(np.shape(Jk), np.float64)) for Jk in (Jx, Jy, Jz)]
+    particle_to_grid_J_cuda[blocks, cuda_tpb](*d_part, dx, dy, cuda.to_device(wrap_x), cuda.to_device(wrap_y), *d_J)
+    for Jk, d_Jk in zip((Jx, Jy, Jz), d_J):
+        Jk[...] = d_Jk.copy_to_host()
+    Jx[nxn-1,:] = Jx[0,:]
+    Jy[:,nyn-1] = Jy[:,0]
+
+def grid_to_particle(xk, yk, f, gridtype, out=None):
     ''' Interpolation of grid quantity to particle
+    out (optional) is a preallocated particle array to be overwritten
     '''
     global dx, dy, nx, ny, npart
     
-    fp = zeros(npart,np.float64)
+    fp = np.empty(npart, np.float64) if out is None else out
 
     fx, fy = 0., 0.
     if gridtype=='LR':
@@ -1129,131 +1415,272 @@ def grid_to_particle(xk, yk, f, gridtype):
     elif gridtype=='C':
       fx, fy = dx/2., dy/2.
 
-    for i in range(npart):
-
-      #  interpolate field f from grid to particle */
-      xa = (xk[i]-fx)/dx
-      ya = (yk[i]-fy)/dy
-      i1 = int(np.floor(xa))
-      i2 = i1 + 1
-      j1 = int(np.floor(ya))
-      j2 = j1 + 1 
-      wx2 = xa - np.float64(i1)
-      wx1 = 1.0 - wx2
-      wy2 = ya - np.float64(j1)
-      wy1 = 1.0 - wy2
-      if gridtype=='LR':
-        j1, j2 = j1%nyc, j2%nyc
-      elif gridtype=='UD':
-        i1, i2 = i1%nxc, i2%nxc
-      elif gridtype=='C':
-        i1, i2 = i1%nxc, i2%nxc
-        j1, j2 = j1%nyc, j2%nyc
+    wx = wrap_x if gridtype in ('UD', 'C') else node_x
+    wy = wrap_y if gridtype in ('LR', 'C') else node_y
+    if use_cuda:
+      grid_to_particle_gpu(xk, yk, f, fx, fy, wx, wy, fp)
+      return fp
+
+    if numba_available:
+      grid_to_particle_nb(xk, yk, f, fx, fy, dx, dy, wx, wy, fp)
+      return fp
+
+    #  interpolate field f from grid to particle, all particles at once
+    xa = (xk-fx)/dx
+    ya = (yk-fy)/dy
+    i1 = np.floor(xa).astype(np.int64)
+    i2 = i1 + 1
+    j1 = np.floor(ya).astype(np.int64)
+    j2 = j1 + 1 
+    wx2 = xa - i1
+    wx1 = 1.0 - wx2
+    wy2 = ya - j1
+    wy1 = 1.0 - wy2
+    if gridtype=='LR':
+      j1, j2 = np.mod(j1, nyc), np.mod(j2, nyc)
+    elif gridtype=='UD':
+      i1, i2 = np.mod(i1, nxc), np.mod(i2, nxc)
+    elif gridtype=='C':
+      i1, i2 = np.mod(i1, nxc), np.mod(i2, nxc)
+      j1, j2 = np.mod(j1, nyc), np.mod(j2, nyc)
 
-      fp[i] = wx1* wy1 * f[i1,j1] + wx2* wy1 * f[i2,j1] + wx1* wy2 * f[i1,j2] + wx2* wy2 * f[i2,j2]
+    fp[...] = wx1* wy1 * f[i1,j1] + wx2* wy1 * f[i2,j1] + wx1* wy2 * f[i1,j2] + wx2* wy2 * f[i2,j2]
     
     return fp
 
-def particle_to_grid_rho(xk, yk, q):
-    ''' Interpolation particle to grid - charge rho -> c
+def deposit_bincount(i1, i2, j1, j2, wx1, wx2, wy1, wy2, weight, shape):
+    ''' Scatter-add of the four bilinear corners of every particle (numpy fallback):
+    np.bincount on the flattened indexes sums the repeated cells correctly
     '''
-    global dx, dy, nx, ny, npart, rho_ion
-    
-    rho = zeros(np.shape(xiC), np.float64)
+    size = shape[0]*shape[1]
+    grid  = np.bincount(i1*shape[1] + j1, wx1 * wy1 * weight, size)
+    grid += np.bincount(i2*shape[1] + j1, wx2 * wy1 * weight, size)
+    grid += np.bincount(i1*shape[1] + j2, wx1 * wy2 * weight, size)
+    grid += np.bincount(i2*shape[1] + j2, wx2 * wy2 * weight, size)
+    return grid.reshape(shape)
+
+@njit(cache=True, fastmath=True, parallel=True)
+def particle_to_grid_rho_nb(xk, yk, q, dx, dy, nxc, nyc, rho, nthreads, wrap_x, wrap_y):
+    ''' Numba version of particle_to_grid_rho: each thread deposits its own chunk of 
+    particles on a private copy of the grid, the copies are summed at the end
+    wrap_x[k+1] = k%nxc, wrap_y[k+1] = k%nyc: periodic indexes without integer division
+    '''
+    npart = xk.shape[0]
+    chunk = (npart + nthreads - 1)//nthreads
+    rhot = np.zeros((nthreads, nxc, nyc), np.float64)
 
-    for i in range(npart):
+    for t in prange(nthreads):
+      for i in range(t*chunk, min((t+1)*chunk, npart)):
         xa = (xk[i]-dx/2.)/dx
         ya = (yk[i]-dy/2.)/dy
-        i1 = int(np.floor(xa))
-        i2 = i1 + 1
-        j1 = int(np.floor(ya))
-        j2 = j1 + 1  
-        wx2 = xa - np.float64(i1)
+        i1 = int(math.floor(xa))
+        j1 = int(math.floor(ya))
+        wx2 = xa - i1
         wx1 = 1.0 - wx2
-        wy2 = ya - np.float64(j1)
+        wy2 = ya - j1
         wy1 = 1.0 - wy2
-        i1, i2 = i1%nxc, i2%nxc
-        j1, j2 = j1%nyc, j2%nyc
+        i1, i2 = wrap_x[i1+1], wrap_x[i1+2]
+        j1, j2 = wrap_y[j1+1], wrap_y[j1+2]
+
+        rhot[t, i1, j1] += wx1 * wy1 * q[i]
+        rhot[t, i2, j1] += wx2 * wy1 * q[i]
+        rhot[t, i1, j2] += wx1 * wy2 * q[i]
+        rhot[t, i2, j2] += wx2 * wy2 * q[i]
+
+    for i in prange(nxc):
+      for j in range(nyc):
+        for t in range(nthreads):
+          rho[i,j] += rhot[t,i,j]
 
-        rho[i1, j1] += wx1 * wy1 * q[i]
-        rho[i2, j1] += wx2 * wy1 * q[i]
-        rho[i1, j2] += wx1 * wy2 * q[i]
-        rho[i2, j2] += wx2 * wy2 * q[i]
+def particle_to_grid_rho(xk, yk, q, out=None):
+    ''' Interpolation particle to grid - charge rho -> c
+    out (optional) is a preallocated c array, zeroed and deposited on
+    '''
+    global dx, dy, nx, ny, npart, rho_ion
+    
+    if out is None:
+        rho = zeros(np.shape(xiC), FTYPE)
+    else:
+        rho = out
+        rho.fill(0.)
+
+    if numba_available:
+      particle_to_grid_rho_nb(xk, yk, q, dx, dy, nxc, nyc, rho, get_num_threads(), wrap_x, wrap_y)
+      if electron_and_ion:
+          rho += rho_ion
+      return rho
+
+    xa = (xk-dx/2.)/dx
+    ya = (yk-dy/2.)/dy
+    i1 = np.floor(xa).astype(np.int64)
+    j1 = np.floor(ya).astype(np.int64)
+    wx2 = xa - i1
+    wx1 = 1.0 - wx2
+    wy2 = ya - j1
+    wy1 = 1.0 - wy2
+    i1, i2 = np.mod(i1, nxc), np.mod(i1 + 1, nxc)
+    j1, j2 = np.mod(j1, nyc), np.mod(j1 + 1, nyc)
+
+    rho += deposit_bincount(i1, i2, j1, j2, wx1, wx2, wy1, wy2, q, np.shape(rho))
       
     if electron_and_ion:
         rho += rho_ion
 
     return rho 
 
-def particle_to_grid_J(xk, yk, uk, vk, wk, qk): 
+@njit(cache=True, fastmath=True, parallel=True)
+def particle_to_grid_J_nb(xk, yk, uk, vk, wk, qk, dx, dy, nxc, nyc, nxn, nyn, Jx, Jy, Jz, nthreads, wrap_x, wrap_y):
+    ''' Numba version of particle_to_grid_J: each thread deposits its own chunk of 
+    particles on a private copy of the grids, the copies are summed at the end
+    wrap_x[k+1] = k%nxc, wrap_y[k+1] = k%nyc: periodic indexes without integer division
+    (also for the last face, i1+1 == nxc -> 0)
+    '''
+    npart = xk.shape[0]
+    chunk = (npart + nthreads - 1)//nthreads
+
+    Jxt = np.zeros((nthreads, nxn, nyc), np.float64)
+    Jyt = np.zeros((nthreads, nxc, nyn), np.float64)
+    Jzt = np.zeros((nthreads, nxc, nyc), np.float64)
+
+    for t in prange(nthreads):
+      for i in range(t*chunk, min((t+1)*chunk, npart)):
+        qdxdy = qk[i]/dx/dy
+
+        #  interpolate p -> LR
+        xa = xk[i]/dx 
+        ya = (yk[i]-dy/2.)/dy
+        i1 = int(math.floor(xa))
+        j1 = int(math.floor(ya))
+        wx2 = xa - i1
+        wx1 = 1.0 - wx2
+        wy2 = ya - j1
+        wy1 = 1.0 - wy2
+        i1, i2 = wrap_x[i1+1], wrap_x[i1+2]
+        j1, j2 = wrap_y[j1+1], wrap_y[j1+2]
+
+        Jxt[t,i1,j1] += wx1* wy1 * qdxdy * uk[i]
+        Jxt[t,i2,j1] += wx2* wy1 * qdxdy * uk[i]
+        Jxt[t,i1,j2] += wx1* wy2 * qdxdy * uk[i]
+        Jxt[t,i2,j2] += wx2* wy2 * qdxdy * uk[i]
+
+        # interpolate p -> UD
+        xa = (xk[i]-dx/2.)/dx 
+        ya = yk[i]/dy
+        i1 = int(math.floor(xa))
+        j1 = int(math.floor(ya))
+        wx2 = xa - i1
+        wx1 = 1.0 - wx2
+        wy2 = ya - j1
+        wy1 = 1.0 - wy2
+        i1, i2 = wrap_x[i1+1], wrap_x[i1+2]
+        j1, j2 = wrap_y[j1+1], wrap_y[j1+2]
+
+        Jyt[t,i1,j1] += wx1* wy1 * qdxdy * vk[i]
+        Jyt[t,i2,j1] += wx2* wy1 * qdxdy * vk[i]
+        Jyt[t,i1,j2] += wx1* wy2 * qdxdy * vk[i]
+        Jyt[t,i2,j2] += wx2* wy2 * qdxdy * vk[i]
+
+        # interpolate p -> c
+        xa = (xk[i]-dx/2.)/dx 
+        ya = (yk[i]-dy/2.)/dy
+        i1 = int(math.floor(xa))
+        j1 = int(math.floor(ya))
+        wx2 = xa - i1
+        wx1 = 1.0 - wx2
+        wy2 = ya - j1
+        wy1 = 1.0 - wy2
+        i1, i2 = wrap_x[i1+1], wrap_x[i1+2]
+        j1, j2 = wrap_y[j1+1], wrap_y[j1+2]
+
+        Jzt[t,i1,j1] += wx1* wy1 * qdxdy * wk[i]
+        Jzt[t,i2,j1] += wx2* wy1 * qdxdy * wk[i]
+        Jzt[t,i1,j2] += wx1* wy2 * qdxdy * wk[i]
+        Jzt[t,i2,j2] += wx2* wy2 * qdxdy * wk[i]
+
+    # reduction of the private grids
+    for i in prange(nxn):
+      for j in range(nyc):
+        for t in range(nthreads):
+          Jx[i,j] += Jxt[t,i,j]
+    for i in prange(nxc):
+      for j in range(nyn):
+        for t in range(nthreads):
+          Jy[i,j] += Jyt[t,i,j]
+      for j in range(nyc):
+        for t in range(nthreads):
+          Jz[i,j] += Jzt[t,i,j]
+
+    Jx[nxn-1,:] = Jx[0,:]
+    Jy[:,nyn-1] = Jy[:,0]
+
+def particle_to_grid_J(xk, yk, uk, vk, wk, qk, out=None): 
     ''' Interpolation particle to grid - current -> LR, UD, c
+    out (optional) is a preallocated (LR, UD, c) tuple, zeroed and deposited on
     ''' 
     global dx, dy, nxc, nyc, nxn, nyn, npart
   
-    Jx = zeros(np.shape(xiLR), np.float64)
-    Jy = zeros(np.shape(xiUD), np.float64)
-    Jz = zeros(np.shape(xiC), np.float64)
-
-    for i in range(npart):
-
-      #  interpolate p -> LR
-      xa = xk[i]/dx 
-      ya = (yk[i]-dy/2.)/dy
-      i1 = int(np.floor(xa))
-      i2 = i1 + 1
-      if i2==nxn-1:
-        i2=0
-      j1 = int(np.floor(ya))
-      j2 = j1 + 1  
-      wx2 = xa - np.float64(i1)
-      wx1 = 1.0 - wx2
-      wy2 = ya - np.float64(j1)
-      wy1 = 1.0 - wy2
-      j1, j2 = j1%nyc, j2%nyc
-
-      Jx[i1,j1] += wx1* wy1 * qk[i] * uk[i]/dx/dy
-      Jx[i2,j1] += wx2* wy1 * qk[i] * uk[i]/dx/dy
-      Jx[i1,j2] += wx1* wy2 * qk[i] * uk[i]/dx/dy
-      Jx[i2,j2] += wx2* wy2 * qk[i] * uk[i]/dx/dy
-
-      # interpolate p -> UD
-      xa = (xk[i]-dx/2.)/dx 
-      ya = yk[i]/dy
-      i1 = int(np.floor(xa))
-      i2 = i1 + 1
-      j1 = int(np.floor(ya))
-      j2 = j1 + 1  
-      if j2==nyn-1:
-        j2=0
-      wx2 = xa - np.float64(i1)
-      wx1 = 1.0 - wx2
-      wy2 = ya - np.float64(j1)
-      wy1 = 1.0 - wy2
-      i1, i2 = i1%nxc, i2%nxc
-
-      Jy[i1,j1] += wx1* wy1 * qk[i] * vk[i]/dx/dy
-      Jy[i2,j1] += wx2* wy1 * qk[i] * vk[i]/dx/dy
-      Jy[i1,j2] += wx1* wy2 * qk[i] * vk[i]/dx/dy
-      Jy[i2,j2] += wx2* wy2 * qk[i] * vk[i]/dx/dy
-
-      # interpolate p -> c
-      xa = (xk[i]-dx/2.)/dx 
-      ya = (yk[i]-dy/2.)/dy
-      i1 = int(np.floor(xa))
-      i2 = i1 + 1
-      j1 = int(np.floor(ya))
-      j2 = j1 + 1  
-      wx2 = xa - np.float64(i1)
-      wx1 = 1.0 - wx2
-      wy2 = ya - np.float64(j1)
-      wy1 = 1.0 - wy2
-      i1, i2 = i1%nxc, i2%nxc
-      j1, j2 = j1%nyc, j2%nyc
-
-      Jz[i1,j1] += wx1* wy1 * qk[i] * wk[i]/dx/dy
-      Jz[i2,j1] += wx2* wy1 * qk[i] * wk[i]/dx/dy
-      Jz[i1,j2] += wx1* wy2 * qk[i] * wk[i]/dx/dy
-      Jz[i2,j2] += wx2* wy2 * qk[i] * wk[i]/dx/dy
+    if out is None:
+        Jx = zeros(np.shape(xiLR), FTYPE)
+        Jy = zeros(np.shape(xiUD), FTYPE)
+        Jz = zeros(np.shape(xiC), FTYPE)
+    else:
+        Jx, Jy, Jz = out
+        for J in out:
+            J.fill(0.)
+
+    if use_cuda:
+      particle_to_grid_J_gpu(xk, yk, uk, vk, wk, qk, Jx, Jy, Jz)
+      return Jx, Jy, Jz
+
+    if numba_available:
+      particle_to_grid_J_nb(xk, yk, uk, vk, wk, qk, dx, dy, nxc, nyc, nxn, nyn, Jx, Jy, Jz, get_num_threads(), wrap_x, wrap_y)
+      return Jx, Jy, Jz
+
+    qdxdy = qk/dx/dy
+
+    #  interpolate p -> LR
+    xa = xk/dx 
+    ya = (yk-dy/2.)/dy
+    i1 = np.floor(xa).astype(np.int64)
+    i2 = i1 + 1
+    i2[i2==nxn-1] = 0
+    j1 = np.floor(ya).astype(np.int64)
+    wx2 = xa - i1
+    wx1 = 1.0 - wx2
+    wy2 = ya - j1
+    wy1 = 1.0 - wy2
+    j1, j2 = np.mod(j1, nyc), np.mod(j1 + 1, nyc)
+
+    Jx += deposit_bincount(i1, i2, j1, j2, wx1, wx2, wy1, wy2, qdxdy * uk, np.shape(Jx))
+
+    # interpolate p -> UD
+    xa = (xk-dx/2.)/dx 
+    ya = yk/dy
+    i1 = np.floor(xa).astype(np.int64)
+    j1 = np.floor(ya).astype(np.int64)
+    j2 = j1 + 1  
+    j2[j2==nyn-1] = 0
+    wx2 = xa - i1
+    wx1 = 1.0 - wx2
+    wy2 = ya - j1
+    wy1 = 1.0 - wy2
+    i1, i2 = np.mod(i1, nxc), np.mod(i1 + 1, nxc)
+
+    Jy += deposit_bincount(i1, i2, j1, j2, wx1, wx2, wy1, wy2, qdxdy * vk, np.shape(Jy))
+
+    # interpolate p -> c
+    xa = (xk-dx/2.)/dx 
+    ya = (yk-dy/2.)/dy
+    i1 = np.floor(xa).astype(np.int64)
+    j1 = np.floor(ya).astype(np.int64)
+    wx2 = xa - i1
+    wx1 = 1.0 - wx2
+    wy2 = ya - j1
+    wy1 = 1.0 - wy2
+    i1, i2 = np.mod(i1, nxc), np.mod(i1 + 1, nxc)
+    j1, j2 = np.mod(j1, nyc), np.mod(j1 + 1, nyc)
+
+    Jz += deposit_bincount(i1, i2, j1, j2, wx1, wx2, wy1, wy2, qdxdy * wk, np.shape(Jz))
 
     Jx[nxn-1,:] = Jx[0,:]
     Jy[:,nyn-1] = Jy[:,0]
@@ -1273,12 +1700,9 @@ if perturb:
 
 stop_geom = time.time()
 
-print(g11_C)
-print(g12_C)
-print(g13_C)
-print(g22_C)
-print(g23_C)
-print(g33_C)
+print(geomC.g11)
+print(geomC.g12)
+print(geomC.g22)
 
 #if perturb:
 #    xgen, ygen = cartesian_to_general_particle(x, y)
@@ -1404,371 +1828,406 @@ print(g33_C)
 #print('energyBx=',histEnergyB1[0],'energyBy=',histEnergyB2[0],'energyBz=',histEnergyB3[0])
 #print('Momentumx=',histMomentumx[0],'Momentumy=',histMomentumy[0],'Momentumz=',histMomentumz[0])
 
-print('Main loop ...')
-start_loop = time.time()
+if NK_method:
+    from scipy.optimize import newton_krylov
+
+# scratch arrays of step_terms() and residual(), allocated once and reused by every call
+J_w = (zeros(np.shape(xiLR), FTYPE), zeros(np.shape(xiUD), FTYPE), zeros(np.shape(xiC), FTYPE))
+EBp_w = tuple(np.empty(npart, np.float64) for i in range(6))
+xbar_w, ybar_w, ubar_w, vbar_w, wbar_w, tmp_w, force_w = (np.empty(npart, np.float64) for i in range(7))
+Bbar_w = (np.empty((nxc, nyn), FTYPE), np.empty((nxn, nyc), FTYPE), np.empty((nxn, nyn), FTYPE))
+xgenbar_w = (np.empty(npart, np.float64), np.empty(npart, np.float64))
+# particles in general coordinates: mapped once per step (views on x, y without perturbation)
+xgen, ygen = cartesian_to_general_particle(x, y) if perturb else (x, y)
+# double buffers of the fields: E, B live in *_buf[cur], the step writes *_buf[nxt]
+E_buf = ((E1, E2, E3), tuple(np.empty_like(E_k) for E_k in (E1, E2, E3)))
+B_buf = ((B1, B2, B3), tuple(np.empty_like(B_k) for B_k in (B1, B2, B3)))
+cur, nxt = 0, 1
+# start of E1, E2, E3 in the Krylov vector (traces of the numpy diagnostics)
+E_offsets = np.array([0, nxn*nyc, nxn*nyc+nxc*nyn])
+
+def step_figure():
+    ''' To build the figure of plot_each_step once: B3 and rho maps, phase space,
+    particles map and divergence; returns its artists, updated in the main loop
+    '''
+    art = {'fig': reuse_figure('step', figsize=(12, 9))}
 
-# main cycle
+    plt.subplot(2, 3, 1)
+    art['B3'] = plt.pcolormesh(xiN, etaN, B3)
+    plt.title('B3 map')
+    plt.xlabel('x')
+    plt.ylabel('y')
+    plt.colorbar()
 
-for it in range(0,nt):
-    plt.clf()
-    #start = time.time()
-
-    if NK_method:
-        # The following is python's NK methods
-        #guess = zeros(2*nxn*nyc+2*nxc*nyn+nxc*nxc+nxn*nxn+3*2*part,np.float64)
-        guess = phys_to_krylov(E1, E2, E3, u, v, w)
-        sol = newton_krylov(residual, guess, method='lgmres', verbose=1, f_tol=1e-14)#, f_rtol=1e-7)
-        print('Residual: %g' % abs(residual(sol)).max())
-    elif Picard:
-        # The following is a Picard iteration
-        guess = phys_to_krylov(E1, E2, E3, u, v, w) 
-        err = 1.
-        tol = 1e-14
-        kmax = 100
-        k=0
-        xkrylov = guess
-        while err > tol and k<=kmax:
-            k+=1
-            xkold = xkrylov
-            xkrylov = xkrylov - residual(xkrylov)
-            err = np.linalg.norm(xkrylov-xkold)
-            print(k, err)
-        sol = xkrylov
-
-    """
-    #stop = time.time()
-    #cpu_time[it] = stop - start
-
-    #if relativistic:
-    #    gnew = np.sqrt(1.+unew**2+vnew**2+wnew**2)
-    #    gold = np.sqrt(1.+u**2+v**2+w**2)
-    #    gbar = (gold+gnew)/2.
-    #else:
-    #    gbar = np.ones(npart)
-    
-    # position is evolved in physical space 
-    # pushed by general geom. fields converted
-    #ubar = (unew + u)/2.
-    #vbar = (vnew + v)/2.
-    """
+    plt.subplot(2, 3, 2)
+    art['rho'] = plt.pcolormesh(xiC, etaC, rho)
+    plt.title('rho map')
+    plt.xlabel('x')
+    plt.ylabel('y')
+    plt.colorbar()
 
-    # t:    -1/2        0           1/2         1
-    #       B           Bbar        Bnew
-    #                   E/Eold                  Enew
-    #       u                       unew
-    #                   x                       xnew
-    #                   curlE
-    #                   Energy
-
-    E1new, E2new, E3new, unew, vnew, wnew = krylov_to_phys(sol)
-
-    xnew = x + unew * dt
-    ynew = y + vnew * dt
-
-    xnew = xnew % Lx
-    ynew = ynew % Ly
-
-    curlE1, curlE2, curlE3 = curl(E1, E2, E3, 'E')
-
-    B1new = B1 - dt * curlE1
-    B2new = B2 - dt * curlE2
-    B3new = B3 - dt * curlE3
-
-    B1bar = (B1new + B1)/2.
-    B2bar = (B2new + B2)/2.
-    B3bar = (B3new + B3)/2.
-    E1old = E1
-    E2old = E2
-    E3old = E3
-    x = xnew
-    y = ynew
-    u = unew
-    v = vnew
-    w = wnew
-    E1 = E1new
-    E2 = E2new
-    E3 = E3new
-    B1 = B1new
-    B2 = B2new
-    B3 = B3new
-
-
-    """
-    x += u*dt
-    y += v*dt
-    x = x%Lx
-    y = y%Ly
-    u = unew
-    v = vnew
-    w = wnew
-
-    E1bar = (E1new + E1)/2.
-    E2bar = (E2new + E2)/2.
-    E3bar = (E3new + E3)/2.
-
-    curlE1, curlE2, curlE3 = curl(E1bar, E2bar, E3bar,'E')
-
-    B1 = B1 - dt*curlE1
-    B2 = B2 - dt*curlE2
-    B3 = B3 - dt*curlE3
-    
-    if perturb:
-        xgen, ygen = cartesian_to_general_particle(x, y)
-    else:
-        xgen, ygen = x, y
-    """
+    plt.subplot(2, 3, 3)
+    art['phase1'], = plt.plot(x[0:npart1], u[0:npart1], 'b.')
+    art['phase2'], = plt.plot(x[npart1:npart], u[npart1:npart], 'r.')
+    plt.xlim((0, Lx))
+    plt.ylim((-2*V0x1, 2*V0x1))
+    plt.title('Phase space')
+    plt.xlabel('x')
+    plt.ylabel('u')
 
-    if perturb:
-        xgen, ygen = cartesian_to_general_particle(x, y)
-    else:
-        xgen, ygen = x, y
+    plt.subplot(2, 3, 4)
+    art['map1'], = plt.plot(x[0:npart1], y[0:npart1],'b.')
+    art['map2'], = plt.plot(x[npart1:npart], y[npart1:npart],'r.')
+    plt.xlim((0,Lx))
+    plt.ylim((0,Ly))
+    plt.title('Particles map')
+    plt.xlabel('x')
+    plt.ylabel('y')
 
-    rho = particle_to_grid_rho(xgen, ygen, q)
-    divE[it] = np.sum(div(E1, E2, E3, 'E'))
-    divB[it] = np.sum(div(B1, B2, B3, 'B'))
-    divE_rho[it] = np.sum(np.abs(div(E1new, E2new, E3new, 'E')) - np.abs(rho))
-    
-    E1time[it] = np.sum(E1)
-    E2time[it] = np.sum(E2)
-    E3time[it] = np.sum(E3)
-    B1time[it] = np.sum(B1)
-    B2time[it] = np.sum(B2)
-    B3time[it] = np.sum(B3)
-
-    if relativistic:
-        energyP1 = np.sum((g[0:npart1]-1.)*abs(q[0:npart1]/QM[0:npart1]))
-        energyP2 = np.sum((g[npart1:npart]-1.)*abs(q[npart1:npart]/QM[npart1:npart]))
-    #elif perturb:
-    #    energyP1 = 0.5*np.sum((J_C * g11_C * avg(E1 * J1, 'LR2C') + 2. * J_C * avg(g12_LR, 'LR2C') * avg(E1, 'LR2C') * avg(J2, 'UD2C')
-    #                         + J_C * g22_C * avg(E2 * J2, 'UD2C') + J_C * g33_C * E3 * J3)/2.*dx*dy)
-    #    energyP2 = 0.5*np.sum((J_C * g11_C * avg(E1 * J1, 'LR2C') + 2. * J_C * avg(g12_LR, 'LR2C') * avg(E1, 'LR2C') * avg(J2, 'UD2C')
-    #                         + J_C * g22_C * avg(E2 * J2, 'UD2C') + J_C * g33_C * E3 * J3)/2.*dx*dy)
-    #elif (not relativistic) and (not perturb):
-    else:
-        energyP1[it] = np.sum((u[0:npart1]**2+v[0:npart1]**2+w[0:npart1]**2)/2.*abs(q[0:npart1]/QM[0:npart1]))
-        energyP2[it] = np.sum((u[npart1:npart]**2+v[npart1:npart]**2 +w[npart1:npart]**2)/2.*abs(q[npart1:npart]/QM[npart1:npart]))
- 
-#    if perturb:
-#        # Energy -> defined in C
-#        energyE = (np.sum(J_C * g11_C * avg(E1**2, 'LR2C')) +  2.*np.sum(J_C * g12_C * avg(E1, 'LR2C') * avg(E2, 'UD2C'))\
-#                +  np.sum(J_C * g22_C * avg(E2**2, 'UD2C')) +  np.sum(J_C * g33_C * E3**2))/2.*dx*dy
-#        energyB = (np.sum(J_C * g11_C * avg(B1**2, 'UD2C')) + 2.*np.sum(J_C * g12_C * avg(B1, 'UD2C') * avg(B2, 'LR2C'))\
-#                +  np.sum(J_C * g22_C * avg(B2**2, 'LR2C')) +  np.sum(J_C * g33_C * avg(avg(B3**2, 'N2LR'), 'LR2C')))/2.*dx*dy
-#        
-#        energyTot = energyE + energyB + energyP1 + energyP2 
-#
-#        momentumx = np.sum(unew[0:npart])
-#        momentumy = np.sum(vnew[0:npart])
-#        momentumz = np.sum(wnew[0:npart])
-#        momentumTot = momentumx + momentumy + momentumz
-#
-#        histEnergyP1.append(energyP1)
-#        histEnergyP2.append(energyP2)
-#        histEnergyE.append(energyE)
-#        histEnergyB.append(energyB)
-#        histEnergyTot.append(energyTot)
-#    
-#        histMomentumx.append(momentumx)
-#        histMomentumy.append(momentumy)
-#        histMomentumz.append(momentumz)
-#        histMomentumTot.append(momentumTot)
-#
-#        energyP[it] = histEnergyP1[it] + histEnergyP2[it]
-#        
-#        print('cycle',it,'energy =',histEnergyTot[it])
-#        print('energyP1=',histEnergyP1[it],'energyP2=',histEnergyP2[it])
-#        print('energyE=',histEnergyE[it])
-#        print('energyB=',histEnergyB[it])
-#        print('relative energy change=',(histEnergyTot[it]-histEnergyTot[0])/histEnergyTot[0])
-#        print('momento totale= ', histMomentumTot[it])
-    if perturb:
+    art['div_ax'] = plt.subplot(2, 3, 6)
+    art['divE'], = plt.plot(divE, label = 'div(E)-rho')
+    art['divB'], = plt.plot(divB, label = 'div(B)')
+    plt.title('Divergence free')
+    plt.xlabel('t')
+    plt.ylabel('div')
+    plt.legend(loc='upper center', bbox_to_anchor=(0.5, -0.05), shadow=True, ncol=2)
+    return art
+
+if plot_each_step:
+    step_art = step_figure()
+    # shown once, non-blocking: the loop only flushes its events on the plotting cycles
+    plt.show(block=False)
+
+if plot_data == True:
+    # opened once, the rows of the cycles are buffered (64 kB) instead of reopening the file each cycle
+    data_file = open("iPiC_2D3V_cov_yee.dat", "a", buffering=1<<16)
+    # one row per cycle: it and 17 diagnostics, formatted as print would
+    data_row = ' '.join(['%s']*18) + '\n'
+
+print('Main loop ...')
+start_loop = time.time()
+
+# main cycle
+
+try:
+    for it in range(0,nt):
+        if sort_every > 0 and it > 0 and it % sort_every == 0:
+            resort_particles()
+            if perturb:
+                cartesian_to_general_particle(x, y, out=(xgen, ygen))
+        #start = time.time()
+
+        # E, B, x, y are fixed during the solve: their share of the residual is computed once
+        (B1new, B2new, B3new), (B1bar, B2bar, B3bar), dtcurlB, EBp = step_terms(B_buf[nxt])
+
+        if NK_method:
+            # The following is python's NK methods
+            #guess = zeros(2*nxn*nyc+2*nxc*nyn+nxc*nxc+nxn*nxn+3*2*part,np.float64)
+            guess = phys_to_krylov(E1, E2, E3, u, v, w)
+            sol = newton_krylov(residual, guess, method='lgmres', verbose=1, f_tol=solver_tol)#, f_rtol=1e-7)
+            print('Residual: %g' % abs(residual(sol)).max())
+        elif Picard:
+            # The following is a Picard iteration
+            guess = phys_to_krylov(E1, E2, E3, u, v, w) 
+            err = 1.
+            tol = solver_tol
+            kmax = 100
+            k=0
+            xkrylov = guess
+            while err > tol and k<=kmax:
+                k+=1
+                xkold = xkrylov
+                xkrylov = xkrylov - residual(xkrylov)
+                err = np.linalg.norm(xkrylov-xkold)
+                print(k, err)
+            sol = xkrylov
+
+        """
+        #stop = time.time()
+        #cpu_time[it] = stop - start
+
+        #if relativistic:
+        #    gnew = np.sqrt(1.+unew**2+vnew**2+wnew**2)
+        #    gold = np.sqrt(1.+u**2+v**2+w**2)
+        #    gbar = (gold+gnew)/2.
+        #else:
+        #    gbar = np.ones(npart)
+        
+        # position is evolved in physical space 
+        # pushed by general geom. fields converted
+        #ubar = (unew + u)/2.
+        #vbar = (vnew + v)/2.
+        """
+
+        # t:    -1/2        0           1/2         1
+        #       B           Bbar        Bnew
+        #                   E/Eold                  Enew
+        #       u                       unew
+        #                   x                       xnew
+        #                   curlE
+        #                   Energy
+
+        # Enew goes straight to the next E buffers, unew, vnew, wnew to u, v, w (one copy each)
+        krylov_to_phys(sol, out=(*E_buf[nxt], u, v, w))
+
+        # xnew = (x + unew*dt) % Lx, written straight on x, y (views on P)
+        if numba_available:
+            push_position_nb(x, y, u, v, dt, Lx, Ly)
+        else:
+            for pos, vel, L in ((x, u, Lx), (y, v, Ly)):
+                np.multiply(vel, dt, out=tmp_w)
+                pos += tmp_w
+                wrap(pos, L)
+
+        # E and B move to their next buffers (Bnew is already there), Eold keeps the current ones
+        E1old, E2old, E3old = E_buf[cur]
+        E1, E2, E3 = E_buf[nxt]
+        B1, B2, B3 = B_buf[nxt]
+        cur, nxt = nxt, cur
+
+
+        """
+        x += u*dt
+        y += v*dt
+        x = x%Lx
+        y = y%Ly
+        u = unew
+        v = vnew
+        w = wnew
+
+        E1bar = (E1new + E1)/2.
+        E2bar = (E2new + E2)/2.
+        E3bar = (E3new + E3)/2.
+
+        curlE1, curlE2, curlE3 = curl(E1bar, E2bar, E3bar,'E')
+
+        B1 = B1 - dt*curlE1
+        B2 = B2 - dt*curlE2
+        B3 = B3 - dt*curlE3
+        
+        if perturb:
+            xgen, ygen = cartesian_to_general_particle(x, y)
+        else:
+            xgen, ygen = x, y
+        """
+
+        if perturb:
+            cartesian_to_general_particle(x, y, out=(xgen, ygen))
+
+        if not (diag_all_steps or (it % every == 0) or (it == 1) or (it == nt-1)):
+            # diagnostics skipped on this cycle: its row of diag stays NaN
+            diag[it] = np.nan
+            continue
+
+        rho = particle_to_grid_rho(xgen, ygen, q, out=rho)
+        # E1, E2, E3 are E1new, E2new, E3new here: div(E) serves both divE and divE_rho
+        if numba_available and not geomLR.is_identity:
+            divE[it], divE_rho[it] = div_E_sums_nb(E1, E2, rho, geomLR.buf, geomUD.buf, geomC.buf, dx, dy)
+            divB[it] = div_B_sum_nb(B1, B2, geomLR.buf, geomUD.buf, geomN.buf, dx, dy)
+        elif numba_available:
+            divE[it], divE_rho[it] = div_E_sums_cart_nb(E1, E2, rho, dx, dy)
+            divB[it] = np.sum(div(B1, B2, B3, 'B'))
+        else:
+            divE_C = div(E1, E2, E3, 'E')
+            divE[it] = np.sum(divE_C)
+            divB[it] = np.sum(div(B1, B2, B3, 'B'))
+            np.abs(divE_C, out=divE_C)
+            divE_C -= np.abs(rho)
+            divE_rho[it] = np.sum(divE_C)
+        
+        if numba_available:
+            E1time[it], E2time[it], E3time[it], B1time[it], B2time[it], B3time[it] = field_sums_nb(E1, E2, E3, B1, B2, B3)
+        else:
+            # E1, E2, E3 are copies of E1new, E2new, E3new, consecutive views on sol:
+            # one reduceat over the field part of the vector
+            E1time[it], E2time[it], E3time[it] = np.add.reduceat(sol[:nxn*nyc+nxc*nyn+nxc*nyc], E_offsets)
+            B1time[it] = np.sum(B1)
+            B2time[it] = np.sum(B2)
+            B3time[it] = np.sum(B3)
+
+        if relativistic:
+            energyP1 = np.sum((g[0:npart1]-1.)*mass[0:npart1])
+            energyP2 = np.sum((g[npart1:npart]-1.)*mass[npart1:npart])
+        #elif perturb:
+        #    energyP1 = 0.5*np.sum((J_C * g11_C * avg(E1 * J1, 'LR2C') + 2. * J_C * avg(g12_LR, 'LR2C') * avg(E1, 'LR2C') * avg(J2, 'UD2C')
+        #                         + J_C * g22_C * avg(E2 * J2, 'UD2C') + J_C * g33_C * E3 * J3)/2.*dx*dy)
+        #    energyP2 = 0.5*np.sum((J_C * g11_C * avg(E1 * J1, 'LR2C') + 2. * J_C * avg(g12_LR, 'LR2C') * avg(E1, 'LR2C') * avg(J2, 'UD2C')
+        #                         + J_C * g22_C * avg(E2 * J2, 'UD2C') + J_C * g33_C * E3 * J3)/2.*dx*dy)
+        #elif (not relativistic) and (not perturb):
+        elif numba_available:
+            energyP1[it] = particle_energy_nb(u, v, w, mass, 0, npart1)
+            energyP2[it] = particle_energy_nb(u, v, w, mass, npart1, npart)
+        else:
+            energyP1[it] = np.sum((u[0:npart1]**2+v[0:npart1]**2+w[0:npart1]**2)/2.*mass[0:npart1])
+            energyP2[it] = np.sum((u[npart1:npart]**2+v[npart1:npart]**2 +w[npart1:npart]**2)/2.*mass[npart1:npart])
+     
+    #    if perturb:
+    #        # Energy -> defined in C
+    #        energyE = (np.sum(J_C * g11_C * avg(E1**2, 'LR2C')) +  2.*np.sum(J_C * g12_C * avg(E1, 'LR2C') * avg(E2, 'UD2C'))\
+    #                +  np.sum(J_C * g22_C * avg(E2**2, 'UD2C')) +  np.sum(J_C * g33_C * E3**2))/2.*dx*dy
+    #        energyB = (np.sum(J_C * g11_C * avg(B1**2, 'UD2C')) + 2.*np.sum(J_C * g12_C * avg(B1, 'UD2C') * avg(B2, 'LR2C'))\
+    #                +  np.sum(J_C * g22_C * avg(B2**2, 'LR2C')) +  np.sum(J_C * g33_C * avg(avg(B3**2, 'N2LR'), 'LR2C')))/2.*dx*dy
+    #        
+    #        energyTot = energyE + energyB + energyP1 + energyP2 
+    #
+    #        momentumx = np.sum(unew[0:npart])
+    #        momentumy = np.sum(vnew[0:npart])
+    #        momentumz = np.sum(wnew[0:npart])
+    #        momentumTot = momentumx + momentumy + momentumz
+    #
+    #        histEnergyP1.append(energyP1)
+    #        histEnergyP2.append(energyP2)
+    #        histEnergyE.append(energyE)
+    #        histEnergyB.append(energyB)
+    #        histEnergyTot.append(energyTot)
+    #    
+    #        histMomentumx.append(momentumx)
+    #        histMomentumy.append(momentumy)
+    #        histMomentumz.append(momentumz)
+    #        histMomentumTot.append(momentumTot)
+    #
+    #        energyP[it] = histEnergyP1[it] + histEnergyP2[it]
+    #        
+    #        print('cycle',it,'energy =',histEnergyTot[it])
+    #        print('energyP1=',histEnergyP1[it],'energyP2=',histEnergyP2[it])
+    #        print('energyE=',histEnergyE[it])
+    #        print('energyB=',histEnergyB[it])
+    #        print('relative energy change=',(histEnergyTot[it]-histEnergyTot[0])/histEnergyTot[0])
+    #        print('momento totale= ', histMomentumTot[it])
         # Energy -> defined in C
-        #energyE1[it]= np.sum(J_C * g11_C * avg(E1old**2, 'LR2C') \
-        #                + J_C * g12_C * avg(E1old, 'LR2C') * avg(E2old, 'UD2C'))/2.*dx*dy# \
-        #                #+ J_C * g13_C * avg(E1, 'LR2C') * E3)/2.*dx*dy 
-        #energyE2[it]= np.sum(J_C * g21_C * avg(E2old, 'UD2C') * avg(E1old, 'LR2C') \
-        #                 + J_C * g22_C * avg(E2old**2, 'UD2C'))/2.*dx*dy# \
-        #                #+ J_C * g23_C * avg(E2, 'UD2C') * E3)/2.*dx*dy 
-        #energyE3[it]= np.sum(#J_C * g31_C * E3 * avg(E1, 'LR2C') \
-        #               #+ J_C * g32_C * E3 * avg(E2, 'UD2C') \
-        #               + J_C * g33_C * E3old**2)/2.*dx*dy
-        #energyB1[it]= np.sum(J_C * g11_C * avg(B1bar, 'UD2C')**2 \
-        #               + J_C * g12_C * avg(B1bar, 'UD2C') * avg(B2bar, 'LR2C'))/2.*dx*dy# \
-        #               #+ J_C * g13_C * avg(B1, 'UD2C') * avg(avg(B3, 'N2LR'), 'LR2C'))/2.*dx*dy 
-        #energyB2[it]= np.sum(J_C * g21_C * avg(B2bar, 'LR2C') * avg(B1bar, 'UD2C')\
-        #                 + J_C * g22_C * avg(B2bar**2, 'LR2C'))/2.*dx*dy  # \
-        #               #+ J_C * g23_C * avg(B2, 'LR2C') * avg(avg(B3, 'N2LR'), 'LR2C'))/2.*dx*dy 
-        #energyB3[it]= np.sum(#J_C * g31_C * avg(avg(B3, 'N2LR'), 'LR2C') * avg(B1, 'UD2C') \
-        #               #+ J_C * g32_C * avg(avg(B3, 'N2LR'), 'LR2C') * avg(B2, 'LR2C') \
-        #               + J_C * g33_C * avg(avg(B3bar**2, 'N2LR'), 'LR2C'))/2.*dx*dy
-        energyE1[it] = np.sum(J_C * g11_C * avg(E1**2, 'LR2C')
-                              + J_C * g12_C * avg(E1, 'LR2C') * avg(E2, 'UD2C')
-                              + J_C * g13_C * avg(E1, 'LR2C') * E3)/2.*dx*dy
-        energyE2[it] = np.sum(J_C * g21_C * avg(E2, 'UD2C') * avg(E1, 'LR2C')
-                              + J_C * g22_C * avg(E2**2, 'UD2C')
-                              + J_C * g23_C * avg(E2, 'UD2C') * E3)/2.*dx*dy
-        energyE3[it] = np.sum(J_C * g31_C * E3 * avg(E1, 'LR2C')
-                              + J_C * g32_C * E3 * avg(E2, 'UD2C')
-                              + J_C * g33_C * E3**2)/2.*dx*dy
-        energyB1[it] = np.sum(J_C * g11_C * avg(B1bar**2, 'UD2C')
-                              + J_C * g12_C *
-                              avg(B1bar, 'UD2C') * avg(B2bar, 'LR2C')
-                              + J_C * g13_C * avg(B1, 'UD2C') * avg(avg(B3, 'N2LR'), 'LR2C'))/2.*dx*dy
-        energyB2[it] = np.sum(J_C * g21_C * avg(B2bar, 'LR2C') * avg(B1bar, 'UD2C')
-                              + J_C * g22_C * avg(B2bar**2, 'LR2C')
-                              + J_C * g23_C * avg(B2, 'LR2C') * avg(avg(B3, 'N2LR'), 'LR2C'))/2.*dx*dy
-        energyB3[it] = np.sum(J_C * g31_C * avg(avg(B3, 'N2LR'), 'LR2C') * avg(B1, 'UD2C')
-                              + J_C * g32_C *
-                              avg(avg(B3, 'N2LR'), 'LR2C') * avg(B2, 'LR2C')
-                              + J_C * g33_C * avg(avg(B3bar**2, 'N2LR'), 'LR2C'))/2.*dx*dy
-    else:
-        energyE1[it] = np.sum(E1old[0:nxn-1,:]**2)/2.*dx*dy
-        energyE2[it] = np.sum(E2old[:,0:nyn-1]**2)/2.*dx*dy
-        energyE3[it] = np.sum(E3old[:,:]**2)/2.*dx*dy
-        energyB1[it] = np.sum(B1bar[:,0:nyn-1]**2)/2.*dx*dy
-        energyB2[it] = np.sum(B2bar[0:nxn-1,:]**2)/2.*dx*dy
-        energyB3[it] = np.sum(B3bar[0:nxn-1,0:nyn-1]**2)/2.*dx*dy
-    
-    energyTot[it] = energyP1[it] + energyP2[it] + energyE1[it] + energyE2[it] + energyE3[it] + energyB1[it] + energyB2[it] + energyB3[it]
-
-    momentumx = np.sum(unew[0:npart])
-    momentumy = np.sum(vnew[0:npart])   
-    momentumz = np.sum(wnew[0:npart])
-    momentumTot[it] = momentumx + momentumy + momentumz
-
-   #histEnergyP1.append(energyP1)
-   #histEnergyP2.append(energyP2)
-   #histEnergyE1.append(energyE1)
-   #histEnergyE2.append(energyE2)
-   #histEnergyE3.append(energyE3)
-   #histEnergyB1.append(energyB1)
-   #histEnergyB2.append(energyB2)
-   #histEnergyB3.append(energyB3)
-   #histEnergyTot.append(energyTot)
-   #
-   #histMomentumx.append(momentumx)
-   #histMomentumy.append(momentumy)
-   #histMomentumz.append(momentumz)
-   #histMomentumTot.append(momentumTot)
-
-    energyP[it] = energyP1[it] + energyP2[it]
-    energyE[it] = energyE1[it] + energyE2[it] + energyE3[it]
-    energyB[it] = energyB1[it] + energyB2[it] + energyB3[it]
+            #energyE1[it]= np.sum(J_C * g11_C * avg(E1old**2, 'LR2C') \
+            #                + J_C * g12_C * avg(E1old, 'LR2C') * avg(E2old, 'UD2C'))/2.*dx*dy# \
+            #                #+ J_C * g13_C * avg(E1, 'LR2C') * E3)/2.*dx*dy 
+            #energyE2[it]= np.sum(J_C * g21_C * avg(E2old, 'UD2C') * avg(E1old, 'LR2C') \
+            #                 + J_C * g22_C * avg(E2old**2, 'UD2C'))/2.*dx*dy# \
+            #                #+ J_C * g23_C * avg(E2, 'UD2C') * E3)/2.*dx*dy 
+            #energyE3[it]= np.sum(#J_C * g31_C * E3 * avg(E1, 'LR2C') \
+            #               #+ J_C * g32_C * E3 * avg(E2, 'UD2C') \
+            #               + J_C * g33_C * E3old**2)/2.*dx*dy
+            #energyB1[it]= np.sum(J_C * g11_C * avg(B1bar, 'UD2C')**2 \
+            #               + J_C * g12_C * avg(B1bar, 'UD2C') * avg(B2bar, 'LR2C'))/2.*dx*dy# \
+            #               #+ J_C * g13_C * avg(B1, 'UD2C') * avg(avg(B3, 'N2LR'), 'LR2C'))/2.*dx*dy 
+            #energyB2[it]= np.sum(J_C * g21_C * avg(B2bar, 'LR2C') * avg(B1bar, 'UD2C')\
+            #                 + J_C * g22_C * avg(B2bar**2, 'LR2C'))/2.*dx*dy  # \
+            #               #+ J_C * g23_C * avg(B2, 'LR2C') * avg(avg(B3, 'N2LR'), 'LR2C'))/2.*dx*dy 
+            #energyB3[it]= np.sum(#J_C * g31_C * avg(avg(B3, 'N2LR'), 'LR2C') * avg(B1, 'UD2C') \
+            #               #+ J_C * g32_C * avg(avg(B3, 'N2LR'), 'LR2C') * avg(B2, 'LR2C') \
+            #               + J_C * g33_C * avg(avg(B3bar**2, 'N2LR'), 'LR2C'))/2.*dx*dy
+        if perturb and numba_available:
+            sE1, sE2, sE3, sB1, sB2, sB3 = field_energies_nb(E1, E2, E3, B1bar, B2bar, B3bar, geomC.buf)
+            energyE1[it] = sE1/2.*dx*dy
+            energyE2[it] = sE2/2.*dx*dy
+            energyE3[it] = sE3/2.*dx*dy
+            energyB1[it] = sB1/2.*dx*dy
+            energyB2[it] = sB2/2.*dx*dy
+            energyB3[it] = sB3/2.*dx*dy
+        elif perturb:
+            J_C, g11_C, g12_C, g22_C = geomC.det, geomC.g11, geomC.g12, geomC.g22
+            E1_C, E2_C = avg(E1, 'LR2C'), avg(E2, 'UD2C')
+            B1bar_C, B2bar_C = avg(B1bar, 'UD2C'), avg(B2bar, 'LR2C')
+            energyE1[it] = np.sum(J_C * g11_C * avg(E1**2, 'LR2C')
+                                  + J_C * g12_C * E1_C * E2_C)/2.*dx*dy
+            energyE2[it] = np.sum(J_C * g12_C * E2_C * E1_C
+                                  + J_C * g22_C * avg(E2**2, 'UD2C'))/2.*dx*dy
+            energyE3[it] = np.sum(J_C * E3**2)/2.*dx*dy
+            energyB1[it] = np.sum(J_C * g11_C * avg(B1bar**2, 'UD2C')
+                                  + J_C * g12_C *
+                                  B1bar_C * B2bar_C)/2.*dx*dy
+            energyB2[it] = np.sum(J_C * g12_C * B2bar_C * B1bar_C
+                                  + J_C * g22_C * avg(B2bar**2, 'LR2C'))/2.*dx*dy
+            energyB3[it] = np.sum(J_C * avgN2C(B3bar**2))/2.*dx*dy
+        else:
+            energyE1[it] = sum_squares(E1old[0:nxn-1,:])/2.*dx*dy
+            energyE2[it] = sum_squares(E2old[:,0:nyn-1])/2.*dx*dy
+            energyE3[it] = sum_squares(E3old[:,:])/2.*dx*dy
+            energyB1[it] = sum_squares(B1bar[:,0:nyn-1])/2.*dx*dy
+            energyB2[it] = sum_squares(B2bar[0:nxn-1,:])/2.*dx*dy
+            energyB3[it] = sum_squares(B3bar[0:nxn-1,0:nyn-1])/2.*dx*dy
         
-    print('cycle',it,'energy =',energyTot[it])
-    print('energyP1=',energyP1[it],'energyP2=',energyP2[it])
-    print('energyE1=',energyE1[it],'energyE2=',energyE2[it],'energyE3=',energyE3[it])
-    print('energyB1=',energyB1[it],'energyB2=',energyB2[it],'energyB3=',energyB3[it])
-    print('relative energy change=',(energyTot[it]-energyTot[0])/energyTot[0])
-    print('momento totale= ', momentumTot[it])
-    print('')
-
-    if plot_each_step == True:
-        plt.figure(figsize=(12, 9))
-
-        plt.subplot(2, 3, 1)
-        plt.pcolor(xiN, etaN, B3)
-        plt.title('B3 map')
-        plt.xlabel('x')
-        plt.ylabel('y')
-        plt.colorbar()
-
-        #plt.subplot(2, 3, 2)
-        #plt.pcolor(xUD, yUD, E2)
-        #plt.title('E_y map')
-        #plt.xlabel('x')
-        #plt.ylabel('y')
-        #plt.colorbar()
-
-        #plt.subplot(2, 3, 3)
-        #plt.pcolor(xc, yc, E3)
-        #plt.title('E_z map')
-        #plt.xlabel('x')
-        #plt.ylabel('y')
-        #plt.colorbar()
-
-        plt.subplot(2, 3, 2)
-        plt.pcolor(xiC, etaC, rho)
-        plt.title('rho map')
-        plt.xlabel('x')
-        plt.ylabel('y')
-        plt.colorbar()
-
-        plt.subplot(2, 3, 3)
-        plt.plot(x[0:npart1], u[0:npart1], 'b.')
-        plt.plot(x[npart1:npart], u[npart1:npart], 'r.')
-        plt.xlim((0, Lx))
-        plt.ylim((-2*V0x1, 2*V0x1))
-        plt.title('Phase space')
-        plt.xlabel('x')
-        plt.ylabel('u')
-
-        #plt.subplot(2, 3, 3)
-        #plt.plot(momentumTot)
-        #plt.title('Momentum evolution')
-        #plt.xlabel('t')
-        #plt.ylabel('p')
-
-        plt.subplot(2, 3, 4)
-        plt.plot(x[0:npart1], y[0:npart1],'b.')
-        plt.plot(x[npart1:npart], y[npart1:npart],'r.')
-        plt.xlim((0,Lx))
-        plt.ylim((0,Ly))
-        plt.title('Particles map')
-        plt.xlabel('x')
-        plt.ylabel('y')
-
-        #plt.subplot(2, 3, 5)
-        #plt.plot((histEnergyTot-histEnergyTot[0])/histEnergyTot[0])#, label='U_tot')
-        #plt.plot(energyE+energyB)#, label='U_fields')
-        #plt.plot(energyE)#, label='U_elect')
-        #plt.plot(energyB)#, label = 'U_mag')
-        #plt.plot(energyP, label='U_part')
-        #plt.title('Energy evolution')
-        #plt.xlabel('t')
-        #plt.ylabel('E')
-        #plt.legend(loc='upper center', bbox_to_anchor=(0.5, -0.05),shadow=True, ncol=2)
-
-        plt.subplot(2, 3, 6)
-        plt.plot(divE, label = 'div(E)-rho')
-        plt.plot(divB, label = 'div(B)')
-        plt.title('Divergence free')
-        plt.xlabel('t')
-        plt.ylabel('div')
-        plt.legend(loc='upper center', bbox_to_anchor=(0.5, -0.05), shadow=True, ncol=2)
-
-        filename1 = PATH1 + 'fig_' + '%04d'%it + '.png'
+        energyTot[it] = energyP1[it] + energyP2[it] + energyE1[it] + energyE2[it] + energyE3[it] + energyB1[it] + energyB2[it] + energyB3[it]
+
+        momentumx = np.sum(u[0:npart])
+        momentumy = np.sum(v[0:npart])   
+        momentumz = np.sum(w[0:npart])
+        momentumTot[it] = momentumx + momentumy + momentumz
+
+       #histEnergyP1.append(energyP1)
+       #histEnergyP2.append(energyP2)
+       #histEnergyE1.append(energyE1)
+       #histEnergyE2.append(energyE2)
+       #histEnergyE3.append(energyE3)
+       #histEnergyB1.append(energyB1)
+       #histEnergyB2.append(energyB2)
+       #histEnergyB3.append(energyB3)
+       #histEnergyTot.append(energyTot)
+       #
+       #histMomentumx.append(momentumx)
+       #histMomentumy.append(momentumy)
+       #histMomentumz.append(momentumz)
+       #histMomentumTot.append(momentumTot)
+
+        energyP[it] = energyP1[it] + energyP2[it]
+        energyE[it] = energyE1[it] + energyE2[it] + energyE3[it]
+        energyB[it] = energyB1[it] + energyB2[it] + energyB3[it]
+            
+        print('cycle',it,'energy =',energyTot[it])
+        print('energyP1=',energyP1[it],'energyP2=',energyP2[it])
+        print('energyE1=',energyE1[it],'energyE2=',energyE2[it],'energyE3=',energyE3[it])
+        print('energyB1=',energyB1[it],'energyB2=',energyB2[it],'energyB3=',energyB3[it])
+        print('relative energy change=',(energyTot[it]-energyTot[0])/energyTot[0])
+        print('momento totale= ', momentumTot[it])
+        print('')
+
+        if plot_each_step and ((it % every == 0) or (it == 1)):
+            # the artists of the step figure are updated, the figure is built once before the loop
+            step_art['B3'].set_array(B3.ravel())
+            step_art['rho'].set_array(rho.ravel())
+            for mesh in (step_art['B3'], step_art['rho']):
+                mesh.autoscale()
+            step_art['phase1'].set_data(x[0:npart1], u[0:npart1])
+            step_art['phase2'].set_data(x[npart1:npart], u[npart1:npart])
+            step_art['map1'].set_data(x[0:npart1], y[0:npart1])
+            step_art['map2'].set_data(x[npart1:npart], y[npart1:npart])
+            step_art['divE'].set_ydata(divE)
+            step_art['divB'].set_ydata(divB)
+            step_art['div_ax'].relim()
+            step_art['div_ax'].autoscale_view()
+
+            filename1 = PATH1 + 'fig_' + '%04d'%it + '.png'
+            step_art['fig'].savefig(filename1, dpi=ndpi)
+            # no plt.pause: redraw the window and process its pending events without the sleep
+            step_art['fig'].canvas.draw_idle()
+            step_art['fig'].canvas.flush_events()
         if (it % every == 0) or (it == 1):
-            plt.savefig(filename1, dpi=ndpi)
-        plt.pause(0.00000001)
-    if (it % every == 0) or (it == 1):
-        '''
-        if nppc!=0:
-            myplot_particle_map(x, y)
-            filename1 = PATH1 + 'part_' + '%04d'%it + '.png'
-            plt.savefig(filename1, dpi=ndpi) 
-
-            myplot_phase_space(x, u, limx=(0, Lx), limy=(-2*V0x1, 2*V0x1), xlabel='x', ylabel='vx')
-            filename1 = PATH1 + 'phase_' + '%04d'%it + '.png'
+            '''
+            if nppc!=0:
+                myplot_particle_map(x, y)
+                filename1 = PATH1 + 'part_' + '%04d'%it + '.png'
+                plt.savefig(filename1, dpi=ndpi) 
+
+                myplot_phase_space(x, u, limx=(0, Lx), limy=(-2*V0x1, 2*V0x1), xlabel='x', ylabel='vx')
+                filename1 = PATH1 + 'phase_' + '%04d'%it + '.png'
+                plt.savefig(filename1, dpi=ndpi)
+
+                myplot_map(xc, yc, rho, title='rho', xlabel='x', ylabel='y')
+                filename1 = PATH1 + 'rho_' + '%04d'%it + '.png'
+                plt.savefig(filename1, dpi=ndpi)
+            '''
+            myplot_map(xiN, etaN, B3, title='B_3', xlabel='x', ylabel='y')
+            filename1 = PATH1 + 'B3_' + '%04d' % it + '.png'
             plt.savefig(filename1, dpi=ndpi)
 
-            myplot_map(xc, yc, rho, title='rho', xlabel='x', ylabel='y')
-            filename1 = PATH1 + 'rho_' + '%04d'%it + '.png'
+            myplot_map(xiLR, etaLR, E1, title='E_1', xlabel='x', ylabel='y')
+            filename1 = PATH1 + 'E1_' + '%04d' % it + '.png'
             plt.savefig(filename1, dpi=ndpi)
-        '''
-        myplot_map(xiN, etaN, B3, title='B_3', xlabel='x', ylabel='y')
-        filename1 = PATH1 + 'B3_' + '%04d' % it + '.png'
-        plt.savefig(filename1, dpi=ndpi)
-
-        myplot_map(xiLR, etaLR, E1, title='E_1', xlabel='x', ylabel='y')
-        filename1 = PATH1 + 'E1_' + '%04d' % it + '.png'
-        plt.savefig(filename1, dpi=ndpi)
+        if plot_data == True:
+            data_file.write(data_row % (it, E1time[it], E2time[it], E3time[it], B1time[it], B2time[it], B3time[it],
+                                        energyE1[it], energyE2[it], energyE3[it], energyB1[it], energyB2[it], energyB3[it],
+                                        energyTot[it], energyP1[it], energyP2[it], divE[it], divB[it]))
+finally:
+    # the buffered rows are flushed even if the run stops on an exception
     if plot_data == True:
-        f = open("iPiC_2D3V_cov_yee.dat", "a")
-        print(it, np.sum(E1), np.sum(E2), np.sum(E3), np.sum(B1), np.sum(B2), np.sum(B3), \
-              energyE1, energyE2, energyE3, energyB1, energyB2, energyB3, energyTot, energyP1, energyP2, \
-              divE[it], divB[it], file=f)
-        f.close()
+        data_file.close()
 
 
 stop_loop = time.time()
@@ -1782,75 +2241,33 @@ if plot_dir == True:
     #    filename1 = PATH1 + '@energy_elec_' + '%04d'%it + '.png'
     #    plt.savefig(filename1, dpi=ndpi)
     #else:
-    myplot_func((energyTot-energyTot[0])/energyTot[0],
-                title='Relative error on total energy', xlabel='t', ylabel='err(E)')
-    filename1 = PATH1 + '@error_rel_' + '%04d' % it + '.png'
-    plt.savefig(filename1, dpi=ndpi)
-
-    ##np.abs(histEnergyTot[it-1]-histEnergyTot[it])/histEnergyTot[it]
-    #myplot_func((histEnergyTot-histEnergyTot[it-1])/histEnergyTot[it-1],
-    #            title='Total energy error', xlabel='t', ylabel='err(E)')
-    #filename1 = PATH1 + '@error_' + '%04d' % it + '.png'
-    #plt.savefig(filename1, dpi=ndpi)
-
-    myplot_func(energyB,  title='Energy B', xlabel='t', ylabel='U_mag')
-    filename1 = PATH1 + '@energy_mag_' + '%04d'%it + '.png'
-    plt.savefig(filename1, dpi=ndpi)
-
-    myplot_func(energyE,  title='Energy E', xlabel='t', ylabel='U_el')
-    filename1 = PATH1 + '@energy_elec_' + '%04d'%it + '.png'
-    plt.savefig(filename1, dpi=ndpi)
-
-    myplot_func(energyP,  title='Energy Part.', xlabel='t', ylabel='U_part')
-    filename1 = PATH1 + '@energy_part_' + '%04d'%it + '.png'
-    plt.savefig(filename1, dpi=ndpi)
-
-    myplot_func(energyTot, title='Energy Total.', xlabel='t', ylabel='U_part')
-    filename1 = PATH1 + '@energy_total_' + '%04d' % it + '.png'
-    plt.savefig(filename1, dpi=ndpi)
-
-    myplot_func(momentumTot, title='Momentum', xlabel='t', ylabel='p')
-    filename1 = PATH1 + '@momentum_' + '%04d'%it + '.png'
-    plt.savefig(filename1, dpi=ndpi)
-
-    myplot_func(divE_rho, title='div(E)-rho', xlabel='t', ylabel='div')
-    filename1 = PATH1 + '@div(E)-rho_' + '%04d'%it + '.png'
-    plt.savefig(filename1, dpi=ndpi)
-
-    myplot_func(divE, title='div(E)', xlabel='t', ylabel='div(E)')
-    filename1 = PATH1 + '@div(E)_' + '%04d'%it + '.png'
-    plt.savefig(filename1, dpi=ndpi)
-
-    myplot_func(divB, title='div(B)', xlabel='t', ylabel='div')
-    filename1 = PATH1 + '@div(B)_' + '%04d'%it + '.png'
-    plt.savefig(filename1, dpi=ndpi)
-
-    myplot_func(B1time,  title='B1 time evolution', xlabel='t', ylabel='B1')
-    filename1 = PATH1 + '@B1_' + '%04d'%it + '.png'
-    plt.savefig(filename1, dpi=ndpi)
-
-    myplot_func(B2time,  title='B2 time evolution', xlabel='t', ylabel='B2')
-    filename1 = PATH1 + '@B2_' + '%04d'%it + '.png'
-    plt.savefig(filename1, dpi=ndpi)
-
-    myplot_func(B3time,  title='B3 time evolution', xlabel='t', ylabel='B3')
-    filename1 = PATH1 + '@B3_' + '%04d'%it + '.png'
-    plt.savefig(filename1, dpi=ndpi)
-
-    myplot_func(E1time,  title='E1 time evolution', xlabel='t', ylabel='E1')
-    filename1 = PATH1 + '@E1_' + '%04d'%it + '.png'
-    plt.savefig(filename1, dpi=ndpi)
-
-    myplot_func(E2time,  title='E2 time evolution', xlabel='t', ylabel='E2')
-    filename1 = PATH1 + '@E2_' + '%04d'%it + '.png'
-    plt.savefig(filename1, dpi=ndpi)
-
-    myplot_func(E3time,  title='E3 time evolution', xlabel='t', ylabel='E3')
-    filename1 = PATH1 + '@E3_' + '%04d'%it + '.png'
-    plt.savefig(filename1, dpi=ndpi)
+    # cycles whose diagnostics were skipped (diag_all_steps=False) hold NaN: left out of the plots
+    t_diag = np.flatnonzero(~np.isnan(energyTot))
+    end_plots = [((energyTot-energyTot[0])/energyTot[0], 'Relative error on total energy', 'err(E)', '@error_rel_'),
+                 (energyB, 'Energy B', 'U_mag', '@energy_mag_'),
+                 (energyE, 'Energy E', 'U_el', '@energy_elec_'),
+                 (energyP, 'Energy Part.', 'U_part', '@energy_part_'),
+                 (energyTot, 'Energy Total.', 'U_part', '@energy_total_'),
+                 (momentumTot, 'Momentum', 'p', '@momentum_'),
+                 (divE_rho, 'div(E)-rho', 'div', '@div(E)-rho_'),
+                 (divE, 'div(E)', 'div(E)', '@div(E)_'),
+                 (divB, 'div(B)', 'div', '@div(B)_'),
+                 (B1time, 'B1 time evolution', 'B1', '@B1_'),
+                 (B2time, 'B2 time evolution', 'B2', '@B2_'),
+                 (B3time, 'B3 time evolution', 'B3', '@B3_'),
+                 (E1time, 'E1 time evolution', 'E1', '@E1_'),
+                 (E2time, 'E2 time evolution', 'E2', '@E2_'),
+                 (E3time, 'E3 time evolution', 'E3', '@E3_')]
+    for field, title, ylabel, prefix in end_plots:
+        myplot_func(field[t_diag], title=title, xlabel='t', ylabel=ylabel, t=t_diag)
+        filename1 = PATH1 + prefix + '%04d'%it + '.png'
+        plt.savefig(filename1, dpi=ndpi)
 
 #fname = PATH1 + "energyTOT_perturbed_eps0.txt"
 #np.savetxt(fname, energyTot)
 
+if plot_data == True:
+    np.savez(PATH1 + 'diag', **{name: diag[:nt, i] for i, name in enumerate(diag_names)})
+
 print('Geometry initialisation cpu time:', stop_geom - start_geom)
 print('Time integration cpu time:', stop_loop - start_loop)
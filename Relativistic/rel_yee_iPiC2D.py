@@ -266,9 +266,9 @@ def grid_to_particle(xk,yk,f,gridtype):
       i2 = i1 + 1
       j1 = int(np.floor(ya))
       j2 = j1 + 1 
-      wx2 = xa - np.float64(i1)
+      wx2 = xa - i1
       wx1 = 1.0 - wx2
-      wy2 = ya - np.float64(j1)
+      wy2 = ya - j1
       wy1 = 1.0 - wy2
       if gridtype=='LR':
         j1, j2 = j1%nyc, j2%nyc
@@ -301,9 +301,9 @@ def particle_to_grid_J(xk,yk,uk,vk,wk,qk):
         i2=0
       j1 = int(np.floor(ya))
       j2 = j1 + 1  
-      wx2 = xa - np.float64(i1)
+      wx2 = xa - i1
       wx1 = 1.0 - wx2
-      wy2 = ya - np.float64(j1)
+      wy2 = ya - j1
       wy1 = 1.0 - wy2
       j1, j2 = j1%nyc, j2%nyc
 
@@ -321,9 +321,9 @@ def particle_to_grid_J(xk,yk,uk,vk,wk,qk):
       j2 = j1 + 1  
       if j2==nyn-1:
         j2=0
-      wx2 = xa - np.float64(i1)
+      wx2 = xa - i1
       wx1 = 1.0 - wx2
-      wy2 = ya - np.float64(j1)
+      wy2 = ya - j1
       wy1 = 1.0 - wy2
       i1, i2 = i1%nxc, i2%nxc
 
@@ -339,9 +339,9 @@ def particle_to_grid_J(xk,yk,uk,vk,wk,qk):
       i2 = i1 + 1
       j1 = int(np.floor(ya))
       j2 = j1 + 1  
-      wx2 = xa - np.float64(i1)
+      wx2 = xa - i1
       wx1 = 1.0 - wx2
-      wy2 = ya - np.float64(j1)
+      wy2 = ya - j1
       wy1 = 1.0 - wy2
       i1, i2 = i1%nxc, i2%nxc
       j1, j2 = j1%nyc, j2%nyc